@@ -16,7 +16,13 @@ __all__ = [
     "parse_code",
     "file_work",
     "zip",
-    "zip_work"
+    "zip_work",
+    "pipeline",
+    "run_pipeline",
+    "data",
+    "load_data",
+    "journal",
+    "RunJournal",
 ]
 
 __version__ = "2024.2.0"
@@ -27,6 +33,9 @@ from .funcs import parse_code, read_user_data
 from .result import Result
 from .filer import file_work
 from .zip import zip_work
+from .pipeline import run_pipeline
+from .data import load_data
+from .journal import RunJournal
 
 if __name__ == "__main__":
     filename = "model_solution.py"
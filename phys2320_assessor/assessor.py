@@ -4,6 +4,7 @@ __all__ = ["Assessor"]
 
 from os import path
 import builtins
+from contextlib import nullcontext
 import base64
 import re
 import os
@@ -13,9 +14,14 @@ import shutil
 import types
 import importlib
 from pathlib import Path
+from collections import deque
 import subprocess as proc
 import sqlite3
 import glob
+import hashlib
+import logging
+import pickle
+from copy import deepcopy
 from pprint import pformat, pprint
 
 import mccabe
@@ -25,25 +31,38 @@ from time import perf_counter
 from inspect import getdoc, isclass, ismodule, getargspec, iscode, isfunction, getargs
 from zlib import crc32
 import pygments
+import pygments.lexers
+import pygments.formatters.html
 
 try:
     import weasyprint as wprnt
     from PyPDF2 import PdfFileMerger, PdfFileReader
 except (ImportError, OSError):
-    wprint = None
+    wprnt = None
     PdfFileMerger = None
     PdfFileReader = None
 
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 
 from . import exceptions as excp
 from .result import Result
+from .data import load_data
+from .report import REPORT_CSS, write_asset, bundle_report
+from .stages import Stage, Artifact, StageCache, method_hash, files_hash
+from .scaling import time_limited, fit_exponent
+from .lineprof import LineProfiler, heat_map
+from .schema import compile_template
+from .sandbox import run_in_child, start_in_child
+from .similarity import figure_hash, code_text, shingles, MinHasher, MIN_SHINGLES
 from .funcs import (
     open_figures,
+    thin_figure,
     isiterable,
     touch,
-    read_user_data,
+    file_lock,
+    place_file,
     raiseExit,
     parse_code,
     is_mod_function,
@@ -51,6 +70,8 @@ from .funcs import (
     compare_dicts,
 )
 
+log = logging.getLogger(__name__)
+
 number_pat = re.compile(r"(?P<number>[\+\-]?[0-9]+(\.[0-9]+)?([Ee][\+\-]?[0-9]+)?)")
 
 
@@ -78,6 +99,20 @@ builtins.input = no_input
 number = re.compile(r"[^\d]*(?P<number>[\+\-]?\d+(\.\d*)?([Ee][\+\-]?\d+)?).*")
 
 
+COMPARE_METHODS = (
+    "compare",
+    "compare_dict",
+    "compare_one_val",
+    "three_way",
+    "normalise_entry",
+    "normalise_one_val",
+    "normalise_scalar",
+    "sanitize_student_answers",
+    "compare_planned",
+    "_check_dict_entry",
+)
+
+
 class Assessor(object):
 
     """A Base class for assessing Computing 2 coursework."""
@@ -86,7 +121,146 @@ class Assessor(object):
     stdfile_match = None
     stdfile_dir = "."
     student_files = "."
+    data_cache = None  # Directory for the parsed data cache - defaults to .data_cache in the cohort directory
+    report_assets = "inline"  # or "shared" to use one report.css per cohort, class based highlighting and figure files
+    report_bundle = None  # or "gzip"/"zip" to compress each report after it is written
+    figure_backend = "Agg"  # Render figures off screen - None to leave the backend alone and show each figure
+    max_figures = 20  # Most figures to render from each run of the code
+    max_figure_points = 10000  # Lines and scatter plots with more points than this are thinned before rendering
+    output_limit = 100000  # Characters of output kept from importing, running and linting the code
+    timing_lane = False  # Time the student and model runs one at a time across all the workers in the cohort
+    sandbox = False  # Run the student's ProcessData in a forked child process, limited by the two settings below
+    sandbox_cpu_limit = 120.0  # Seconds of CPU time allowed for each sandboxed run
+    sandbox_memory_limit = 4 * 1024**3  # Bytes of memory allowed for each sandboxed run
     colors = ["LimeGreen", "Orchid", "OrangeRed", "Orange", "Orange", "Orange", "Orange"]
+    stage_cache = True  # Cache each marking stage in the student's .stages folder and only re-run what has changed
+    stage_version = 3  # Change to invalidate every cached stage
+    replay = False  # Re-use the recorded stages and only re-run the replay_stages - see replay_cohort
+    replay_stages = ("compare", "compare_std", "robustness")
+    scaling_factors = None  # e.g. (1, 10, 100) to time the code on copies of the standard data that many times larger
+    scaling_cpu_limit = 60.0  # Seconds of CPU time allowed for each scaled run
+    scaling_memory_limit = 2 * 1024**3  # Bytes of memory allowed for each scaled run
+    line_profile = False  # Profile the student code line by line on the standard data and shade the listing by time
+    scaling_tolerance = 0.5  # Flag student code whose scaling exponent exceeds the model solution's by more than this
+    variants = None  # e.g. ("shuffled", "crlf") to also run the code on these variants of the standard data
+    variant_workers = None  # Most variant runs at once - defaults to the number of cores
+    figure_hash_runs = ("import", "student")  # Runs whose figures are hashed to find copied figures - see similarity
+    # Stages started in forked child processes as soon as the student's files are found - see start_background
+    background_stages = ("model", "model_figures", "model_std", "model_std_figures", "lint", "highlight")
+
+    # The marking stages - see stages.Stage. Subclasses that add settings or methods used by a stage should add them here.
+    stages = {
+        "info": Stage(
+            (), ("get_info", "stage_info"), (), ("name", "issid", "code", "data", "files", "mods", "fixes", "pdfs"), False
+        ),
+        "calc_answers": Stage(("info",), ("get_calc_answers", "stage_calc_answers"), (), ("calc_answers",), True),
+        "import": Stage(
+            ("info",), ("do_import", "inspect", "stage_import"), ("output_limit", "max_figures"), ("antipatterns",), "html"
+        ),
+        "student": Stage(
+            ("info", "import"),
+            ("run_code", "_run_stage", "_run_sandboxed", "_new_globals", "_report_new_globals", "stage_student"),
+            ("output_limit", "max_figures", "timing_lane", "sandbox", "sandbox_cpu_limit", "sandbox_memory_limit"),
+            ("student_time", "host"),
+            True,
+        ),
+        "model": Stage(
+            ("info",),
+            ("run_model", "run_code", "_run_stage", "stage_model"),
+            ("output_limit", "max_figures", "timing_lane"),
+            ("model_time", "host"),
+            True,
+        ),
+        "compare": Stage(
+            ("student", "model", "calc_answers"),
+            COMPARE_METHODS + ("stage_compare",),
+            ("template", "colors"),
+            ("ratio",),
+            True,
+        ),
+        "student_std": Stage(
+            ("info", "import"),
+            ("run_code", "_run_stage", "_run_sandboxed", "_new_globals", "_report_new_globals", "stage_student_std"),
+            ("output_limit", "max_figures", "timing_lane", "sandbox", "sandbox_cpu_limit", "sandbox_memory_limit"),
+            ("student_time", "host"),
+            True,
+        ),
+        "model_std": Stage(
+            ("info",),
+            ("run_model", "run_code", "_run_stage", "stage_model_std"),
+            ("output_limit", "max_figures", "timing_lane"),
+            ("model_time", "host"),
+            True,
+        ),
+        "compare_std": Stage(
+            ("student", "student_std", "model_std", "calc_answers"),
+            COMPARE_METHODS + ("stage_compare_std",),
+            ("template", "colors"),
+            ("ratio",),
+            True,
+        ),
+        "structure": Stage(
+            ("info", "import"),
+            ("get_func_details", "stage_structure"),
+            (),
+            ("func_listing", "text_signature"),
+            True,
+        ),
+        "scaling": Stage(
+            ("info", "import"),
+            ("_split_data_file", "get_scaled_data", "place_scaled_data", "stage_scaling"),
+            ("scaling_factors", "scaling_cpu_limit", "scaling_memory_limit", "scaling_tolerance", "timing_lane"),
+            ("scaling_exponent",),
+            True,
+        ),
+        "variants": Stage(
+            ("info", "import"),
+            ("_split_data_file", "get_variant_data", "place_variant_data", "_variant_model", "stage_variants"),
+            ("variants", "variant_workers", "output_limit", "sandbox_cpu_limit", "sandbox_memory_limit"),
+            (),
+            True,
+        ),
+        "robustness": Stage(
+            ("variants", "student"), COMPARE_METHODS + ("stage_robustness",), ("template", "colors"), (), True
+        ),
+        "lint": Stage(("info",), ("lint_code", "stage_lint"), ("output_limit",), (), True),
+        "profile": Stage(("info", "import"), ("stage_profile",), ("line_profile", "output_limit"), (), True),
+        "highlight": Stage(("info",), ("highlight_code", "stage_highlight"), ("report_assets",), (), True),
+        "listing": Stage(
+            ("info", "profile", "highlight"), ("highlight_code", "stage_listing"), ("report_assets",), (), True
+        ),
+    }
+    # The figures left open by the import and each run - pattern, title, heading and whether to warn if there are none
+    figure_patterns = {
+        "import": ("Import_figures-{}.png", "", "<h3>Figures Incorrectly generated during import{}</h3>", False),
+        "student": ("Students_Data_Figure-{}.png", "Student Code", "<h3>Figures from {}</h3>", True),
+        "model": ("Students_Data_Reference_Figure-{}.png", "Model Solution", "<h3>Figures from {}</h3>", True),
+        "student_std": ("Standard_Data_Figure-{}.png", "Student Code", "<h3>Figures from {}</h3>", True),
+        "model_std": ("Standard_Data_Reference_Figure-{}.png", "Model Solution", "<h3>Figures from {}</h3>", True),
+    }
+    for _run in figure_patterns:
+        stages[f"{_run}_figures"] = Stage((_run,), ("render_figures",), ("max_figure_points", "figure_backend"), (), True)
+    del _run
+    # The order the stages appear in the report
+    report_stages = [
+        "import",
+        "import_figures",
+        "student",
+        "student_figures",
+        "model",
+        "model_figures",
+        "compare",
+        "student_std",
+        "student_std_figures",
+        "model_std",
+        "model_std_figures",
+        "compare_std",
+        "robustness",
+        "scaling",
+        "structure",
+        "lint",
+        "listing",
+    ]
 
     def __init__(self, subdir, dbconn=None):
         if path.isdir(subdir) and path.exists(path.join(subdir, "readme.txt")):
@@ -104,13 +278,19 @@ class Assessor(object):
         self.files = []
         self.metadata = {}
         self.temp_close = plt.close
+        self.figure_time = 0.0
+        self.output_dropped = 0
+        self.host = None  # Host name and calibration time (see workers.calibrate) for the timings
+        self.scaling_exponent = None
+        self.antipatterns = {}  # Performance anti-pattern name to the lines it was found at - see funcs.Inspector
+        self.text_signature = None  # MinHash signature of the docstrings and comments - see similarity
         (self.conn, self.cur) = dbconn
         self._exception = []
 
     def __getstate__(self):
         """Remove the sqlite3 connection information for pickling."""
         state = self.__dict__.copy()
-        for k in ["conn", "cur", "module", "run_student"]:
+        for k in ["conn", "cur", "module", "run_student", "_artifacts", "_ran", "_keys", "_background", "_collected"]:
             state.pop(k, None)
         return state
 
@@ -125,11 +305,17 @@ class Assessor(object):
     ###################################################################################
 
     def run_model(self, filename):
-        """Must be implemented in the specific sub class !"""
+        """Must be implemented in the specific sub class !
+
+        Implementations should use :py:meth:`load_data` to read filename rather than parsing the file themselves.
+        """
         raise NotImplementedError("This method should be defined in a sub-class")
 
     def get_calc_answers(self, filenameet):
-        """Must be implemented in the specific sub class !"""
+        """Must be implemented in the specific sub class !
+
+        Implementations should use :py:meth:`load_data` to read the header of the file.
+        """
         raise NotImplementedError("This method should be defined in a sub-class")
 
     def get_std_data(self):
@@ -142,17 +328,75 @@ class Assessor(object):
         """
         raise NotImplementedError("This method should be defined in a sub-class")
 
-    def normalise_entry(self, entry):
-        """Do whatever is needed to get this entry into a set of well formatted Results."""
-        if isinstance(entry, dict):
-            for k in entry:
-                if k.endswith("_error"):
-                    continue
-                template = self.template.get(k, None)
-                entry[k] = self.normalise_one_val(entry, k, template)
-            entry = {k: entry[k] for k in entry if not k.endswith("_error")}  # filter out error keys
+    def get_scaled_data(self, std_file, scaled_file, factor):
+        """Write a version of the standard data file std_file with factor times as many rows to scaled_file.
+
+        This default just repeats the rows of the standard data. Override it to generate a genuinely larger data set
+        if repeated rows would upset the analysis (e.g. code that needs distinct x values).
+        """
+        header, body = self._split_data_file(std_file)
+        with open(scaled_file, "w") as data:
+            data.writelines(header + body * factor)
+
+    def get_variant_data(self, std_file, variant_file, variant):
+        """Write the variant named variant (one of :py:attr:`variants`) of the standard data std_file to variant_file.
+
+        This default knows two variants whose answers are the same as the standard data's - *shuffled*, with the rows
+        of data in a random order, and *crlf*, with Windows line endings. Override it to add variants for the year's
+        problem - e.g. noisier data, the columns in a different order or different values in the header - and call
+        this for the rest. :py:meth:`get_calc_answers` must give the right answers for each variant file.
+        """
+        header, body = self._split_data_file(std_file)
+        if variant == "shuffled":
+            order = np.random.default_rng(crc32(path.basename(std_file).encode())).permutation(len(body))
+            body = [body[ix] for ix in order]
+        elif variant == "crlf":
+            header, body = [[line.rstrip("\r\n") + "\r\n" for line in lines] for lines in (header, body)]
         else:
+            raise NotImplementedError(f"No way to make the {variant} variant of the standard data")
+        with open(variant_file, "w", newline="") as data:
+            data.writelines(header + body)
+
+    def normalise_entry(self, entry):
+        """Do whatever is needed to get this entry into a set of well formatted Results.
+
+        The entry is normalised in one pass along the compiled template (see :py:mod:`schema`). Anything that the
+        template doesn't describe, or that doesn't have the shape it describes, is normalised recursively by
+        :py:meth:`normalise_one_val`.
+        """
+        if not isinstance(entry, dict):
             raise TypeError("Trying to normalise a top level that is not a dictionary.")
+        plan = compile_template(getattr(self, "template", None))
+        containers = {(): entry}  # The dicts and lists in entry that have the shape the template describes
+        nodes = plan.nodes
+        ix = 0
+        while ix < len(nodes):
+            node = nodes[ix]
+            ix += 1
+            parent = containers.get(node.parent)
+            key = node.key
+            if parent is None or (key not in parent if isinstance(parent, dict) else key >= len(parent)):
+                ix += node.size - 1
+                continue
+            value = parent[key]
+            if node.kind == "dict" and isinstance(value, dict):
+                containers[node.path] = value
+            elif node.kind == "list" and isinstance(value, list) and len(value) == len(node.template):
+                containers[node.path] = value
+            elif node.kind == "value" and not isinstance(value, (dict, list, np.ndarray)):
+                parent[key] = self.normalise_scalar(value, parent, node.error_key)
+            else:
+                parent[key] = self.normalise_one_val(parent, key, node.template)
+                ix += node.size - 1
+        for keys, container in containers.items():
+            if not isinstance(container, dict):
+                continue
+            expected = plan.children[keys]
+            for key in list(container):
+                if key not in expected and not (isinstance(key, str) and key.endswith("_error")):
+                    container[key] = self.normalise_one_val(container, key, None)
+            for key in [key for key in container if isinstance(key, str) and key.endswith("_error")]:
+                del container[key]  # filter out error keys
         return entry
 
     ####################################################################################
@@ -168,7 +412,7 @@ class Assessor(object):
             os.chdir(os.path.dirname(self.code))
         filename = os.path.basename(self.code)
 
-        with CaptureOutput():
+        with CaptureOutput(limit=self.output_limit):
             results = pylintRun([filename], do_exit=False)
         print(f"<H2>Code quality Analysis {filename}</H2>")
         print(
@@ -189,7 +433,7 @@ class Assessor(object):
         )
         print(f"<li>Percentage of duplicated lines: {round(stats.percent_duplicated_lines,1)}</li>")
         print(f"<li>Running mccabe analysis tool:")
-        with CaptureOutput() as out:
+        with CaptureOutput(limit=self.output_limit) as out:
             complexity = mccabe.get_code_complexity(Path(filename).read_text(), threshold=10, filename=filename)
         out = str(out).replace("\n", "<br/>\n")
         print(f"<ol>{out}</ol><br/>Overall score {complexity}</li>")
@@ -214,12 +458,15 @@ class Assessor(object):
         """Should be implemented if necessary in sepcoifc subclass!"""
         return student_ans
 
-    def stylesheets(self):
-        "Return some style sheets or other header information."
-        ret = """<style>
+    def report_css(self):
+        """Return the css rules for the report - including the code highlighting rules when using shared assets."""
+        ret = """
             .red {color: red; }
             .orange {color: orange; }
             .green {color: green; }
+            table.heatmap {border-collapse: collapse; }
+            table.heatmap td {padding: 0 5px; text-align: right; }
+            table.heatmap td.code {white-space: pre; font-family: monospace; text-align: left; }
             body {width: 1280px;}
             @media print {
                 body {
@@ -242,7 +489,18 @@ class Assessor(object):
               size: A4 landscape; /* Change from the default size of A4 */
               margin: 2cm; /* Set margin on each page */
             }
-            </style>
+            """
+        if self.report_assets == "shared":
+            ret += pygments.formatters.html.HtmlFormatter(style="xcode").get_style_defs(".highlight")
+        return ret
+
+    def stylesheets(self):
+        "Return some style sheets or other header information."
+        if self.report_assets == "shared":
+            ret = f"""<link rel="stylesheet" href="../{REPORT_CSS}">"""
+        else:
+            ret = f"""<style>{self.report_css()}</style>"""
+        ret += """
             <link rel="stylesheet" href="https://code.jquery.com/ui/1.13.1/themes/base/jquery-ui.css">
             <link rel="stylesheet" href="https://fonts.googleapis.com/css?family=Lato">
             """
@@ -257,8 +515,14 @@ class Assessor(object):
                 fix_data = "<br/>\n".join(fixes.readlines())
             print(f"{fix_data}</p>")
 
+    def write_report_assets(self):
+        """Write the shared stylesheet into the cohort directory if it isn't already there and up to date."""
+        write_asset(path.join(path.dirname(self.subdir), REPORT_CSS), self.report_css())
+
     def report_header(self):
         """Print the header of the student code report."""
+        if self.report_assets == "shared":
+            self.write_report_assets()
         print(
             f"""
         <html>
@@ -314,6 +578,25 @@ class Assessor(object):
     ############## Core functionality ##################################################
     ####################################################################################
 
+    def load_data(self, filename):
+        """Return the header dictionary and data array for filename, parsing each distinct data file only once.
+
+        Args:
+            filename (str):
+                Data file - relative paths are taken relative to the student's folder.
+
+        Returns:
+            (ParsedData):
+                namedtuple of header, columns and data. The data array is read-only and shared, copy it before
+                changing it. It is None if the file's data isn't a regular table of numbers - the header is still read.
+        """
+        if not path.isabs(filename):
+            filename = path.join(self.subdir, filename)
+        cache = self.data_cache
+        if cache is None:
+            cache = path.join(path.dirname(self.subdir), ".data_cache")
+        return load_data(filename, cache)
+
     def normalise_one_val(self, entries, k, template=None):
         """Recurses through structures trying to turn floats into Results."""
         entry = entries[k]
@@ -338,12 +621,19 @@ class Assessor(object):
             for ix, e in enumerate(entry):
                 entry[ix] = self.normalise_one_val(entry, ix, template[ix])
             entries[k] = entry
-        elif isinstance(entry, (int, float)):
-            if isinstance(k, str) and "{}_error".format(k) in entries:
-                error = entries["{}_error".format(k)]
+        elif isinstance(entry, (int, float, str)):
+            entries[k] = self.normalise_scalar(entry, entries, "{}_error".format(k) if isinstance(k, str) else None)
+
+        return entries[k]
+
+    def normalise_scalar(self, entry, entries, error_key):
+        """Turn a single number (or string holding one) into a Result, with its error from entries[error_key]."""
+        if isinstance(entry, (int, float)):
+            if error_key is not None and error_key in entries:
+                error = entries[error_key]
             else:
                 error = 0.0
-            entries[k] = Result(entry, error)
+            return Result(entry, error)
         elif isinstance(entry, str):
             try:
                 res = number.match(entry)
@@ -352,8 +642,8 @@ class Assessor(object):
             except (AttributeError, ValueError, KeyError) as err:
                 pass
             else:
-                if isinstance(k, str) and "{}_error".format(k) in entries:
-                    error = entries["{}_error".format(k)]
+                if error_key is not None and error_key in entries:
+                    error = entries[error_key]
                     if isinstance(error, str):
                         try:
                             res = number.match(error)
@@ -367,21 +657,75 @@ class Assessor(object):
                 if error is not None and error < 0.0:
                     error = abs(error)
                 try:
-                    entries[k] = Result(entry, error)
+                    return Result(entry, error)
                 except (TypeError, ValueError):
-                    entries[k] = entry
+                    return entry
+        return entry
 
-        return entries[k]
+    def place_std_data(self, std_filename):
+        """Put the standard data file std_filename into the student's folder as a read-only link or copy.
 
-    def run_code(self, codeobj, filename):
-        """Run some code and time the results."""
+        The standard file is generated with get_std_data if it doesn't already exist - whilst holding a lock so that
+        parallel workers don't try to write it at the same time.
+        """
+        src = path.join(self.stdfile_dir, std_filename)
+        if not path.exists(src):
+            with file_lock(src + ".lock"):
+                if not path.exists(src):
+                    self.get_std_data()
+        place_file(src, self.std_data)
+
+    def _split_data_file(self, filename):
+        """Return the lines of the data file filename split into the header (and any column names) and the data."""
+        with open(filename, "r", errors="ignore") as data:
+            lines = data.readlines()
+        split = next((ix + 1 for ix, line in enumerate(lines) if "&END" in line), 0)
+        header, body = lines[:split], [line for line in lines[split:] if line.strip() != ""]
+        try:
+            [float(v) for v in body[0].replace(",", " ").split()] if len(body) else None
+        except ValueError:  # Keep a row of column names at the top
+            header, body = header + body[:1], body[1:]
+        if len(body) and not body[-1].endswith("\n"):
+            body[-1] += "\n"
+        return header, body
+
+    def place_scaled_data(self, std_filename, factor):
+        """Return the name of the standard data file std_filename scaled up by factor, generating it if needed."""
+        if factor == 1:
+            return path.join(self.subdir, std_filename)
+        scaled = path.join(self.stdfile_dir, f"scaled_{factor}x_{std_filename}")
+        if not path.exists(scaled):
+            with file_lock(scaled + ".lock"):
+                if not path.exists(scaled):
+                    self.get_scaled_data(path.join(self.subdir, std_filename), scaled, factor)
+        return scaled
+
+    def place_variant_data(self, std_filename, variant):
+        """Return the name of the variant of the standard data file std_filename, generating it if needed."""
+        filename = path.join(self.stdfile_dir, f"variant_{variant}_{std_filename}")
+        if not path.exists(filename):
+            with file_lock(filename + ".lock"):
+                if not path.exists(filename):
+                    self.get_variant_data(path.join(self.subdir, std_filename), filename, variant)
+        return filename
+
+    def run_code(self, codeobj, filename, sanitize=True):
+        """Run some code and time the results.
+
+        If sanitize is False the raw return value of the code is returned rather than passing it through
+        sanitize_student_answers.
+        """
         plt.style.use("default")
         try:
-            t1 = perf_counter()
-            ret = codeobj(filename)
-            t2 = perf_counter()
+            try:
+                with CaptureOutput(limit=self.output_limit) as output, self.timing():
+                    t1 = perf_counter()
+                    ret = codeobj(filename)
+                    t2 = perf_counter()
+            finally:
+                self.report_output(output)
             dt = t2 - t1
-            results = self.sanitize_student_answers(ret)
+            results = self.sanitize_student_answers(ret) if sanitize else ret
         except Exception as err1:
             print("<H3>Code threw an Error!</H3>")
             try:
@@ -396,29 +740,134 @@ class Assessor(object):
             raise excp.StudentCodeError("Student code threw and error !")
         return results, dt
 
-    def save_figs(self, pattern, title, prefix="<h3>Figures from {}</h3>"):
-        """Save all the open figures into files."""
+    def timing(self):
+        """Return a context manager to hold while a run of the code is timed.
+
+        With timing_lane set this is a lock shared by every worker marking the cohort, so only one run is timed at once.
+        Otherwise, while any stages are running in the background, it is a lock for the student's folder so that the
+        student's and model runs are not timed at the same time.
+        """
+        if self.timing_lane:
+            return file_lock(path.join(path.dirname(self.subdir), ".timing_lane.lock"))
+        if getattr(self, "_timing_lock", None) is not None:
+            return file_lock(self._timing_lock)
+        return nullcontext()
+
+    def report_output(self, output):
+        """Print the output captured from the student code, noting if any of it had to be dropped.
+
+        output is a CaptureOutput, or the text, characters written and characters dropped from a sandboxed run.
+        """
+        if isinstance(output, tuple):
+            text, written, dropped = output
+        else:
+            text, written, dropped = str(output), getattr(output.buffer, "written", 0), getattr(output.buffer, "dropped", 0)
+        if text:
+            print("<p>" + text.replace("\n", "<br/>\n") + "</p>")
+        if dropped:
+            self.output_dropped += dropped
+            print(
+                f"<p><b>Output truncated:</b> the code printed {written} characters - only the first and "
+                + f"last {self.output_limit // 2} are shown ({dropped} dropped).</p>"
+            )
+
+    def capture_figures(self):
+        """Take the figures left open by some code and close them.
+
+        Up to max_figures figures are kept, pickled so that they can be cached and rendered later.
+
+        Returns:
+            (dict):
+                The total number of figures that were open and the figures kept.
+        """
+        figures = open_figures()
+        kept = []
+        for fig in figures[: self.max_figures]:
+            try:
+                kept.append(pickle.dumps(fig))
+            except Exception:  # Render it directly, but it won't be cached
+                kept.append(fig)
+        self.temp_close("all")
+        return {"total": len(figures), "figures": kept}
+
+    def render_figures(self, captured, pattern):
+        """Render captured figures (see :py:meth:`capture_figures`) to png images, thinning large plots first.
+
+        Returns:
+            (dict):
+                The file names and png data of the figures along with notes on what was left out and the time taken.
+        """
+        start = perf_counter()
+        rendered = {"total": captured["total"], "pngs": [], "errors": [], "thinned": 0, "dropped": 0}
+        for i, fig in enumerate(captured["figures"]):
+            try:
+                if isinstance(fig, bytes):
+                    fig = pickle.loads(fig)
+                if self.figure_backend is None:
+                    fig.show()
+                else:
+                    artists, points = thin_figure(fig, self.max_figure_points)
+                    rendered["thinned"] += artists
+                    rendered["dropped"] += points
+                buffer = io.BytesIO()
+                fig.savefig(buffer, format="png")
+                rendered["pngs"].append((pattern.format(i), buffer.getvalue()))
+            except Exception as err:
+                rendered["errors"].append(str(err))
+        self.temp_close("all")
+        rendered["elapsed"] = perf_counter() - start
+        self.figure_time += rendered["elapsed"]
+        return rendered
+
+    def figure_html(self, rendered, patterns):
+        """Print the table of rendered figures, writing the figure files when using shared report assets.
+
+        Args:
+            rendered (dict):
+                The figures from :py:meth:`render_figures`.
+            patterns (tuple):
+                An entry from figure_patterns - the file name pattern, title, heading and whether to warn if there
+                are no figures.
+        """
+        _, title, prefix, required = patterns
+        if not required and rendered["total"] == 0:
+            return
         out = []
         out.append(prefix.format(title))
         out.append("<table><tr>")
-        try:
-            for i, fig in enumerate(open_figures()):  # Close and open figures from the import
-                fig.show()
-                buffer = io.BytesIO()
-                fig.savefig(buffer, format="png")
-                buffer.seek(0)
-                data = base64.encodebytes(buffer.getvalue()).decode("ascii").strip()
-                out.append(f"<td><img class='figure' src='data:image/png;base64,{data}' width=200px></td>")
-            self.temp_close("all")
-        except Exception as err:
+        for name, png in rendered["pngs"]:
+            if self.report_assets == "shared":  # Save as a file next to the report
+                os.makedirs(path.join(self.subdir, "figures"), exist_ok=True)
+                with open(path.join(self.subdir, "figures", name), "wb") as figure:
+                    figure.write(png)
+                out.append(f"<td><img class='figure' src='figures/{name}' width=200px></td>")
+                continue
+            data = base64.encodebytes(png).decode("ascii").strip()
+            out.append(f"<td><img class='figure' src='data:image/png;base64,{data}' width=200px></td>")
+        for err in rendered["errors"]:
             out.append(f"An error occured trying to save the figures!\n{err}")
         out.append("</tr></table>")
+        if rendered["total"] > self.max_figures:
+            out.append(
+                f"<p>{rendered['total']} figures were left open - only the first {self.max_figures} are shown.</p>"
+            )
+        if rendered["thinned"]:
+            out.append(
+                f"<p>{rendered['thinned']} plotted lines or sets of points had more than {self.max_figure_points} "
+                + f"points and were thinned before plotting ({rendered['dropped']} points not drawn).</p>"
+            )
+        if len(out) > 3:
+            out.append(f"<p>Figures took {rendered['elapsed']:.2f}s to render.</p>")
         if len(out) == 3:  # No figures !
             print("<h3>No Figures left open after {} code ran</h3>".format(title))
             print("<h2>Manual Checking of code required to see if figures were saved by code.</h2>")
         else:
             print("\n".join(out))
 
+    def save_figs(self, pattern, title, prefix="<h3>Figures from {}</h3>"):
+        """Save all the open figures into the report."""
+        self.figure_html(self.render_figures(self.capture_figures(), pattern), (pattern, title, prefix, True))
+
     def three_way(self, s, m, c):
         """Does a three way comparison between student, model and calculated answer and makes a judgement."""
         if isinstance(m, str):
@@ -599,28 +1048,86 @@ class Assessor(object):
 
         sc = []
         for k in keys:
-            if k not in student:  # Completely missing key
-                print("<tr><td>{}</td><td colsp[an=4>No Student Answer</td></tr>".format(k))
+            if not self._check_dict_entry(student, model_ans, calc_ans, k):
                 continue
-            elif student[k] is None:
-                print("<tr><td>{}</td><td colsp[an=4>Student Answered None</td></tr>".format(k))
-                continue
-            if isinstance(calc_ans[k], list):
-                if not isinstance(model_ans[k], list):
-                    print(
-                        "<tr><td>{}</td><td colsp[an=4>Model answer not a list - refernce code failure</td></tr>".format(
-                            k
-                        )
-                    )
-                    continue
-                if not isinstance(student[k], (list, tuple)):
-                    print(
-                        "<tr><td>{}</td><td colsp[an=4>Student answer was noty a list<br/>\n{}</td></tr>".format(
-                            k, student[k]
-                        )
+            sc.append(self.compare_one_val(student.get(k, None), model_ans.get(k, None), calc_ans.get(k, None), k))
+        score = np.all(sc)
+        return score
+
+    def _check_dict_entry(self, student, model_ans, calc_ans, k):
+        """Check that there is a student answer for key k of a dictionary that can be compared - report it if not."""
+        if k not in student:  # Completely missing key
+            print("<tr><td>{}</td><td colsp[an=4>No Student Answer</td></tr>".format(k))
+            return False
+        elif student[k] is None:
+            print("<tr><td>{}</td><td colsp[an=4>Student Answered None</td></tr>".format(k))
+            return False
+        if isinstance(calc_ans[k], list):
+            if not isinstance(model_ans[k], list):
+                print(
+                    "<tr><td>{}</td><td colsp[an=4>Model answer not a list - refernce code failure</td></tr>".format(k)
+                )
+                return False
+            if not isinstance(student[k], (list, tuple)):
+                print(
+                    "<tr><td>{}</td><td colsp[an=4>Student answer was noty a list<br/>\n{}</td></tr>".format(
+                        k, student[k]
                     )
+                )
+                return False
+        return True
+
+    def compare_planned(self, student, model_ans, calc_ans):
+        """Compare dictionaries of student and model answers in one pass along the compiled template.
+
+        The same table rows are printed as by :py:meth:`compare_dict`. Any answer that doesn't have the shape the
+        template describes is compared recursively by :py:meth:`compare_one_val` (or the whole lot by
+        :py:meth:`compare_dict` if the calculated answers don't follow the template).
+        """
+        plan = compile_template(getattr(self, "template", None))
+        if not isinstance(student, dict) or list(calc_ans.keys()) != plan.children[()]:
+            return self.compare_dict(student, model_ans, calc_ans)
+        matched = {(): (student, model_ans, calc_ans, None, "dict")}  # Nested answers that follow the template
+        sc = []
+        nodes = plan.nodes
+        ix = 0
+        while ix < len(nodes):
+            node = nodes[ix]
+            ix += 1
+            parent = matched.get(node.parent)
+            key = node.key
+            if parent is None:  # Already compared as part of its parent
+                ix += node.size - 1
+                continue
+            ps, pm, pc, plabel, pkind = parent
+            if pkind == "dict":
+                if not self._check_dict_entry(ps, pm, pc, key):
+                    ix += node.size - 1
                     continue
-            sc.append(self.compare_one_val(student.get(k, None), model_ans.get(k, None), calc_ans.get(k, None), k))
+                s, m, c, label = ps.get(key, None), pm.get(key, None), pc.get(key, None), key
+            else:
+                s, m, c, label = ps[key], pm[key], pc[key], "{}[{}]".format(plabel, key)
+            if (
+                node.kind == "dict"
+                and isinstance(m, dict)
+                and isinstance(s, dict)
+                and isinstance(c, dict)
+                and list(c.keys()) == plan.children[node.path]
+            ):
+                print("<tr><td colpan=5>{}</td></tr>".format("Comapring sub-dictionary for {}".format(label)))
+                matched[node.path] = (s, m, c, label, "dict")
+            elif (
+                node.kind == "list"
+                and isinstance(m, list)
+                and isinstance(s, (list, np.ndarray))
+                and isinstance(c, list)
+                and len(s) == len(m) == len(c) == len(node.template)
+            ):
+                print("<tr><td colpan =5>Answer is a list for {}</td></tr>".format(label))
+                matched[node.path] = (s, m, c, label, "list")
+            else:
+                sc.append(self.compare_one_val(s, m, c, label))
+                ix += node.size - 1
         score = np.all(sc)
         return score
 
@@ -632,7 +1139,7 @@ class Assessor(object):
         print(
             "<table><tr><th>Parameter</th><th>Student Answer</th><th>Model Answer</th><th>Actual Answer</th><th>Comment</th></tr>"
         )
-        score = self.compare_dict(student, model_ans, calc_ans)
+        score = self.compare_planned(student, model_ans, calc_ans)
         print("</table>")
         return score
 
@@ -643,15 +1150,25 @@ class Assessor(object):
             self.lint_code()
         except Exception as err:
             print(f"<p>Failed to check code complexity {err}.</p>")
+        self.highlight_code()
+
+    def highlight_code(self, profile=None):
+        """Print the code with syntax highlighting - as a heat map if given a line profile (see lineprof.heat_map)."""
         try:
             lexer = pygments.lexers.get_lexer_by_name("Python")
-            formatter = pygments.formatters.html.HtmlFormatter(noclasses=True, linenos=True, style="xcode")
+            formatter = pygments.formatters.html.HtmlFormatter(
+                noclasses=self.report_assets != "shared", linenos=True, style="xcode"
+            )
 
             if Path(self.code).exists():
                 code = Path(self.code).read_text()
             else:
                 code = Path(Path(self.code).name).read_text()
-            print(pygments.highlight(code, lexer, formatter))
+            if profile:
+                print("<h3>Line profile of the student code on the standard data</h3>")
+                print(heat_map(code, profile, noclasses=self.report_assets != "shared", style="xcode"))
+            else:
+                print(pygments.highlight(code, lexer, formatter))
         except Exception as err:
             print(f"<p>Couldn't even show the code !: {err}</p>")
 
@@ -715,118 +1232,41 @@ class Assessor(object):
             raise excp.NoDataError("<h2>Error ! Could not locate code</h2><h2>Manual Checking Required</h2>")
 
     def test(self):
+        """Mark the student, writing the report to results.html.
+
+        The marking is done in the stages listed in report_stages (see :py:attr:`stages`). The artifacts of each stage
+        are cached in the student's .stages folder, so when a student is marked again only the stages whose inputs
+        have changed are re-run.
+        """
         restore = (sys.stdout, sys.stderr)
         touch(path.join(self.subdir, "skip"))
-        print("Looking at folder {}".format(self.subdir))
+        log.info(f"Looking at folder {self.subdir}", extra={"student": path.basename(self.subdir)})
+        shutil.rmtree(path.join(self.subdir, "figures"), ignore_errors=True)  # Figures from an earlier run
+        if self.figure_backend is not None and matplotlib.get_backend().lower() != self.figure_backend.lower():
+            plt.switch_backend(self.figure_backend)
+        self.figure_time = 0.0
+        self.output_dropped = 0
+        self._artifacts = {}
+        self._ran = set()
+        self._keys = {}
+        self._background = {}
+        self._collected = {}
+        self._timing_lock = None
+        cwd = os.getcwd()
         with open(path.join(self.subdir, "results.html"), "w") as tmp:  # sys.stdout:
             try:
                 sys.stdout = tmp
                 sys.stderr = sys.stdout
-                cwd = os.getcwd()
-                self.get_info()
-                user_settings = read_user_data(self.data)
-                self.metadata = user_settings
-
-                std_filename = self.stdfile_pattern.format(**user_settings)
-                self.std_data = path.join(self.subdir, std_filename)
-                src = path.join(self.stdfile_dir, std_filename)
-                if not path.exists(src):
-                    self.get_std_data()
-                shutil.copyfile(src, self.std_data)
-
-                userfile = path.split(self.data)[-1]
-                stdfile = path.split(self.std_data)[-1]
-                self.calc_answers = self.get_calc_answers(path.join(self.subdir, userfile))  # Get model answers early
+                print(self.stage("info").html, end="")
+                print(self.stage("calc_answers").html, end="")  # Get model answers early
                 # Comence output
                 self.report_header()
                 self.report_fixes()
-                self.report_settings(user_settings)
-
-                print("<h2>Importing the Student Module</h2>")
-                before_import = get_globals()
-                self.do_import()
-                plt.close("all")
-                new_globals = compare_dicts(before_import, get_globals())
-                if new_globals:
-                    print("<h3>New Global Variables added!</h3>")
-                    print(
-                        f"""<p>Importing the code should not introduce new global variables. This implies that some
-                          code has executed and has used global variables. If so, structure is capped at a 2.2.<p>
-                          <pre>{pformat(new_globals,indent=4)}</pre>"""
-                    )
-
-                os.chdir(self.subdir)
-                if self.module is None:
-                    print("<hr/>")
-                    print("<h2>Manual Checking of code required !</h2>")
-                    raise excp.NoCdeError("No student code module located")
-                else:
-                    plt.show = replace_show
-                    plt.close = replace_close
-                    if "sys" in dir(self.module):
-                        print("<p>Patching code to stop sys.exit from exiting test framework!</p>")
-                        msys = getattr(self.module, "sys")
-                        msys.exit = raiseExit
-                    # Change to the subdirectory becayse sine styudebts have hardcoded their data files
-                    calc_answers = self.calc_answers
-                    print("<h4>Running Student code</h4>")
-                    before_import = get_globals()
-
-                    sresults, self.student_time = self.run_code(self.run_student, userfile)
-                    self.save_figs("Students_Data_Figure-{}.png", "Student Code")
-                    print("<h4>Running Model Solution code</h4>")
-                    dresults, self.model_time = self.run_code(self.run_model, userfile)
-                    self.save_figs("Students_Data_Reference_Figure-{}.png", "Model Solution")
-                    self.ratio = 100.0 * self.student_time / self.model_time
-                    print("<h2>Comparison of Results.....</h2>")
-                    print(f"<p>Student solution took {self.ratio:.1f}% the model solution's time.</p>")
-
-                    self.compare(sresults, dresults, calc_answers)
-
-                    print("<h2>Trying Code with Stadard Data Set</h2>")
-
-                    calc_answers = self.get_calc_answers(stdfile)
-
-                    print("<h4>Running Student code</h4>")
-                    try:
-                        run_1_sresult = sresults
-                        sresults, self.student_time = self.run_code(self.run_student, stdfile)
-                    except Exception as err:
-                        raise excp.SecondRunException("Hit error on second run with standard data") from err
-                    with CaptureOutput():
-                        sc = self.compare(run_1_sresult, sresults, calc_answers)
-                    if sc:
-                        print("<h3>Student returned same aswers for reference code - hardcoded File path?</h3>")
-                        print(
-                            """<p>The student's solutions for their data file and the reference data file appear to
-                        give the same answer. Possibly they've hardcoded a path somewhere and are really analysing the same
-                        data twice. If they have -0.5 grades on robustness</p>"""
-                        )
-                    self.save_figs("Standard_Data_Figure-{}.png", "Student Code")
-                    new_globals = compare_dicts(before_import, get_globals())
-                    if new_globals:
-                        print("<h3>New Global Variables added!</h3>")
-                        print(
-                            f"""<p>Running the code should not introduce new global variables. This implies that some
-                              code has executed and has used global variables. If so, structure is capped at a 2.2 if not
-                              already taken off from the import.<p>
-                              <pre>{pformat(new_globals,indent=4)}</pre>"""
-                        )
-
-                    print("<h4>Running Model Solution code</h4>")
-
-                    dresults, self.model_time = self.run_code(self.run_model, stdfile)
-                    self.save_figs("Standard_Data_Reference_Figure-{}.png", "Model Solution")
-
-                    print("<h2>Comparison of Results for Standard Data.....</h2>")
-                    print("<p>Student solution took {0.ratio:.1f}% the model solution's time.</p>".format(self))
-
-                    self.compare(sresults, dresults, calc_answers)
-
-                    print("<h2>Student Code Structure</h2>")
-                    self.get_func_details()
-                    self.save_func_details()
-                    self.show_code()
+                self.report_settings(self.metadata)
+                os.chdir(self.subdir)  # Some students have hardcoded the names of their data files
+                self.start_background()
+                for name in self.report_stages:
+                    self.render_stage(name)
             except excp.NoDataError as err:
                 err_string = str(err).replace("\n", "<br/>\n")
                 print(err_string)
@@ -834,7 +1274,9 @@ class Assessor(object):
                 print("</body></html>")
                 (sys.stdout, sys.stderr) = restore
                 self._exception.append(err_string)
-                print(f"Hit exception {err} for {self.name} ({self.issid})")
+                log.warning(
+                    f"Hit exception {err} for {self.name} ({self.issid})", extra={"student": path.basename(self.subdir)}
+                )
             except excp.StudentCodeError as err:
                 err_string = str(err).replace("\n", "<br/>\n")
                 print(err_string)
@@ -846,7 +1288,9 @@ class Assessor(object):
                 print("</body></html>")
                 plt.close("all")
                 (sys.stdout, sys.stderr) = restore
-                print(f"Hit exception {err} for {self.name} ({self.issid})")
+                log.warning(
+                    f"Hit exception {err} for {self.name} ({self.issid})", extra={"student": path.basename(self.subdir)}
+                )
             except Exception as err:
                 err_string = str(err).replace("\n", "<br/>\n")
                 print(err_string)
@@ -858,17 +1302,619 @@ class Assessor(object):
                 plt.close("all")
                 (sys.stdout, sys.stderr) = restore
                 self.exception = err_string
-                print(f"Hit exception {err} for {self.name} ({self.issid})")
+                log.warning(
+                    f"Hit exception {err} for {self.name} ({self.issid})", extra={"student": path.basename(self.subdir)}
+                )
             else:
+                print("</body></html>")
                 (sys.stdout, sys.stderr) = restore
             finally:
                 plt.close = self.temp_close  # unpatch plt.close
                 plt.close("all")
+                self.stop_background()
 
         os.chdir(cwd)
+        if self.report_bundle is not None:
+            bundle_report(self.subdir, self.report_bundle)
 
         # os.unlink(path.join(subdir,"skip"))
 
+    ####################################################################################
+    ############## Marking stages ######################################################
+    ####################################################################################
+
+    def stage_key(self, name):
+        """Return the hash of everything that goes into stage name."""
+        if name not in self._keys:
+            if name == "info":
+                self.stage("info")
+                files = [path.join(self.subdir, "readme.txt"), self.code, self.data, self.fixes, self.std_data]
+                files += [path.join(self.subdir, mod) for mod in sorted(self.mods)]
+                parts = [files_hash(files)]
+            else:
+                spec = self.stages[name]
+                parts = [self.stage_key(dep) for dep in spec.inputs]
+                parts.append(method_hash(type(self), spec.methods))
+                parts.extend(repr(getattr(self, setting, None)) for setting in spec.settings)
+                parts.append(repr(spec.attrs))
+            parts.extend([name, str(self.stage_version)])
+            self._keys[name] = hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+        return self._keys[name]
+
+    def stage(self, name, data=True):
+        """Return the artifact of stage name, running it (and any stages it needs) unless it is cached.
+
+        Args:
+            name (str):
+                The name of the stage - a key of :py:attr:`stages`, implemented by the method stage_<name> or, for the
+                <run>_figures stages, by :py:meth:`render_figures`.
+
+        Keyword Arguments:
+            data (bool):
+                Whether the stage's data is needed - if not, a stage that caches only its report fragment is not re-run.
+
+        Returns:
+            (Artifact):
+                The stage's report fragment, data and the attributes it set.
+
+        If the stage raises an exception its report fragment is printed before the exception is passed on.
+        """
+        spec = self.stages[name]
+        artifact = self._artifacts.get(name)
+        if artifact is not None and (name in self._ran or not data or spec.cache is True):
+            return artifact
+        if name in getattr(self, "_background", {}):
+            artifact = self._collect_background(name)
+            if artifact is not None:
+                self._restore_stage(artifact)
+                self._ran.add(name)
+                self._artifacts[name] = artifact
+                return artifact
+        cache = StageCache(path.join(self.subdir, ".stages"))
+        if self.replay and name != "info" and name not in self.replay_stages:
+            artifact = cache.get(name)
+            if artifact is None:
+                raise excp.NoRecordingError(f"Nothing recorded for the {name} stage to replay")
+            self._keys[name] = artifact.key
+            self._restore_stage(artifact)
+            self._artifacts[name] = artifact
+            return artifact
+        if self.stage_cache and spec.cache and name not in self._ran and not self.replay:
+            artifact = cache.get(name, self.stage_key(name))
+            if artifact is not None and (spec.cache is True or not data):
+                self._restore_stage(artifact)
+                self._artifacts[name] = artifact
+                return artifact
+        inputs = [self.stage(dep).data for dep in spec.inputs]
+        accumulated = (len(self._exception), self.output_dropped, self.figure_time)
+        output = CaptureOutput()
+        try:
+            with output:
+                if name.endswith("_figures"):
+                    result = self.render_figures(inputs[0]["figures"], self.figure_patterns[name[: -len("_figures")]][0])
+                else:
+                    result = getattr(self, f"stage_{name}")(*inputs)
+        except Exception:
+            print(str(output), end="")
+            raise
+        attrs = {attr: getattr(self, attr) for attr in spec.attrs}
+        attrs["_exception"] = self._exception[accumulated[0] :]
+        attrs["output_dropped"] = self.output_dropped - accumulated[1]
+        attrs["figure_time"] = self.figure_time - accumulated[2]
+        self._ran.add(name)
+        self._artifacts[name] = Artifact(None, str(output), result, attrs)
+        if self.stage_cache and spec.cache:
+            artifact = self._artifacts[name]._replace(key=self.stage_key(name))
+            cache.put(name, artifact if spec.cache is True else artifact._replace(data=None))
+        return self._artifacts[name]
+
+    def _needs(self, name):
+        """Return the set of stages that stage name uses, directly or through other stages."""
+        needs = set()
+        todo = list(self.stages[name].inputs)
+        while todo:
+            dep = todo.pop()
+            if dep not in needs:
+                needs.add(dep)
+                todo.extend(self.stages[dep].inputs)
+        return needs
+
+    def start_background(self):
+        """Start running the background_stages in forked child processes, alongside the import and student runs.
+
+        Only stages that don't need the student's code to be imported - directly or through other stages - and aren't
+        already cached are started. A stage that uses another background stage runs in the same child after it. The
+        artifacts come back when :py:meth:`stage` first asks for each stage; a stage that failed in the child is
+        simply run again, so its error is reported as usual.
+        """
+        self._background = {}
+        self._collected = {}
+        if self.replay or not self.background_stages:
+            return
+        cache = StageCache(path.join(self.subdir, ".stages"))
+        groups = []
+        for name in self.background_stages:
+            if name not in self.stages or name in self._artifacts or "import" in self._needs(name):
+                continue
+            if self.stage_cache and self.stages[name].cache is True and cache.get(name, self.stage_key(name)):
+                continue
+            group = next((group for group in groups if set(group) & self._needs(name)), None)
+            if group is None:
+                groups.append([name])
+            else:
+                group.append(name)
+        if not groups:
+            return
+        self._timing_lock = path.join(self.subdir, ".timing.lock")
+        sys.stdout.flush()
+        for group in groups:
+            child = start_in_child(self._run_background, group)
+            self._background.update((name, child) for name in group)
+
+    def _run_background(self, names):
+        """Run the stages names in a child process and return their artifacts - stopping at the first failure."""
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+        self._background = {}
+        artifacts = {}
+        for name in names:
+            try:
+                artifacts[name] = self.stage(name)
+            except Exception:  # Left for the parent to run again and report
+                break
+        return artifacts
+
+    def _collect_background(self, name):
+        """Return the artifact of the background stage name, waiting for its child if needed, or None if it failed."""
+        child = self._background.pop(name)
+        if child not in self._collected:
+            ok, artifacts = child.result()
+            self._collected[child] = artifacts if ok else {}
+        return self._collected[child].get(name)
+
+    def stop_background(self):
+        """Stop any background children whose stages weren't needed - e.g. because the student's code failed."""
+        for child in set(self._background.values()):
+            if child not in self._collected:
+                child.cancel()
+        self._background = {}
+        self._collected = {}
+        self._timing_lock = None
+
+    def can_replay(self):
+        """Return True if every stage needed to replay the student has been recorded."""
+        needed = ["calc_answers"] + [name for name in self.report_stages if name not in self.replay_stages]
+        return all(path.exists(path.join(self.subdir, ".stages", f"{name}.pkl")) for name in needed)
+
+    def _restore_stage(self, artifact):
+        """Set the attributes recorded in a cached artifact."""
+        for attr, value in artifact.attrs.items():
+            if attr == "_exception":
+                self._exception.extend(value)
+            elif attr in ["output_dropped", "figure_time"]:
+                setattr(self, attr, getattr(self, attr) + value)
+            else:
+                setattr(self, attr, value)
+
+    def render_stage(self, name):
+        """Print the report fragment for stage name."""
+        artifact = self.stage(name, data=False)
+        print(artifact.html, end="")
+        if name.endswith("_figures"):
+            self.figure_html(artifact.data, self.figure_patterns[name[: -len("_figures")]])
+            self.save_figure_hashes(name[: -len("_figures")], artifact.data)
+        elif name == "structure":
+            self.save_func_details()
+            self.save_text_signature()
+        elif name == "import":
+            self.save_antipatterns()
+
+    def stage_info(self):
+        """Find the student's files and place the standard data file."""
+        self.get_info()
+        user_settings = self.load_data(self.data).header
+        if user_settings is None:
+            print("Problems reading the user supplied data.")
+        self.metadata = user_settings
+
+        std_filename = self.stdfile_pattern.format(**user_settings)
+        self.std_data = path.join(self.subdir, std_filename)
+        self.place_std_data(std_filename)
+        return {"user": path.split(self.data)[-1], "std": std_filename}
+
+    def stage_calc_answers(self, info):
+        """Work out the correct answers for the student's data and the standard data."""
+        self.calc_answers = self.get_calc_answers(path.join(self.subdir, info["user"]))
+        return {"user": self.calc_answers, "std": self.get_calc_answers(path.join(self.subdir, info["std"]))}
+
+    def stage_import(self, info):
+        """Import the student's module."""
+        print("<h2>Importing the Student Module</h2>")
+        before_import = get_globals()
+        self.do_import()
+        figures = self.capture_figures()
+        new_globals = compare_dicts(before_import, get_globals())
+        if new_globals:
+            print("<h3>New Global Variables added!</h3>")
+            print(
+                f"""<p>Importing the code should not introduce new global variables. This implies that some
+                  code has executed and has used global variables. If so, structure is capped at a 2.2.<p>
+                  <pre>{pformat(new_globals,indent=4)}</pre>"""
+            )
+        if self.module is None:
+            print("<hr/>")
+            print("<h2>Manual Checking of code required !</h2>")
+            raise excp.NoCpdeError("No student code module located")
+        if "sys" in dir(self.module):
+            print("<p>Patching code to stop sys.exit from exiting test framework!</p>")
+            msys = getattr(self.module, "sys")
+            msys.exit = raiseExit
+        return {"figures": figures}
+
+    def _run_stage(self, codeobj, filename, title):
+        """Run some code on filename and capture the figures it leaves open."""
+        plt.show = replace_show
+        plt.close = replace_close
+        print(f"<h4>Running {title}</h4>")
+        if self.sandbox and codeobj is self.run_student:
+            return self._run_sandboxed(filename)
+        results, elapsed = self.run_code(codeobj, filename, sanitize=False)  # Keep the raw returns for replaying
+        return {"results": results, "time": elapsed, "figures": self.capture_figures()}
+
+    def _run_sandboxed(self, filename):
+        """Run the student's code on filename in a forked child process, limited by the sandbox settings.
+
+        The child sends back the results - with any large arrays passed through shared memory, see :py:mod:`sandbox` -
+        along with the output, figures and any global variables the code added (which this process can't see), so the
+        run reports just as it would have done in this process.
+        """
+
+        def child():
+            before = get_globals()
+            with CaptureOutput(limit=self.output_limit) as output:
+                try:
+                    t1 = perf_counter()
+                    ret = self.run_student(filename)
+                    t2 = perf_counter()
+                    error = None
+                except Exception:
+                    ret, t2, error = {}, perf_counter(), format_exc()
+            figures = self.capture_figures()
+            figures["figures"] = [fig for fig in figures["figures"] if isinstance(fig, bytes)]  # Must be picklable
+            buffer = output.buffer
+            new_globals = compare_dicts(before, get_globals())
+            return {
+                "results": ret,
+                "time": t2 - t1,
+                "error": error,
+                "output": (str(output), buffer.written, buffer.dropped),
+                "figures": figures,
+                "new_globals": pformat(new_globals, indent=4) if new_globals else None,  # The values may not pickle
+            }
+
+        with self.timing():
+            ok, run = run_in_child(child, cpu_limit=self.sandbox_cpu_limit, memory_limit=self.sandbox_memory_limit)
+        if ok:
+            self.report_output(run["output"])
+            error = run["error"]
+        else:
+            error = f"The sandboxed run failed: {run}"
+        if error is not None:
+            print("<H3>Code threw an Error!</H3>")
+            error_string = error.replace("\n", "<br/>\n")
+            print(error_string)
+            self._exception.append(error_string)
+            raise excp.StudentCodeError("Student code threw and error !")
+        return {
+            "results": run["results"],
+            "time": run["time"],
+            "figures": run["figures"],
+            "new_globals": run["new_globals"],
+        }
+
+    def _new_globals(self, before):
+        """Return the global variables the student's code has added since before, formatted, or None."""
+        new_globals = compare_dicts(before, get_globals())
+        return pformat(new_globals, indent=4) if new_globals else None
+
+    def _report_new_globals(self, new_globals):
+        """Report the global variables the student's code added, as returned by :py:meth:`_new_globals`."""
+        if new_globals:
+            print("<h3>New Global Variables added!</h3>")
+            print(
+                f"""<p>Running the code should not introduce new global variables. This implies that some
+                  code has executed and has used global variables. If so, structure is capped at a 2.2 if not
+                  already taken off from the import.<p>
+                  <pre>{new_globals}</pre>"""
+            )
+
+    def stage_student(self, info, _):
+        """Run the student's code on their own data."""
+        before = get_globals()
+        run = self._run_stage(self.run_student, info["user"], "Student code")
+        self.student_time = run["time"]
+        self._report_new_globals(run.pop("new_globals") if "new_globals" in run else self._new_globals(before))
+        return run
+
+    def stage_model(self, info):
+        """Run the model solution on the student's data."""
+        run = self._run_stage(self.run_model, info["user"], "Model Solution code")
+        self.model_time = run["time"]
+        return run
+
+    def stage_student_std(self, info, _):
+        """Run the student's code on the standard data."""
+        print("<h2>Trying Code with Stadard Data Set</h2>")
+        before = get_globals()
+        try:
+            run = self._run_stage(self.run_student, info["std"], "Student code")
+        except Exception as err:
+            raise excp.SecondRunException("Hit error on second run with standard data") from err
+        self.student_time = run["time"]
+        self._report_new_globals(run.pop("new_globals") if "new_globals" in run else self._new_globals(before))
+        return run
+
+    def stage_model_std(self, info):
+        """Run the model solution on the standard data."""
+        run = self._run_stage(self.run_model, info["std"], "Model Solution code")
+        self.model_time = run["time"]
+        return run
+
+    def _report_timing(self, student, model):
+        """Print how the student's code time compared to the model solution."""
+        self.ratio = 100.0 * student["time"] / model["time"]
+        print(f"<p>Student solution took {self.ratio:.1f}% the model solution's time.</p>")
+        if self.host is not None:
+            print(
+                f"<p>Timed on {self.host['host']} (calibration time {1000*self.host['calibration']:.1f}ms"
+                + f"{', one run at a time' if self.timing_lane else ''}).</p>"
+            )
+
+    def stage_compare(self, student, model, calc_answers):
+        """Compare the student's and model answers for the student's data."""
+        print("<h2>Comparison of Results.....</h2>")
+        self._report_timing(student, model)
+        return self.compare(
+            self.sanitize_student_answers(deepcopy(student["results"])),
+            self.sanitize_student_answers(deepcopy(model["results"])),
+            deepcopy(calc_answers["user"]),
+        )
+
+    def stage_compare_std(self, student, student_std, model_std, calc_answers):
+        """Compare the student's and model answers for the standard data."""
+        with CaptureOutput():
+            sc = self.compare(
+                self.sanitize_student_answers(deepcopy(student["results"])),
+                self.sanitize_student_answers(deepcopy(student_std["results"])),
+                deepcopy(calc_answers["std"]),
+            )
+        if sc:
+            print("<h3>Student returned same aswers for reference code - hardcoded File path?</h3>")
+            print(
+                """<p>The student's solutions for their data file and the reference data file appear to
+            give the same answer. Possibly they've hardcoded a path somewhere and are really analysing the same
+            data twice. If they have -0.5 grades on robustness</p>"""
+            )
+        print("<h2>Comparison of Results for Standard Data.....</h2>")
+        self._report_timing(student_std, model_std)
+        return self.compare(
+            self.sanitize_student_answers(deepcopy(student_std["results"])),
+            self.sanitize_student_answers(deepcopy(model_std["results"])),
+            deepcopy(calc_answers["std"]),
+        )
+
+    def stage_scaling(self, info, _):
+        """Time the student's and model code on scaled up copies of the standard data and fit how the time grows."""
+        if not self.scaling_factors:
+            return None
+        print("<h2>Scaling with the Size of the Data</h2>")
+        rows, times = [], {"student": [], "model": []}
+        for factor in self.scaling_factors:
+            filename = self.place_scaled_data(info["std"], factor)
+            rows.append(self.load_data(filename).data.shape[0])
+            for who, func in [("student", self.run_student), ("model", self.run_model)]:
+                if len(times[who]) and isinstance(times[who][-1], str):  # Failed on a smaller file
+                    times[who].append("not run")
+                    continue
+                with self.timing():
+                    elapsed = time_limited(func, filename, self.scaling_cpu_limit, self.scaling_memory_limit)
+                times[who].append(elapsed)
+        print("<table><tr><th>Size</th><th>Rows</th><th>Student Code</th><th>Model Solution</th></tr>")
+        for factor, nrows, student, model in zip(self.scaling_factors, rows, times["student"], times["model"]):
+            student, model = [f"{t*1000:.1f}ms" if isinstance(t, float) else t for t in (student, model)]
+            print(f"<tr><td>{factor}&times;</td><td>{nrows}</td><td>{student}</td><td>{model}</td></tr>")
+        print("</table>")
+        self.scaling_exponent = fit_exponent(rows, times["student"])
+        model_exponent = fit_exponent(rows, times["model"])
+        exponents = [f"{k:.2f}" if k is not None else "unknown" for k in (self.scaling_exponent, model_exponent)]
+        print(f"<p>Run time grows as rows<sup>k</sup> with k={exponents[0]} for the student code and k={exponents[1]}")
+        print("for the model solution.</p>")
+        failed = any(isinstance(t, str) for t in times["student"]) and not any(isinstance(t, str) for t in times["model"])
+        slow = None not in (self.scaling_exponent, model_exponent) and (
+            self.scaling_exponent > model_exponent + self.scaling_tolerance
+        )
+        if failed or slow:
+            print(
+                """<h3>Student code scales poorly with the size of the data</h3>
+                <p>The student's code slows down much faster than the model solution as the data gets bigger (or
+                couldn't cope with the larger files at all). Look for loops over every pair of data points, or
+                arrays grown one element at a time.</p>"""
+            )
+        return {"rows": rows, "times": times, "exponents": (self.scaling_exponent, model_exponent)}
+
+    def _variant_model(self, filename):
+        """Return the model solution's results and the calculated answers for a variant file, cached beside it.
+
+        Every student with the same standard data shares the variant files, so the model solution is only run once for
+        each - the cache is named for the source of :py:meth:`run_model` and :py:meth:`get_calc_answers`.
+        """
+        cache = f"{filename}.{method_hash(type(self), ('run_model', 'get_calc_answers'))[:12]}.model"
+        if not path.exists(cache):
+            with file_lock(cache + ".lock"):
+                if not path.exists(cache):
+                    try:
+                        with CaptureOutput(limit=self.output_limit):
+                            answers = {"results": self.run_model(filename), "calc": self.get_calc_answers(filename)}
+                    except Exception as err:
+                        answers = {"error": f"{type(err).__name__}: {err}"}
+                    with open(cache + ".tmp", "wb") as data:
+                        pickle.dump(answers, data)
+                    os.replace(cache + ".tmp", cache)
+        with open(cache, "rb") as data:
+            return pickle.load(data)
+
+    def stage_variants(self, info, _):
+        """Run the student's code on each variant of the standard data, several variants at once.
+
+        Each run is a forked child process limited by the sandbox settings (see :py:mod:`sandbox`), with up to
+        :py:attr:`variant_workers` running at a time. The model solution's answers are worked out (or read from their
+        cache) while the children run.
+        """
+        if not self.variants:
+            return None
+        files = {variant: self.place_variant_data(info["std"], variant) for variant in self.variants}
+
+        def child(filename):
+            plt.show = replace_show
+            plt.close = replace_close
+            with CaptureOutput(limit=self.output_limit):  # Nobody is reading the output
+                t1 = perf_counter()
+                ret = self.run_student(filename)
+            return {"results": ret, "time": perf_counter() - t1}
+
+        limits = {"cpu_limit": self.sandbox_cpu_limit, "memory_limit": self.sandbox_memory_limit}
+        pending = deque(files.items())
+        running = deque()
+        workers = max(self.variant_workers or os.cpu_count() or 1, 1)
+        while pending and len(running) < workers:
+            variant, filename = pending.popleft()
+            running.append((variant, start_in_child(child, filename, **limits)))
+        models = {variant: self._variant_model(filename) for variant, filename in files.items()}
+        runs = {}
+        while running:
+            variant, started = running.popleft()
+            runs[variant] = started.result()
+            if pending:
+                variant, filename = pending.popleft()
+                running.append((variant, start_in_child(child, filename, **limits)))
+        return {
+            variant: {"file": path.basename(filename), "student": runs[variant], "model": models[variant]}
+            for variant, filename in files.items()
+        }
+
+    def stage_robustness(self, variants, student):
+        """Report a matrix of which answers the student's code got right for each variant of the standard data."""
+        if not variants:
+            return None
+        print("<h2>Robustness with Variants of the Standard Data</h2>")
+        keys = []
+        for run in variants.values():  # Normalised, so the uncertainties are folded into their values as for s below
+            calc = self.normalise_entry(deepcopy(run["model"].get("calc", {})))
+            keys.extend(key for key in calc if key not in keys)
+        print("<table><tr><th>Data set</th>" + "".join(f"<th>{key}</th>" for key in keys) + "<th>Comment</th></tr>")
+        own = self.sanitize_student_answers(deepcopy(student["results"]))
+        matrix, hardcoded = {}, []
+        for variant, run in variants.items():
+            label = f'<td title="{run["file"]}">{variant}</td>'
+            ok, value = run["student"]
+            if "error" in run["model"]:
+                error = run["model"]["error"]
+                print(f"<tr>{label}<td colspan={len(keys) + 1}>Model solution failed: {error}</td></tr>")
+                continue
+            if not ok:
+                matrix[variant] = None
+                print(
+                    f"<tr>{label}<td colspan={len(keys) + 1} style='background-color: {self.colors[2]};'>"
+                    + f"Student code failed: {value}</td></tr>"
+                )
+                continue
+            results = self.sanitize_student_answers(deepcopy(value["results"]))
+            if not isinstance(results, dict):
+                matrix[variant] = None
+                print(f"<tr>{label}<td colspan={len(keys) + 1}>Student code didn't return a dictionary.</td></tr>")
+                continue
+            with CaptureOutput():
+                same = self.compare(deepcopy(own), deepcopy(results), deepcopy(run["model"]["calc"]))
+            s = self.normalise_entry(results)
+            m = self.normalise_entry(self.sanitize_student_answers(deepcopy(run["model"]["results"])))
+            c = self.normalise_entry(deepcopy(run["model"]["calc"]))
+            matrix[variant] = {}
+            cells = []
+            for key in keys:
+                if s.get(key, None) is None:
+                    matrix[variant][key] = None
+                    cells.append(f"<td style='background-color: {self.colors[3]};'>missing</td>")
+                    continue
+                with CaptureOutput():
+                    matrix[variant][key] = bool(self.compare_one_val(s[key], m.get(key, None), c.get(key, None), key))
+                color, mark = (self.colors[0], "&#10004;") if matrix[variant][key] else (self.colors[2], "&#10008;")
+                cells.append(f"<td style='background-color: {color};'>{mark}</td>")
+            comment = ""
+            if same:
+                hardcoded.append(variant)
+                comment = "Same answers as the student's own data"
+            print(f"<tr>{label}{''.join(cells)}<td>{comment}</td></tr>")
+        print("</table>")
+        times = [run["student"][1]["time"] for run in variants.values() if run["student"][0]]
+        if times:
+            print(f"<p>Student code took {1000*min(times):.1f}-{1000*max(times):.1f}ms on the variants.</p>")
+        if hardcoded:
+            print("<h3>Student returned the same answers for variants of the standard data - hardcoded File path?</h3>")
+            print(
+                f"""<p>The student's code gave the same answers for {', '.join(hardcoded)} as for their own data file.
+            Possibly they've hardcoded a path somewhere and are really analysing the same data each time.</p>"""
+            )
+        return matrix
+
+    def stage_structure(self, info, _):
+        """List the functions the student has defined."""
+        print("<h2>Student Code Structure</h2>")
+        self.get_func_details()
+        text = []
+        for filename in [self.code] + [path.join(self.subdir, mod) for mod in self.mods]:
+            try:
+                with open(filename, "r", errors="ignore") as source:
+                    text.append(code_text(source.read()))
+            except (OSError, TypeError):
+                continue
+        hashes = shingles("\n".join(text))
+        self.text_signature = MinHasher().signature(hashes) if len(hashes) >= MIN_SHINGLES else None
+        return self.func_listing
+
+    def stage_lint(self, info):
+        """Run the code quality tools."""
+        print("<h1>Student Code</h1>")
+        try:
+            self.lint_code()
+        except Exception as err:
+            print(f"<p>Failed to check code complexity {err}.</p>")
+
+    def stage_profile(self, info, _):
+        """Run the student's code on the standard data again under the line profiler, if line_profile is set."""
+        if not self.line_profile:
+            return None
+        profiler = LineProfiler(self.run_student.__code__.co_filename)
+        try:
+            with CaptureOutput(limit=self.output_limit), profiler:
+                self.run_student(info["std"])
+        except Exception:  # Already reported by the timed run - the profile up to the error is still useful
+            pass
+        finally:
+            self.temp_close("all")
+        return profiler.profile
+
+    def stage_highlight(self, info):
+        """Highlight the student's code - shown by the listing unless there is a line profile."""
+        with CaptureOutput() as output:
+            self.highlight_code()
+        return str(output)
+
+    def stage_listing(self, info, profile, highlight):
+        """Show the highlighted code."""
+        if profile:
+            self.highlight_code(profile)
+        else:
+            print(highlight, end="")
+
     def get_func_details(self):
         """Gets a list of various facts about the function objects in module."""
         listing = []
@@ -992,7 +2038,7 @@ class Assessor(object):
     def inspect(self):
         """Checks the code file(s) for inputs etc."""
         try:
-            parse_code(self.code)
+            self.antipatterns = parse_code(self.code).antipatterns
         except excp.InputUsedError as err:
             print(
                 """<p><b>input</b> found in student code. Using <b>input</b> will raise an error but we can try importing anyway! Students were told
@@ -1011,7 +2057,7 @@ class Assessor(object):
         self.run_student = None
         back = os.getcwd()
         try:
-            plt.close("all")
+            self.temp_close("all")
             print("<h2>Importing Student module.....</h2>")
             self.inspect()
             os.chdir(self.subdir)
@@ -1019,17 +2065,13 @@ class Assessor(object):
                 raise ImportError("No Student code!")
             mod_name = path.splitext(path.split(self.code)[-1])[0]
             print(f"Got module name '{mod_name}'")
-            with CaptureOutput() as on_import:
-                self.module = importlib.import_module(mod_name)
-            on_impoprt = str(on_import).replace("\n", "<br/>\n")
-            print(on_import)
+            sys.path.insert(0, self.subdir)  # Don't rely on '' being in sys.path - it isn't in worker processes
+            try:
+                with CaptureOutput(limit=self.output_limit) as on_import:
+                    self.module = importlib.import_module(mod_name)
+            finally:
+                self.report_output(on_import)
             print("<h2>Finished Module import</h2>")
-            if len(open_figures()) > 0:
-                self.save_figs(
-                    "Import_figures-{}.png",
-                    "",
-                    prefix="<h3>Figures Incorrectly generated during import{}</h3>",
-                )
             if "ProcessData" not in dir(self.module) or not isfunction(self.module.ProcessData):
                 print("<h2>Unable to locate required ProcessData function. Check manually</h2>")
                 self.module = None
@@ -1057,10 +2099,13 @@ class Assessor(object):
             self._exception.append(err_string)
             raise err
         finally:
+            if self.subdir in sys.path:
+                sys.path.remove(self.subdir)
             os.chdir(back)
 
     def save_func_details(self):
         """Save several rows of functions details into the database cursor cur."""
+        self.cur.execute("DELETE FROM funcs WHERE issid = ?;", (self.issid,))  # Don't duplicate if re-marking
         for details in self.func_listing:
             row = []
             for k in ["issid", "name", "docstring", "doc_len", "code", "args"]:
@@ -1070,31 +2115,117 @@ class Assessor(object):
         print("<p>Saved {} Function signatures</p>".format(len(self.func_listing)))
         self.conn.commit()
 
+    def save_text_signature(self):
+        """Save the MinHash signature of the docstrings and comments into the database."""
+        self.cur.execute("DELETE FROM text_signatures WHERE issid = ?;", (self.issid,))
+        if self.text_signature is not None:
+            signature = " ".join(f"{value:x}" for value in self.text_signature)
+            self.cur.execute("INSERT INTO text_signatures ( issid, signature ) VALUES ( ?,? );", (self.issid, signature))
+        self.conn.commit()
+
+    def save_antipatterns(self):
+        """Save the number of times each performance anti-pattern was found into the database."""
+        self.cur.execute("DELETE FROM antipatterns WHERE issid = ?;", (self.issid,))
+        sql = "INSERT INTO antipatterns ( issid, pattern, count, lines ) VALUES ( ?,?,?,? );"
+        for pattern, lines in self.antipatterns.items():
+            self.cur.execute(sql, (self.issid, pattern, len(lines), ",".join(str(line) for line in lines)))
+        self.conn.commit()
+
+    def save_figure_hashes(self, run, rendered):
+        """Save the perceptual hashes of the figures rendered from run into the database (see :py:mod:`similarity`)."""
+        self.cur.execute("DELETE FROM figure_hashes WHERE issid = ? AND run = ?;", (self.issid, run))
+        if run in self.figure_hash_runs:
+            sql = "INSERT INTO figure_hashes ( issid, run, figure, hash ) VALUES ( ?,?,?,? );"
+            for name, png in rendered["pngs"]:
+                try:
+                    self.cur.execute(sql, (self.issid, run, name, f"{figure_hash(png):x}"))
+                except (ValueError, OSError, SyntaxError):  # Not a readable png
+                    continue
+        self.conn.commit()
+
     def create_pdf(self):
         """Convert results.html to results.pdf and combine with other pdf files."""
         try:
             dest = path.join(self.subdir, "_results.pdf")
             src = path.join(self.subdir, "results.html")
             wprnt.HTML(src).write_pdf(dest)
-            self.files.insert(0, "_results.pdf")
 
             mergedObject = PdfFileMerger()
 
-            for filename in self.files:
+            for filename in ["_results.pdf"] + self.pdfs:
                 mergedObject.append(PdfFileReader(path.join(self.subdir, filename), "rb"))
 
-            mergedObject.write("result.pdf")
+            mergedObject.write(path.join(self.subdir, "results.pdf"))
         except Exception as err:
-            print(f"{self.name} ({self.issid}) pdf conversion error:\n{err}\n{format_exc()}")
+            log.error(
+                f"{self.name} ({self.issid}) pdf conversion error:\n{err}\n{format_exc()}",
+                extra={"student": path.basename(self.subdir)},
+            )
+
+
+class BoundedBuffer(io.TextIOBase):
+    """A text buffer that keeps just the start and end of what is written to it.
+
+    The first half of the limit is kept from the start of the output and a ring buffer holds the last half, so a
+    student printing in a long loop can't use unbounded memory or produce a huge report.
+    """
+
+    def __init__(self, limit):
+        """Create the buffer to hold at most limit characters."""
+        super().__init__()
+        self.limit = limit
+        self.written = 0
+        self.dropped = 0
+        self._head = []
+        self._head_len = 0
+        self._tail = deque()
+        self._tail_len = 0
+
+    def writable(self):
+        """We can be written to."""
+        return True
+
+    def write(self, text):
+        """Keep text if it falls in the head or tail of the output."""
+        size = len(text)
+        self.written += size
+        if self._head_len < self.limit // 2:
+            keep = text[: self.limit // 2 - self._head_len]
+            self._head.append(keep)
+            self._head_len += len(keep)
+            text = text[len(keep) :]
+        if text:
+            self._tail.append(text)
+            self._tail_len += len(text)
+            excess = self._tail_len - (self.limit - self.limit // 2)
+            while excess > 0:
+                chunk = self._tail.popleft()
+                if len(chunk) > excess:
+                    self._tail.appendleft(chunk[excess:])
+                    chunk = chunk[:excess]
+                self._tail_len -= len(chunk)
+                self.dropped += len(chunk)
+                excess -= len(chunk)
+        return size
+
+    def getvalue(self):
+        """Return the kept output with a marker where output was dropped."""
+        gap = f"\n...[{self.dropped} characters of output dropped]...\n" if self.dropped else ""
+        return "".join(self._head) + gap + "".join(self._tail)
 
 
 class CaptureOutput:
     """A wrapper that redirects sys.stdout and sys.stderr to a string Buffer."""
 
-    def __init__(self, *args):
-        """Create the wrapper with either a new StringIO buffer or an existing one."""
+    def __init__(self, *args, limit=None):
+        """Create the wrapper with either a new StringIO buffer or an existing one.
+
+        If limit is given, the new buffer is a :py:class:`BoundedBuffer` keeping at most limit characters.
+        """
         if len(args) and isinstance(args[0], io.TextIOBase):
             self._wrapper = args[0]
+        elif len(args) == 0 and limit is not None:
+            self._wrapper = BoundedBuffer(limit)
         elif len(args) == 0:
             self._wrapper = io.StringIO()
         else:
@@ -1113,5 +2244,10 @@ class CaptureOutput:
         if self._wrapper.seekable():
             self._wrapper.seek(0)
 
+    @property
+    def buffer(self):
+        """The buffer that output is captured into."""
+        return self._wrapper
+
     def __str__(self):
         return self._wrapper.getvalue()
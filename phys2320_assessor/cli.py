@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""Command line entry point for the assessor - provides the *phys2320* command."""
+import os
+from os import path
+import sys
+import argparse
+import logging
+import time
+
+from .filer import file_work
+from .funcs import _to_type
+from .pipeline import load_class, run_pipeline, mark_cohort, pdf_cohort, replay_cohort
+from .cohort import ComputingClass
+from .journal import RunJournal
+from .workqueue import run_worker
+from .watch import watch_cohort
+from .daemon import MarkingDaemon, send_request
+from .progress import read_status, format_status
+
+
+def _add_assessor(parser):
+    """Add the options needed to find the year's Assessor subclass and the student work."""
+    parser.add_argument(
+        "-a", "--assessor", required=True, help="The year's Assessor subclass as module:ClassName"
+    )
+    parser.add_argument("-d", "--directory", default="Student Work", help="Student work directory")
+    parser.add_argument(
+        "-s",
+        "--set",
+        dest="settings",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Override an Assessor attribute for every student, e.g. -s report_assets=shared",
+    )
+    parser.add_argument(
+        "--start-method",
+        default="forkserver",
+        choices=["forkserver", "spawn", "fork"],
+        help="How worker processes are started (default: forked from a preloaded server)",
+    )
+
+
+def _add_timing(parser):
+    """Add the options that control how marking workers share the cores."""
+    parser.add_argument(
+        "--threads", type=int, default=1, help="BLAS/OpenMP threads per marking worker (0 for no limit, default 1)"
+    )
+    parser.add_argument("--pin", action="store_true", help="Pin each marking worker to a core of its own")
+    parser.add_argument(
+        "--timing-lane", action="store_true", help="Time the student and model runs one at a time across all workers"
+    )
+
+
+def _add_metrics(parser):
+    """Add the option to write the run's counters for Prometheus."""
+    parser.add_argument("--metrics", default=None, metavar="FILE", help="Keep a Prometheus textfile of the counters")
+
+
+def parse_settings(settings):
+    """Turn a list of NAME=VALUE strings into a dictionary of Assessor attribute overrides."""
+    ret = {}
+    for setting in settings:
+        if "=" not in setting:
+            raise argparse.ArgumentTypeError(f"Setting {setting} should be NAME=VALUE")
+        key, value = setting.split("=", 1)
+        ret[key.strip()] = None if value.strip().lower() == "none" else _to_type(value.strip())
+    return ret
+
+
+def build_parser():
+    """Build the argument parser for the phys2320 command."""
+    parser = argparse.ArgumentParser(prog="phys2320", description="PHYS2320 coursework autograder")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    filer = sub.add_parser("file", help="Unzip gradebook downloads and file the submissions")
+    filer.add_argument("download", help="glob pattern for the Gradebook zip files")
+    filer.add_argument("pattern", help="Regular expression for the submission description files")
+    filer.add_argument("-d", "--directory", default="Student Work", help="Student work directory")
+    filer.add_argument("--no-clobber", dest="clobber", action="store_false", help="Don't overwrite existing files")
+
+    mark = sub.add_parser("mark", help="Mark all the students that still need marking")
+    _add_assessor(mark)
+    mark.add_argument("-w", "--workers", type=int, default=1, help="Number of students to mark at once")
+    mark.add_argument("--restart", action="store_true", help="Keep the existing function signatures table")
+    mark.add_argument("--ignore-skip", action="store_true", help="Mark students even if they have a skip file")
+    mark.add_argument("--no-prepare", dest="prepare", action="store_false", help="Don't pre-generate standard data")
+    mark.add_argument("--no-triage", dest="triage", action="store_false", help="Skip the pre-flight checks")
+    _add_timing(mark)
+    _add_metrics(mark)
+    mark.add_argument("--resume", action="store_true", help="Carry on from where the last run stopped")
+
+    pdf = sub.add_parser("pdf", help="Create pdf reports for all marked students")
+    _add_assessor(pdf)
+    pdf.add_argument("-w", "--workers", type=int, default=1, help="Number of pdfs to create at once")
+
+    replay = sub.add_parser("replay", help="Re-compare and re-write the reports from the recorded code outputs")
+    _add_assessor(replay)
+    replay.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="Number of students at once")
+
+    run = sub.add_parser("run", help="File, mark and pdf, streaming students through the stages")
+    _add_assessor(run)
+    run.add_argument("download", nargs="?", default=None, help="glob pattern for the Gradebook zip files")
+    run.add_argument("pattern", nargs="?", default=None, help="Regular expression for the submission descriptions")
+    run.add_argument("--no-clobber", dest="clobber", action="store_false", help="Don't overwrite existing files")
+    run.add_argument("--file-workers", type=int, default=2, help="Number of submissions to file at once")
+    run.add_argument("--mark-workers", type=int, default=os.cpu_count() or 1, help="Number of students to mark at once")
+    run.add_argument("--pdf-workers", type=int, default=2, help="Number of pdfs to create at once")
+    run.add_argument("--no-pdf", dest="pdf", action="store_false", help="Skip the pdf stage")
+    run.add_argument("--restart", action="store_true", help="Keep the existing function signatures table")
+    run.add_argument("--ignore-skip", action="store_true", help="Mark students even if they have a skip file")
+    run.add_argument("--no-prepare", dest="prepare", action="store_false", help="Don't pre-generate standard data")
+    run.add_argument("--no-triage", dest="triage", action="store_false", help="Skip the pre-flight checks")
+    _add_timing(run)
+    _add_metrics(run)
+    run.add_argument("--resume", action="store_true", help="Carry on from where the last run stopped")
+
+    watch = sub.add_parser("watch", help="Keep filing and marking students as new downloads and changes appear")
+    _add_assessor(watch)
+    watch.add_argument("download", nargs="?", default=None, help="glob pattern for the Gradebook zip files")
+    watch.add_argument("pattern", nargs="?", default=None, help="Regular expression for the submission descriptions")
+    watch.add_argument("--interval", type=float, default=10.0, help="Seconds between looking for changes")
+    watch.add_argument("--settle", type=float, default=5.0, help="Seconds a change must be left alone before use")
+    watch.add_argument("--no-clobber", dest="clobber", action="store_false", help="Don't overwrite existing files")
+    watch.add_argument("--mark-workers", type=int, default=os.cpu_count() or 1, help="Number of students to mark at once")
+    watch.add_argument("--pdf-workers", type=int, default=2, help="Number of pdfs to create at once")
+    watch.add_argument("--no-pdf", dest="pdf", action="store_false", help="Skip the pdf stage")
+    watch.add_argument("--restart", action="store_true", help="Keep the existing function signatures table")
+    watch.add_argument("--no-prepare", dest="prepare", action="store_false", help="Don't pre-generate standard data")
+    watch.add_argument("--no-triage", dest="triage", action="store_false", help="Skip the pre-flight checks")
+    _add_timing(watch)
+    _add_metrics(watch)
+
+    status = sub.add_parser("status", help="Show the progress of the current or last run")
+    status.add_argument("-d", "--directory", default="Student Work", help="Student work directory")
+    status.add_argument("-f", "--follow", action="store_true", help="Keep showing the progress until the run finishes")
+    status.add_argument("--interval", type=float, default=2.0, help="Seconds between updates when following")
+
+    serve = sub.add_parser("serve", help="Keep workers running and mark students on request over a local socket")
+    _add_assessor(serve)
+    serve.add_argument("-w", "--workers", type=int, default=1, help="Number of requests to work on at once")
+    _add_timing(serve)
+
+    request = sub.add_parser("request", help="Send a request to the serve command for the same directory")
+    request.add_argument("action", choices=["mark", "replay", "pdf", "status", "stop"], help="What to ask for")
+    request.add_argument("student", nargs="?", default=None, help="Student folder or issid")
+    request.add_argument("-d", "--directory", default="Student Work", help="Student work directory")
+    request.add_argument("-p", "--priority", type=int, default=10, help="Lower numbers are done first (default 10)")
+    request.add_argument("--wait", action="store_true", help="Wait until the request has been done")
+
+    triage = sub.add_parser("triage", help="Run the pre-flight checks and estimate how long marking will take")
+    _add_assessor(triage)
+    triage.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="Number of checks at once")
+    triage.add_argument("--mark-workers", type=int, default=None, help="Number of students to be marked at once")
+    triage.add_argument("--ignore-skip", action="store_true", help="Check students even if they have a skip file")
+
+    publish = sub.add_parser("publish", help="Put the students that need marking on the shared work queue")
+    _add_assessor(publish)
+    publish.add_argument("--requeue", action="store_true", help="Queue every student again")
+    publish.add_argument("--restart", action="store_true", help="Keep the existing function signatures table")
+    publish.add_argument("--ignore-skip", action="store_true", help="Queue students even if they have a skip file")
+
+    similar = sub.add_parser("similar", help="List near-duplicate figures or comments from different students")
+    similar.add_argument("-d", "--directory", default="Student Work", help="Student work directory")
+    similar.add_argument("--radius", type=int, default=8, help="Most bits of the figure hashes that may differ")
+    similar.add_argument("--text", action="store_true", help="Compare docstrings and comments rather than figures")
+    similar.add_argument("--threshold", type=float, default=0.5, help="Least similarity of the text to list")
+    similar.add_argument("--reset", action="store_true", help="Forget the hashes and signatures of earlier runs")
+
+    worker = sub.add_parser("worker", help="Mark students claimed from the shared work queue")
+    _add_assessor(worker)
+    worker.add_argument("-w", "--workers", type=int, default=1, help="Number of students to mark at once")
+    worker.add_argument("--lease", type=float, default=300.0, help="Lease length in seconds")
+    _add_timing(worker)
+    worker.add_argument("--wait", action="store_true", help="Keep waiting for new work when the queue is empty")
+    return parser
+
+
+def main(argv=None):
+    """Run the phys2320 command."""
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    # The year's subclass lives relative to where we were started.
+    sys.path.insert(0, os.getcwd())
+
+    if args.command == "file":
+        file_work(args.download, args.pattern, clobber=args.clobber, directory=args.directory)
+        return 0
+    if args.command == "similar":
+        os.chdir(args.directory)
+        cohort = ComputingClass(".", restart=True)
+        if args.reset:
+            cohort.reset_similarity()
+            cohort.close()
+            return 0
+        if args.text:
+            for similarity, issid, other in cohort.similar_text(threshold=args.threshold):
+                print(f"{similarity:.2f} {issid} ~ {other}")
+        else:
+            for distance, (issid, figure), (other, other_figure) in cohort.similar_figures(radius=args.radius):
+                print(f"{distance:3d} {issid} {figure} ~ {other} {other_figure}")
+        cohort.close()
+        return 0
+    if args.command == "status":
+        while True:
+            status = read_status(args.directory)
+            if status is None:
+                print(f"No run status in {args.directory}")
+                return 1
+            print(format_status(status))
+            for job in status["running"] if args.follow else []:
+                print(f"    {job['stage']:4s} {job['student']} for {job['seconds']:.0f}s")
+            if not args.follow or status["finished"]:
+                return 0
+            time.sleep(args.interval)
+    if args.command == "request":
+        if args.action in ("mark", "replay", "pdf") and args.student is None:
+            build_parser().error(f"request {args.action} needs a student")
+        reply = send_request(
+            args.directory,
+            {"command": args.action, "student": args.student, "priority": args.priority, "wait": args.wait},
+        )
+        if args.action == "status":
+            for state in ("running", "queued", "finished"):
+                for job in reply[state]:
+                    message = f" - {job['message']}" if "message" in job else ""
+                    print(f"{job['state']:8s} {job['command']:6s} {job['student']} ({job['priority']}){message}")
+        else:
+            print(reply.get("message", f"{reply.get('command')} {reply.get('student')} {reply.get('state')}"))
+        return 0 if reply["ok"] else 1
+
+    student_class = load_class(args.assessor)
+    settings = parse_settings(args.settings)
+    if getattr(args, "timing_lane", False):
+        settings["timing_lane"] = True
+    threads = getattr(args, "threads", 1) or None
+    if args.command == "publish":
+        os.chdir(args.directory)
+        cohort = ComputingClass(
+            ".", student_class=student_class, restart=args.restart, ignore_skip=args.ignore_skip, settings=settings
+        )
+        counts = cohort.publish(requeue=args.requeue).counts()
+        cohort.close()
+        print(", ".join(f"{count} {state}" for state, count in counts.items()))
+        return 0
+    if args.command == "serve":
+        MarkingDaemon(
+            student_class,
+            args.directory,
+            workers=args.workers,
+            settings=settings,
+            start_method=args.start_method,
+            threads=threads,
+            pin=args.pin,
+        ).serve()
+        return 0
+    if args.command == "triage":
+        os.chdir(args.directory)
+        cohort = ComputingClass(
+            ".", student_class=student_class, restart=True, ignore_skip=args.ignore_skip, settings=settings
+        )
+        report = cohort.triage(workers=args.workers, journal=RunJournal("."), mark_workers=args.mark_workers)
+        cohort.close()
+        for subdir in report.order:
+            print(path.basename(subdir))
+        return 1 if report.failures else 0
+    if args.command == "worker":
+        outcome = run_worker(
+            student_class,
+            args.directory,
+            workers=args.workers,
+            lease=args.lease,
+            settings=settings,
+            start_method=args.start_method,
+            exit_when_idle=not args.wait,
+            threads=threads,
+            pin=args.pin,
+        )
+    elif args.command == "mark":
+        outcome = mark_cohort(
+            student_class,
+            args.directory,
+            workers=args.workers,
+            restart=args.restart,
+            ignore_skip=args.ignore_skip,
+            prepare=args.prepare,
+            triage=args.triage,
+            resume=args.resume,
+            settings=settings,
+            start_method=args.start_method,
+            threads=threads,
+            pin=args.pin,
+            metrics=args.metrics,
+        )
+    elif args.command == "replay":
+        outcome = replay_cohort(
+            student_class, args.directory, workers=args.workers, settings=settings, start_method=args.start_method
+        )
+    elif args.command == "watch":
+        if (args.download is None) != (args.pattern is None):
+            build_parser().error("watch needs both a download glob and a submission pattern, or neither")
+        outcome = watch_cohort(
+            student_class,
+            download=args.download,
+            pattern=args.pattern,
+            directory=args.directory,
+            interval=args.interval,
+            settle=args.settle,
+            clobber=args.clobber,
+            mark_workers=args.mark_workers,
+            pdf_workers=args.pdf_workers,
+            restart=args.restart,
+            pdf=args.pdf,
+            prepare=args.prepare,
+            triage=args.triage,
+            settings=settings,
+            start_method=args.start_method,
+            threads=threads,
+            pin=args.pin,
+            metrics=args.metrics,
+        )
+    elif args.command == "pdf":
+        outcome = pdf_cohort(
+            student_class, args.directory, workers=args.workers, settings=settings, start_method=args.start_method
+        )
+    else:
+        if (args.download is None) != (args.pattern is None):
+            build_parser().error("run needs both a download glob and a submission pattern, or neither")
+        outcome = run_pipeline(
+            student_class,
+            download=args.download,
+            pattern=args.pattern,
+            directory=args.directory,
+            clobber=args.clobber,
+            file_workers=args.file_workers,
+            mark_workers=args.mark_workers,
+            pdf_workers=args.pdf_workers,
+            restart=args.restart,
+            ignore_skip=args.ignore_skip,
+            pdf=args.pdf,
+            prepare=args.prepare,
+            triage=args.triage,
+            resume=args.resume,
+            settings=settings,
+            start_method=args.start_method,
+            threads=threads,
+            pin=args.pin,
+            metrics=args.metrics,
+        )
+    failed = [subdir for subdir, state in outcome.items() if "failed" in state]
+    print(f"Finished {len(outcome)} students, {len(failed)} failures.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,9 @@ from os import path
 import sqlite3
 
 from . import Assessor
+from .stddata import prepare_std_data
+from .triage import triage_cohort
+from .similarity import similar_pairs, similar_texts
 
 def sortkey(d):
     """Split d on "_", reverse and return as a tuple."""
@@ -16,11 +19,13 @@ class ComputingClass(object):
 
     """A collection of Assessor classes for marking Computing2 Projects."""
 
-    def __init__(self,directory=None,student_class=Assessor,restart=False,ignore_skip=False):
+    def __init__(self,directory=None,student_class=Assessor,restart=False,ignore_skip=False,settings=None):
         self.subdirs=list()
         self.noskip=list()
         self.student_class=student_class
+        self.settings={} if settings is None else dict(settings) # Attribute overrides for every student
         directory=os.getcwd() if directory is None else directory
+        self.directory=directory
         for entry in sorted(os.listdir(directory), key=sortkey):
             entry=path.join(directory,entry)
             if path.isdir(entry) and path.exists(path.join(entry,"readme.txt")):
@@ -32,35 +37,122 @@ class ComputingClass(object):
             cur.execute("""
             DROP TABLE IF EXISTS `funcs`;
             """)
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS `funcs` (
-              `id` int(11) PRIMARY KEY,
-              `issid` varchar(20) NOT NULL,
-              `name` varchar(100) NOT NULL,
-              `docstring` text,
-              `doc_len` int(11),
-              `code` bigint(20),
-              `args` text);
-            """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS `funcs` (
+          `id` int(11) PRIMARY KEY,
+          `issid` varchar(20) NOT NULL,
+          `name` varchar(100) NOT NULL,
+          `docstring` text,
+          `doc_len` int(11),
+          `code` bigint(20),
+          `args` text);
+        """)
+        # The tables below are kept between runs - each student's rows are replaced when they are marked again, so
+        # students marked in earlier runs are still compared with the rest of the cohort.
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS `antipatterns` (
+          `issid` varchar(20) NOT NULL,
+          `pattern` varchar(50) NOT NULL,
+          `count` int(11),
+          `lines` text);
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS `figure_hashes` (
+          `issid` varchar(20) NOT NULL,
+          `run` varchar(20) NOT NULL,
+          `figure` varchar(100) NOT NULL,
+          `hash` text);
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS `text_signatures` (
+          `issid` varchar(20) PRIMARY KEY,
+          `signature` text);
+        """)
 
         self.db=(conn,cur)
 
 
+    def make_student(self,subdir):
+        """Create the Assessor for subdir with the cohort's settings applied."""
+        r=self.student_class(subdir,self.db)
+        for k,v in self.settings.items():
+            setattr(r,k,v)
+        return r
+
     def __iter__(self):
         """Minimal iterator function to loop over sub directories rerturning Assessors."""
         for i,(d,do) in enumerate(zip(self.subdirs,self.noskip)):
-            r=self.student_class(d,self.db)
+            r=self.make_student(d)
             r.do=do
             yield r
 
     def to_do(self):
         """Minimal iterator function to loop over sub directories rerturning Assessors."""
         for i,(d,do) in enumerate(zip(self.subdirs,self.noskip)):
-            r=self.student_class(d,self.db)
             if not do:
                 continue
-            yield r
+            yield self.make_student(d)
+
+
+    def prepare_std_data(self, workers=1):
+        """Generate all the missing standard data files needed by the cohort using workers processes."""
+        return prepare_std_data(self, workers)
+
+    def triage(self, workers=1, journal=None, mark_workers=None):
+        """Run the quick pre-flight checks on the students to mark - see :py:func:`triage.triage_cohort`."""
+        return triage_cohort(self, workers, journal, mark_workers)
+
+    def publish(self, requeue=False, lease=300.0):
+        """Put the students that still need marking onto the work queue in the cohort directory.
+
+        Keyword Arguments:
+            requeue (bool):
+                Queue all the students again, even those already done or failed.
+            lease (float):
+                Lease length for the queue.
 
+        Returns:
+            (WorkQueue):
+                The queue - any number of workers (see :py:func:`workqueue.run_worker`) can then claim students.
+        """
+        from .workqueue import WorkQueue  # workqueue needs this module
+
+        queue = WorkQueue(path.join(self.directory, "work_queue.db"), lease=lease)
+        todo = self.subdirs if requeue else [d for d, do in zip(self.subdirs, self.noskip) if do]
+        queue.publish(todo, requeue=requeue)
+        return queue
+
+    def similar_figures(self, radius=8):
+        """Find figures from different students whose perceptual hashes are within radius bits of each other.
+
+        The hashes are saved by :py:meth:`Assessor.save_figure_hashes` as each report is written.
+
+        Returns:
+            (list):
+                Tuples of (distance, (issid, figure), (issid, figure)), closest first.
+        """
+        rows = self.db[1].execute("SELECT issid, figure, hash FROM figure_hashes ORDER BY issid, run, figure;")
+        return similar_pairs(((issid, figure, int(value, 16)) for issid, figure, value in rows), radius)
+
+    def similar_text(self, threshold=0.5):
+        """Find students whose docstrings and comments are estimated to be at least threshold similar.
+
+        The MinHash signatures are saved by :py:meth:`Assessor.save_text_signature` as each report is written and
+        matched with an LSH index, so only students that share a band of their signatures are compared.
+
+        Returns:
+            (list):
+                Tuples of (similarity, issid, issid), most similar first.
+        """
+        rows = self.db[1].execute("SELECT issid, signature FROM text_signatures ORDER BY issid;")
+        signatures = ((issid, tuple(int(value, 16) for value in signature.split())) for issid, signature in rows)
+        return similar_texts(signatures, threshold)
+
+    def reset_similarity(self):
+        """Empty the anti-pattern, figure hash and text signature tables kept from earlier runs."""
+        for table in ("antipatterns", "figure_hashes", "text_signatures"):
+            self.db[1].execute(f"DELETE FROM `{table}`;")
+        self.db[0].commit()
 
     def close(self):
         """Cleanup our database of function signatures."""
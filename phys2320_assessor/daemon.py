@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""A long running marking service for one cohort, taking requests over a Unix socket.
+
+Starting the phys2320 command to re-mark one student costs far more than marking them: Python has to start, import
+the scientific stack and the year's module, open the cohort and start a pool of workers. :py:class:`MarkingDaemon`
+does all that once and then waits for requests. Each request is one line of JSON and gets one line of JSON back:
+
+    {"command": "mark", "student": "ab12cd", "priority": 0, "wait": true}
+
+*mark* re-marks a student (only the changed stages are re-run, see :py:mod:`stages`), *replay* re-does the
+comparisons and rewrites the report from the recorded stages, *pdf* makes the pdf, *status* reports what is queued,
+running and recently finished and *stop* shuts the daemon down. Students are named by folder or issid. Jobs wait in a
+priority queue - lowest priority number first - until fewer than the given number of jobs are running. Marking gets a
+fresh worker forked from the preloaded server for each student, as in :py:func:`pipeline.run_pipeline`, while replay
+and pdf jobs share long-lived workers that keep their imports and caches. With *wait* the reply is sent when the job
+has finished, otherwise straight away. :py:func:`send_request` is the client.
+"""
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import heapq
+import itertools
+import json
+import os
+from os import path
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+from .cohort import ComputingClass
+from .journal import RunJournal
+from .pipeline import mark_student, pdf_student, replay_student
+from .workers import make_pool, calibrate
+
+__all__ = ["MarkingDaemon", "socket_path", "send_request"]
+
+SOCKET = ".phys2320.sock"
+COMMANDS = ("mark", "replay", "pdf")
+
+
+def socket_path(directory):
+    """Return the socket for the daemon serving the cohort in directory.
+
+    The socket lives in the cohort directory unless that path is too long for a Unix socket, in which case a name
+    made from the directory is used in the temporary directory.
+    """
+    directory = path.realpath(directory)
+    name = path.join(directory, SOCKET)
+    if len(name.encode()) < 100:
+        return name
+    return path.join(tempfile.gettempdir(), f"phys2320-{hashlib.sha1(directory.encode()).hexdigest()[:12]}.sock")
+
+
+def send_request(directory, request, timeout=None):
+    """Send request (a dictionary) to the daemon serving the cohort in directory and return its reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(socket_path(directory))
+        conn.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with conn.makefile("r", encoding="utf-8") as reply:
+            return json.loads(reply.readline())
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    """Read one request from the socket and write back the reply."""
+
+    def handle(self):
+        """Answer each line of JSON with a line of JSON."""
+        for line in self.rfile:
+            try:
+                reply = self.server.daemon.handle(json.loads(line))
+            except Exception as err:  # Bad JSON or a request the daemon can't handle
+                reply = {"ok": False, "message": f"{type(err).__name__}: {err}"}
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class MarkingDaemon(object):
+
+    """Serve marking requests for the cohort in a directory with a warm pool of workers."""
+
+    def __init__(
+        self,
+        student_class,
+        directory=".",
+        workers=1,
+        settings=None,
+        start_method="forkserver",
+        threads=1,
+        pin=False,
+        history=50,
+    ):
+        """Set up the daemon - nothing is started until :py:meth:`serve`.
+
+        Args:
+            student_class (type):
+                The year's Assessor subclass.
+
+        Keyword Arguments:
+            directory (str):
+                The cohort directory.
+            workers (int):
+                Number of jobs to run at once.
+            settings (dict, None):
+                Assessor attributes to override for every student.
+            start_method, threads, pin:
+                Passed to :py:func:`workers.make_pool`.
+            history (int):
+                Number of finished jobs to remember for status requests.
+        """
+        self.student_class = student_class
+        self.directory = path.realpath(directory)
+        self.workers = max(workers, 1)
+        self.settings = settings
+        self.pool_options = {"start_method": start_method, "threads": threads, "pin": pin}
+        self.queue = []  # Heap of (priority, sequence number, job)
+        self.running = {}
+        self.finished = deque(maxlen=history)
+        self.condition = threading.Condition()
+        self.counter = itertools.count(1)
+        self.stopping = False
+        self.cohort = None
+        self.journal = None
+        self.pools = {}
+        self.server = None
+        self.host = None
+
+    def _pool(self, name):
+        """Return the worker pool for name (mark or render), making it if needed."""
+        if name not in self.pools:
+            self.pools[name] = make_pool(
+                self.workers, [self.student_class.__module__], isolate=name == "mark", **self.pool_options
+            )
+        return self.pools[name]
+
+    def find_student(self, student):
+        """Return the folder of student (a folder name or issid) in the cohort directory, or None.
+
+        Names that could reach outside the cohort directory - containing a path separator or .. - are never found.
+        """
+        if not student or ".." in student or os.sep in student or (os.altsep and os.altsep in student):
+            return None
+        if path.exists(path.join(self.directory, student, "readme.txt")):
+            return path.join(self.directory, student)
+        for entry in sorted(os.listdir(self.directory)):  # Look again each time - students may have been filed since
+            if entry.startswith(f"{student}_") and path.exists(path.join(self.directory, entry, "readme.txt")):
+                return path.join(self.directory, entry)
+        return None
+
+    def _describe(self, job):
+        """Return the public parts of a job."""
+        return {key: value for key, value in job.items() if key != "done"}
+
+    def status(self):
+        """Return the queued, running and recently finished jobs."""
+        with self.condition:
+            return {
+                "ok": True,
+                "queued": [self._describe(job) for _, _, job in sorted(self.queue)],
+                "running": [self._describe(job) for job in self.running.values()],
+                "finished": [self._describe(job) for job in self.finished],
+            }
+
+    def handle(self, request):
+        """Handle one request and return the reply."""
+        command = request.get("command")
+        if command == "status":
+            return self.status()
+        if command == "stop":
+            threading.Thread(target=self.stop, daemon=True).start()
+            return {"ok": True, "message": "Stopping"}
+        if command not in COMMANDS:
+            return {"ok": False, "message": f"Unknown command {command}"}
+        subdir = self.find_student(str(request.get("student", "")))
+        if subdir is None:
+            return {"ok": False, "message": f"No student {request.get('student')} in {self.directory}"}
+        job = {
+            "id": next(self.counter),
+            "command": command,
+            "student": path.basename(subdir),
+            "priority": int(request.get("priority", 10)),
+            "state": "queued",
+            "queued": time.time(),
+            "done": threading.Event(),
+        }
+        with self.condition:
+            heapq.heappush(self.queue, (job["priority"], job["id"], job))
+            self.condition.notify_all()
+        if request.get("wait"):
+            job["done"].wait()
+        return {"ok": job["state"] != "failed", **self._describe(job)}
+
+    def _submit(self, job):
+        """Start a job in the pool."""
+        subdir = path.join(self.directory, job["student"])
+        assessor = self.cohort.make_student(subdir)
+        if job["command"] == "mark":
+            lane = "mark"
+            executor = self._pool(lane)
+            future = executor.submit(mark_student, assessor, self.journal, self.host)
+        elif job["command"] == "pdf":
+            lane = "render"
+            executor = self._pool(lane)
+            future = executor.submit(pdf_student, assessor, True, self.journal)
+        else:
+            if not assessor.can_replay():
+                raise IOError("Nothing recorded to replay - mark the student first")
+            lane = "render"
+            executor = self._pool(lane)
+            future = executor.submit(replay_student, assessor)
+        job["state"] = "running"
+        job["started"] = time.time()
+        self.running[job["id"]] = job
+        future.add_done_callback(lambda future: self._finished(job, lane, executor, future))
+
+    def _finished(self, job, lane, executor, future):
+        """Record the outcome of a job and wake the dispatcher.
+
+        If the worker died, executor - the pool the job ran in - is replaced. Every other job in that pool fails
+        too, and by the time their callbacks run the next job may already be in the replacement pool, so only
+        executor itself is ever shut down.
+        """
+        try:
+            future.result()
+            job["state"] = "done"
+        except BrokenProcessPool:
+            job["state"] = "failed"
+            job["message"] = "Worker process stopped"
+            with self.condition:
+                if self.pools.get(lane) is executor:  # A fresh pool for the next job
+                    self.pools.pop(lane).shutdown(wait=False)
+        except Exception as err:
+            job["state"] = "failed"
+            job["message"] = f"{type(err).__name__}: {err}"
+        job["finished"] = time.time()
+        with self.condition:
+            self.running.pop(job["id"], None)
+            self.finished.append(job)
+            self.condition.notify_all()
+        job["done"].set()
+
+    def _dispatch(self):
+        """Start queued jobs, highest priority first, whenever a worker is free."""
+        with self.condition:
+            while not self.stopping:
+                if not self.queue or len(self.running) >= self.workers:
+                    self.condition.wait()
+                    continue
+                _, _, job = heapq.heappop(self.queue)
+                try:
+                    self._submit(job)
+                except Exception as err:
+                    job["state"] = "failed"
+                    job["message"] = f"{type(err).__name__}: {err}"
+                    self.finished.append(job)
+                    job["done"].set()
+
+    def serve(self):
+        """Open the cohort, start the workers and answer requests until stopped."""
+        address = socket_path(self.directory)
+        if path.exists(address):
+            try:
+                send_request(self.directory, {"command": "status"}, timeout=5.0)
+            except OSError:  # Left behind by a daemon that didn't stop cleanly
+                os.unlink(address)
+            else:
+                raise RuntimeError(f"A daemon is already serving {self.directory}")
+        os.chdir(self.directory)
+        self.cohort = ComputingClass(".", student_class=self.student_class, restart=True, settings=self.settings)
+        self.journal = RunJournal(".")
+        self.host = calibrate()  # Once for the daemon rather than in every marking worker
+        self._pool("mark")
+        self._pool("render")
+        dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        dispatcher.start()
+        self.server = socketserver.ThreadingUnixStreamServer(address, _Handler)
+        self.server.daemon_threads = True
+        self.server.daemon = self
+        print(f"Serving {self.directory} on {address}")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            self.server.server_close()
+            if path.exists(address):
+                os.unlink(address)
+            for pool in self.pools.values():
+                pool.shutdown()
+            self.cohort.close()
+            print("Stopped.")
+
+    def stop(self):
+        """Stop serving - jobs that are already running are allowed to finish."""
+        if self.server is not None:
+            self.server.shutdown()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Parse the student data files once and share the results between the model, calculated answers and cohort.
+
+Data files consist of a header block of key=value lines terminated by an &END line, followed by columns of numbers.
+Each file is parsed once - the header and data are stored in a binary cache keyed by a hash of the file contents, so
+the standard data file copied into every student's folder is only ever parsed the first time it is seen. The numerical
+data is memory-mapped from the cache and so is read-only. The header never depends on the numbers - a file whose data
+can't be read as a table of numbers still has its header, just no data.
+"""
+from collections import OrderedDict, namedtuple
+import hashlib
+import io
+import json
+import os
+from os import path
+import tempfile
+
+import numpy as np
+
+from .funcs import _to_type
+
+__all__ = ["ParsedData", "MEMORY_CACHE_SIZE", "load_data", "file_hash"]
+
+ParsedData = namedtuple("ParsedData", ["header", "columns", "data"])
+ParsedData.__doc__ = """The contents of a data file.
+
+Attributes:
+    header (dict or None):
+        The key=value settings from the header, keys in lower case (None if there was no &END line).
+    columns (list of str):
+        Column names if the data had a row of names, otherwise empty.
+    data (2D array or None):
+        The numerical data, one row per line (None if the data wasn't a regular table of numbers).
+"""
+
+MEMORY_CACHE_SIZE = 16  # Files kept parsed in each process - long-lived workers see every student's data in turn
+
+_memory_cache = OrderedDict()
+
+
+def file_hash(filename):
+    """Return the sha1 hex digest of the contents of filename."""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as data:
+        for chunk in iter(lambda: data.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse(filename):
+    """Parse the header and data from filename."""
+    header = {}
+    lines = []
+    with open(filename, "r", errors="ignore") as datafile:
+        for line in datafile:
+            lines.append(line)
+            if "&END" in line:
+                break
+            if "=" in line:
+                key, value = line.split("=", 1)
+                header[key.strip().lower()] = _to_type(value.strip().strip(","))
+        else:  # No header in this file - so it's all data
+            header = None
+        body = [line for line in lines if "=" not in line] if header is None else []
+        body.extend(datafile)
+    body = [line for line in body if line.strip() != ""]
+    columns = []
+    delimiter = "," if len(body) and "," in body[0] else None
+    if delimiter == ",":  # Spreadsheet exports often end every row with an empty cell
+        body = [line.rstrip().rstrip(",") + "\n" for line in body]
+    if len(body):
+        try:
+            [float(v) for v in body[0].split(delimiter) if v.strip() != ""]
+        except ValueError:  # First row is column names
+            columns = [c.strip() for c in body.pop(0).split(delimiter)]
+    if len(body):
+        try:
+            data = np.loadtxt(io.StringIO("".join(body)), delimiter=delimiter, ndmin=2)
+        except ValueError:  # Ragged rows, blank cells, text... - leave it to whatever wants the numbers to complain
+            data = None
+    else:
+        data = np.zeros((0, len(columns)))
+    return ParsedData(header, columns, data)
+
+
+def _store(cache_dir, key, parsed):
+    """Write the parsed data into the cache directory, atomically so parallel workers don't see partial files.
+
+    The .json file is written last, so a .json file without a .npy file means the file had no readable data.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    writers = [(".json", lambda fileobj: fileobj.write(json.dumps([parsed.header, parsed.columns]).encode("utf-8")))]
+    if parsed.data is not None:
+        writers.insert(0, (".npy", lambda fileobj: np.save(fileobj, np.ascontiguousarray(parsed.data))))
+    for ext, writer in writers:
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=key, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fileobj:
+            writer(fileobj)
+        os.replace(tmp, path.join(cache_dir, key + ext))
+
+
+def _fetch(cache_dir, key):
+    """Load the parsed data from the cache directory, returning None if it isn't there."""
+    if cache_dir is None:
+        return None
+    try:
+        with open(path.join(cache_dir, key + ".json"), "r", encoding="utf-8") as meta:
+            header, columns = json.load(meta)
+        array = path.join(cache_dir, key + ".npy")
+        data = np.load(array, mmap_mode="r") if path.exists(array) else None
+    except (OSError, ValueError):
+        return None
+    return ParsedData(header, columns, data)
+
+
+def load_data(filename, cache_dir=None):
+    """Return the header and data from filename, parsing it only if its contents have not been seen before.
+
+    Args:
+        filename (str):
+            Data file to read.
+
+    Keyword Arguments:
+        cache_dir (str, None):
+            Directory to keep the binary cache in. If None, only this process's memory cache is used.
+
+    Returns:
+        (ParsedData):
+            The header dictionary (a fresh copy for each call), column names and read-only data array.
+    """
+    key = file_hash(filename)
+    parsed = _memory_cache.pop(key, None)
+    if parsed is None:
+        parsed = _fetch(cache_dir, key)
+    if parsed is None:
+        parsed = _parse(filename)
+        if cache_dir is not None:
+            _store(cache_dir, key, parsed)
+            parsed = _fetch(cache_dir, key) or parsed
+    if parsed.data is not None and not isinstance(parsed.data, np.memmap):
+        parsed.data.flags.writeable = False
+    _memory_cache[key] = parsed  # Most recently used last
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    header = dict(parsed.header) if parsed.header is not None else None
+    return ParsedData(header, list(parsed.columns), parsed.data)
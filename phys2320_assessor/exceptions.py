@@ -41,3 +41,7 @@ class StudentCodeExit(Exception):
 class SecondRunException(Exception):
 
     """Hit a problem when running the standard data."""
+
+class NoRecordingError(Exception):
+
+    """The recorded results needed to replay a student are missing."""
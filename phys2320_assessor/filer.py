@@ -42,7 +42,7 @@ def scan_sbumissions(directory="Student Work"):
     """
     directory = Path(directory)
     # Regexps for the user and date submitted lines in the submission readme
-    user_pat = re.compile(r"Name\:[^\(]+([^\)]+)\)")
+    user_pat = re.compile(r"Name\:[^\(]+\(([^\)]+)\)")
     submitted_pat = re.compile(r"Date\sSubmitted\:\s(.*)")
     # Initialise our list of submissions
     existing = {}
@@ -50,7 +50,7 @@ def scan_sbumissions(directory="Student Work"):
     for readme in directory.rglob("readme.txt"):
         data = readme.read_text()
         submitted = submitted_pat.search(data).group(1).replace("o'clock ", "")
-        submitted = date_parse(submitted)
+        submitted = date_parse(submitted).replace(tzinfo=None)  # Compared with the naive dates in the file names
         user = user_pat.search(data).group(1)
         existing[user] = submitted
     return existing
@@ -78,7 +78,6 @@ def build_submission_list(directory, SUBMISSIION_PATTERN, ignore_existing=False)
     pattern = re.compile(SUBMISSIION_PATTERN)
     files = dict()
     submisisons = scan_sbumissions(directory) if not ignore_existing else {}
-    breakpoint()
     for f in sorted(os.listdir(directory)):
         if match := pattern.match(f):
             print("{} Matched pattern".format(f))
@@ -92,7 +91,6 @@ def build_submission_list(directory, SUBMISSIION_PATTERN, ignore_existing=False)
                 continue
             submisisons[username] = s_date
             files[username] = f
-    breakpoint()
     return files
 
 
@@ -104,6 +102,10 @@ def process_file(readme, clobber):
             Path to the submission description file.
         clobber (bool):
             Whether to clobber existing entries or not.
+
+    Returns:
+        (Path):
+            The folder that the submission was filed into.
     """
     namepat = re.compile(r"Name:\s*([^\(]*)\(([^\)]*)\)")
     readme = Path(readme)
@@ -133,8 +135,8 @@ def process_file(readme, clobber):
     if not pth.exists():
         os.mkdir(pth)
     print(f"Moving {readme} to {pth}/readme.txt")
-    if not pth / "readme.txt".exists():
-        os.rename(readme, pth / "readme.txt")
+    if clobber or not (pth / "readme.txt").exists():  # A newer submission replaces the old submission date
+        os.replace(readme, pth / "readme.txt")
     for src, dest in moves:
         print("Moving {} to {}".format(src, dest))
         if dest.exists() and src.exists():  # Only unlik if the source path also exists!
@@ -145,6 +147,20 @@ def process_file(readme, clobber):
             print(f"Move failed for: {src}")
     if readme.exists():
         os.unlink(readme)  # Remove the readme file if it exists
+    return pth
+
+
+def unzip_file(zipf):
+    """Unzip one Gradebook zip file into the current directory."""
+    with zipfile.ZipFile(zipf, mode="r") as downloaded:
+        print("Extracting Zip File")
+        downloaded.extractall()
+
+
+def unzip_downloads(ASSIGNMENT_DOWNLOAD):
+    """Unzip all the Gradebook zip files matching the glob pattern ASSIGNMENT_DOWNLOAD in the current directory."""
+    for zipf in Path(".").glob(ASSIGNMENT_DOWNLOAD):
+        unzip_file(zipf)
 
 
 def file_work(ASSIGNMENT_DOWNLOAD, SUBMISSIION_PATTERN, clobber=True, directory="Student Work"):
@@ -166,15 +182,34 @@ def file_work(ASSIGNMENT_DOWNLOAD, SUBMISSIION_PATTERN, clobber=True, directory=
     If the same or newer entry has already been unzipped and moved then does nothing.
     """
 
+    for _ in iter_file_work(ASSIGNMENT_DOWNLOAD, SUBMISSIION_PATTERN, clobber=clobber, directory=directory):
+        pass
+
+
+def iter_file_work(ASSIGNMENT_DOWNLOAD, SUBMISSIION_PATTERN, clobber=True, directory="Student Work"):
+    """Run the filing script, yielding each student folder as soon as it has been filed.
+
+    Args:
+        ASSIGNMENT_DOWNLOAD (str):
+            glob pattern for matching Gradbook zip files.
+        SUBMISSIION_PATTERN (str):
+            Regular expression string for matching submission description files
+
+    Keyword Arguments:
+        clobber (bool):
+            Whether to clobber existing files on copy.
+        directory (str):
+            Working directory (default Student Woek)
+
+    Yields:
+        (Path):
+            The folder of each submission that has been filed.
+    """
     os.makedirs(directory, exist_ok=True)
     os.chdir(directory)
-
-    for zipf in Path(".").glob(ASSIGNMENT_DOWNLOAD):
-        with zipfile.ZipFile(zipf, mode="r") as downloaded:
-            print("Extracting Zip File")
-            downloaded.extractall()
+    unzip_downloads(ASSIGNMENT_DOWNLOAD)
 
     print("Processing Files: Building file list")
     files = build_submission_list(os.getcwd(), SUBMISSIION_PATTERN)
     for u, f in files.items():
-        process_file(f, clobber)
+        yield process_file(f, clobber)
@@ -2,17 +2,63 @@
 """Collection of functions for the assessor."""
 
 from collections.abc import Iterable
+from contextlib import contextmanager
 import ast
+import os
+from os import path
+import shutil
+import stat
+import time
 from inspect import isfunction, getmodule
 import builtins as __builtin__
 
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
 import numpy as np
 import matplotlib
+import matplotlib.collections
 from numbers import Number
 
 from . import exceptions as excp
 
+# Code patterns that make student code slow - with the note for the report
+ANTIPATTERNS = {
+    "elementwise_indexing": "A for loop indexes arrays one element at a time - whole array operations are much faster",
+    "array_in_loop": "A numpy array is built or grown (np.append, np.array...) inside a loop - collect a list and convert it once",
+    "repeated_reads": "ProcessData reads its data file more than once (or inside a loop)",
+    "nested_loops": "Loops over the data are nested inside other loops over the data - the time grows as the square of the data size",
+    "fit_in_loop": "Curve fitting is done inside a loop",
+}
+FIT_FUNCTIONS = {"curve_fit", "polyfit", "leastsq", "least_squares", "minimize", "linregress", "lstsq", "odr", "fit"}
+READ_FUNCTIONS = {"open", "loadtxt", "genfromtxt", "read_csv", "read_table", "fromfile", "load", "read_user_data"}
+ARRAY_FUNCTIONS = {"append", "array", "asarray", "concatenate", "vstack", "hstack", "column_stack", "insert"}
+
+
+def _names(node):
+    """Return the names used in a simple index expression such as i, (i, j) or i+1."""
+    if isinstance(node, ast.Name):
+        return {node.id}
+    if isinstance(node, ast.Tuple):
+        return set().union(*[_names(elt) for elt in node.elts])
+    if isinstance(node, ast.BinOp):
+        return _names(node.left) | _names(node.right)
+    if isinstance(node, ast.UnaryOp):
+        return _names(node.operand)
+    return set()
+
+
 class Inspector(ast.NodeVisitor):
+
+    """Look through the student's code for things that will cause problems when it is marked.
+
+    The code is checked in one pass over its syntax tree. As well as the problems printed as they are found, the
+    performance anti-patterns in :py:data:`ANTIPATTERNS` are collected in the antipatterns attribute - a dictionary of
+    pattern name to the line numbers it was found at - and summarised at the end.
+    """
+
     def __init__(self, *args, **kargs):
         self.closes = False
         self.uses_with = False
@@ -29,18 +75,95 @@ class Inspector(ast.NodeVisitor):
         self.split_parameter = True
         self.split_constant = False
         self.processdata = False
+        self.antipatterns = {}
+        self.numpy = {"np", "numpy"}  # Names numpy is imported as
+        self.from_numpy = set()  # Array functions imported from numpy
+        self._loops = []  # (node, index variables, over data, flagged) for each loop around the current node
+        self._scope = []  # Function definitions around the current node
+        self._reads = []  # Lines where ProcessData reads its file
 
         if len(args) > 0 and isinstance(args[0], str):
             with open(args[0], "r", errors="ignore") as mod_file:
                 self.tree = ast.parse(mod_file.read())
                 print("<h3>Notes form inspecting the code.</h3>\n<ul>")
                 self.visit(self.tree)
+                self.report_antipatterns()
                 print("</ul>\n<p>Finsihed checking Student code for potential issues.</p>")
             if not self.processdata:
                 raise excp.NoProcessDataError("ProcessData function either not found or not defined correctly - autograder will fail!")
             if self.input:
                 raise excp.RawInputFound("The code used the input() function outside the if __name__=='__main__' block. This is likely to cause the grader to crash.")
 
+    def found(self, pattern, node):
+        """Record a performance anti-pattern at node."""
+        self.antipatterns.setdefault(pattern, []).append(getattr(node, "lineno", 0))
+
+    def report_antipatterns(self):
+        """Print a summary of the performance anti-patterns found."""
+        if len(self._reads) > 1:
+            for line in self._reads[1:]:
+                self.antipatterns.setdefault("repeated_reads", []).append(line)
+        for pattern, lines in self.antipatterns.items():
+            lines = self.antipatterns[pattern] = sorted(set(lines))
+            print(
+                f"<li><b>Performance:</b> {ANTIPATTERNS[pattern]} - line{'s' if len(lines) > 1 else ''} "
+                + f"{', '.join(str(line) for line in lines)}.</li>"
+            )
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == "numpy":
+                self.numpy.add(alias.asname or alias.name)
+        self.generic_visit(node)
+
+    def visit_ImportFrom(self, node):
+        if node.module == "numpy":
+            for alias in node.names:
+                if alias.name in ARRAY_FUNCTIONS:
+                    self.from_numpy.add(alias.asname or alias.name)
+        self.generic_visit(node)
+
+    def _data_loop(self, node):
+        """Return the index variables of a for loop over range(len(...)) and whether it loops over data at all."""
+        it = node.iter
+        if isinstance(it, (ast.List, ast.Tuple, ast.Set, ast.Dict, ast.Constant)):
+            return set(), False
+        if isinstance(it, ast.Call) and isinstance(it.func, ast.Name) and it.func.id == "range":
+            if all(isinstance(arg, ast.Constant) for arg in it.args):
+                return set(), False
+            return _names(node.target), True
+        return set(), True
+
+    def _visit_loop(self, node, index=(), data=False):
+        """Visit the inside of a loop, keeping track of the loops around it."""
+        if data and any(over_data for _, _, over_data, _ in self._loops):
+            self.found("nested_loops", node)
+        self._loops.append([node, set(index), data, False])
+        self.generic_visit(node)
+        self._loops.pop()
+
+    def visit_For(self, node):
+        index, data = self._data_loop(node)
+        self._visit_loop(node, index, data)
+
+    visit_AsyncFor = visit_For
+
+    def visit_While(self, node):
+        self._visit_loop(node)
+
+    def visit_ListComp(self, node):
+        self._visit_loop(node)
+
+    visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_Subscript(self, node):
+        used = _names(node.slice)
+        for loop in self._loops:
+            if not loop[3] and loop[1] & used:
+                loop[3] = True  # Only report each loop once
+                self.found("elementwise_indexing", loop[0])
+        self.generic_visit(node)
+
     def visit_FunctionDef(self, node):
         if not hasattr(node,"name"):
             return
@@ -53,7 +176,11 @@ class Inspector(ast.NodeVisitor):
             else:
                 self.processdata=True
 
+        loops, self._loops = self._loops, []  # The body of a function doesn't run in the loop that defines it
+        self._scope.append(node.name)
         self.generic_visit(node)
+        self._scope.pop()
+        self._loops = loops
 
     def visit_arguments(self, node):
         if not hasattr(node,"args"):
@@ -75,11 +202,18 @@ class Inspector(ast.NodeVisitor):
     def visit_If(self, node):
         if not hasattr(node,"test"):
             return
-        if not (isinstance(node.test,ast.Expr) and node.test.left.id=="__name__" and isinstance(node.test.comparators[0],ast.Str) and node.test.comparators[0].s=="__main__"):
+        test = node.test
+        if not (
+            isinstance(test, ast.Compare)
+            and isinstance(test.left, ast.Name)
+            and test.left.id == "__name__"
+            and isinstance(test.comparators[0], ast.Constant)
+            and test.comparators[0].value == "__main__"
+        ):
             self.generic_visit(node) # If this If is not the guard at the end of the script continue processing
 
     def visit_Assign(self, node):
-        if not hasattr(node,"targs"):
+        if not hasattr(node,"targets"):
             return
         for target in node.targets:
             if hasattr(target, "id") and target.id in dir(__builtin__):
@@ -121,6 +255,22 @@ class Inspector(ast.NodeVisitor):
         if call_name == "print":
             print("<li>Code uses print  but there's no screeen to print to!</li>")
             self.prints = True
+        if self._loops:
+            if call_name in FIT_FUNCTIONS:
+                self.found("fit_in_loop", node)
+            numpy_call = (
+                isinstance(node.func, ast.Attribute)
+                and isinstance(node.func.value, ast.Name)
+                and node.func.value.id in self.numpy
+            )
+            if call_name in ARRAY_FUNCTIONS and numpy_call or call_name in self.from_numpy:
+                self.found("array_in_loop", node)
+        if call_name in READ_FUNCTIONS and self._scope and self._scope[0] == "ProcessData":
+            args = list(node.args) + [keyword.value for keyword in node.keywords]
+            if any(isinstance(arg, ast.Name) and arg.id == "filename" for arg in args):
+                self._reads.append(node.lineno)
+                if self._loops:
+                    self.found("repeated_reads", node)
         if call_name == "open":
             self.has_open = True
             if not self.uses_with:
@@ -313,6 +463,87 @@ def touch(pth):
         pass
 
 
+FICLONE = 0x40049409  # Linux ioctl to share the extents of a file (btrfs, xfs etc.)
+
+
+@contextmanager
+def file_lock(lockfile, poll=0.1):
+    """Hold an exclusive lock on lockfile for the duration of the with block.
+
+    Uses fcntl.flock where available, otherwise falls back to exclusively creating the lock file and removing it when
+    done.
+    """
+    if fcntl is not None:
+        with open(lockfile, "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        return
+    while True:
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            time.sleep(poll)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.unlink(lockfile)
+
+
+def _reflink(src, dest):
+    """Make dest a copy-on-write clone of src, raising OSError if the filesystem can't do it."""
+    if fcntl is None or not hasattr(fcntl, "ioctl"):
+        raise OSError("reflinks not supported")
+    try:
+        with open(src, "rb") as source, open(dest, "wb") as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError:
+        if path.exists(dest):
+            os.unlink(dest)
+        raise
+
+
+def place_file(src, dest, read_only=True):
+    """Put the file src at dest by hardlinking, reflinking or copying - whichever works first.
+
+    Args:
+        src (str):
+            Existing file.
+        dest (str):
+            Where it should appear - any existing file is replaced.
+
+    Keyword Arguments:
+        read_only (bool):
+            Remove the write permissions from dest (and hence from src as well if it was hardlinked).
+
+    Returns:
+        (str):
+            One of *link*, *reflink*, *copy* describing how the file was placed.
+    """
+    if path.exists(dest):
+        if path.samefile(src, dest):
+            return "link"
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+        how = "link"
+    except OSError:
+        try:
+            _reflink(src, dest)
+            how = "reflink"
+        except OSError:
+            shutil.copyfile(src, dest)
+            how = "copy"
+    if read_only:
+        mode = os.stat(dest).st_mode
+        os.chmod(dest, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    return how
+
+
 def open_figures():
     return [
         manager.canvas.figure
@@ -320,10 +551,60 @@ def open_figures():
     ]
 
 
+def thin_figure(fig, max_points):
+    """Thin out any plotted lines or point collections in fig that have more than max_points points.
+
+    Every n'th point is kept so that the plot keeps its shape but renders quickly.
+
+    Returns:
+        (int, int):
+            The number of artists thinned and the number of points dropped.
+    """
+    artists = dropped = 0
+    for ax in fig.get_axes():
+        for line in ax.get_lines():
+            xdata, ydata = (np.asarray(data) for data in line.get_data(orig=True))
+            if xdata.size <= max_points or xdata.shape != ydata.shape:
+                continue
+            step = -(-xdata.size // max_points)
+            line.set_data(xdata[::step], ydata[::step])
+            artists += 1
+            dropped += xdata.size - xdata[::step].size
+        for collection in ax.collections:
+            if isinstance(collection, matplotlib.collections.LineCollection):
+                segments = collection.get_segments()
+                if len(segments) > max_points:
+                    step = -(-len(segments) // max_points)
+                    collection.set_segments(segments[::step])
+                    artists += 1
+                    dropped += len(segments) - len(segments[::step])
+                continue
+            offsets = collection.get_offsets()
+            points = len(offsets)
+            if points <= max_points:
+                continue
+            step = -(-points // max_points)
+            collection.set_offsets(offsets[::step])
+            values = collection.get_array()
+            if values is not None and len(values) == points:
+                collection.set_array(values[::step])
+            for getter, setter in [
+                (collection.get_sizes, collection.set_sizes),
+                (collection.get_facecolor, collection.set_facecolor),
+                (collection.get_edgecolor, collection.set_edgecolor),
+            ]:
+                values = getter()
+                if len(values) == points:
+                    setter(values[::step])
+            artists += 1
+            dropped += points - len(offsets[::step])
+    return artists, dropped
+
+
 def parse_code(filename):
-    """Read the source code and try to parse."""
+    """Read the source code and try to parse, returning the :py:class:`Inspector`."""
     try:
-        Inspector(filename)
+        return Inspector(filename)
     except Exception as err:
         raise IOError(
             f"Failed to open source code to check for dangerouts functions. Error was {err}"
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""An append-only journal of the progress of a cohort run so that a crashed run can be resumed.
+
+Each line of the journal file is a JSON record of one student's stage starting, finishing or failing. Records are
+written with a single append and fsync so that a crash can at worst leave a truncated last line - which is ignored
+when reading back. When a stage finishes the pickled state of the student's Assessor is written alongside the journal
+(via a temporary file and an atomic rename) so a resumed run can carry on from it.
+"""
+import json
+import logging
+import os
+from os import path
+import pickle
+import tempfile
+import time
+
+__all__ = ["RunJournal"]
+
+log = logging.getLogger(__name__)
+
+
+class RunJournal(object):
+
+    """Record and read back the stages completed for each student in a cohort run."""
+
+    def __init__(self, directory=".", name="run_journal.jsonl"):
+        """Open (or create) the journal in directory.
+
+        Keyword Arguments:
+            directory (str):
+                The cohort directory.
+            name (str):
+                File name of the journal - the pickled states are kept in a folder of the same name without the
+                extension.
+        """
+        self.filename = path.realpath(path.join(directory, name))
+        self.state_dir = path.splitext(self.filename)[0]
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _append(self, entry):
+        """Append one record to the journal."""
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def new_run(self):
+        """Mark the start of a fresh run - earlier records are ignored when resuming."""
+        self._append({"student": None, "stage": "run", "status": "start", "time": time.time()})
+
+    def record(self, subdir, stage, status="done", assessor=None, elapsed=None, message=None, **extra):
+        """Record a stage event for a student.
+
+        Args:
+            subdir (str):
+                The student's folder.
+            stage (str):
+                Name of the stage, e.g. file, mark or pdf.
+
+        Keyword Arguments:
+            status (str):
+                *start*, *done* or *failed*.
+            assessor (Assessor, None):
+                If given, the Assessor's state is pickled so the run can be resumed from this point.
+            elapsed (float, None):
+                How long the stage took in seconds.
+            message (str, None):
+                Error message for failed stages.
+
+        Other keyword arguments are stored in the record as they are. The record is also logged at DEBUG level with the
+        record as its event, which is how :py:class:`progress.RunMonitor` follows the run.
+        """
+        student = path.basename(path.realpath(subdir))
+        entry = {"student": student, "stage": stage, "status": status, "time": time.time()}
+        if elapsed is not None:
+            entry["elapsed"] = elapsed
+        if message is not None:
+            entry["message"] = message
+        entry.update(extra)
+        if assessor is not None:
+            fd, tmp = tempfile.mkstemp(dir=self.state_dir, prefix=student, suffix=".tmp")
+            with os.fdopen(fd, "wb") as state:
+                pickle.dump(assessor, state)
+                state.flush()
+                os.fsync(state.fileno())
+            entry["state"] = f"{student}.{stage}.pkl"
+            os.replace(tmp, path.join(self.state_dir, entry["state"]))
+        self._append(entry)
+        log.debug(f"{stage} {status} for {student}", extra={"event": entry})
+
+    def entries(self, current=True):
+        """Return the journal records.
+
+        Keyword Arguments:
+            current (bool):
+                Only return the records since the start of the most recent run.
+
+        Returns:
+            (list of dict):
+                The journal records in the order they were written.
+        """
+        entries = []
+        if not path.exists(self.filename):
+            return entries
+        with open(self.filename, "r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # Truncated line from a crash
+                    continue
+                if current and entry.get("stage") == "run":
+                    entries = []
+                    continue
+                entries.append(entry)
+        return entries
+
+    def progress(self):
+        """Summarise the current run.
+
+        Returns:
+            (dict):
+                Mapping of student folder name to a dictionary of stage name to a tuple of (status, number of starts).
+        """
+        progress = {}
+        for entry in self.entries():
+            stages = progress.setdefault(entry["student"], {})
+            status, starts = stages.get(entry["stage"], (None, 0))
+            if entry["status"] == "start":
+                starts += 1
+            if status != "done":
+                status = entry["status"]
+            stages[entry["stage"]] = (status, starts)
+        return progress
+
+    def completed(self, stage):
+        """Return the set of student folder names that have finished stage in the current run."""
+        return {student for student, stages in self.progress().items() if stages.get(stage, (None,))[0] == "done"}
+
+    def timings(self):
+        """Return a dictionary of student folder name to a dictionary of stage name to elapsed time, across all runs."""
+        timings = {}
+        for entry in self.entries(current=False):
+            if entry.get("status") == "done" and "elapsed" in entry:
+                timings.setdefault(entry["student"], {})[entry["stage"]] = entry["elapsed"]
+        return timings
+
+    def state(self, subdir, stage):
+        """Return the Assessor saved when subdir finished stage, or None if there isn't one."""
+        student = path.basename(path.realpath(subdir))
+        state = path.join(self.state_dir, f"{student}.{stage}.pkl")
+        if not path.exists(state):
+            return None
+        with open(state, "rb") as data:
+            return pickle.load(data)
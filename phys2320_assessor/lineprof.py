@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Count how often each line of the student's code runs and roughly how long it takes, and show it as a heat map.
+
+On Python 3.12 and later the profiler uses :py:mod:`sys.monitoring`: line events are only turned on for the student's
+own file (every other code location is disabled the first time it is seen), so numpy, scipy and the rest run at full
+speed. Older Pythons fall back to :py:func:`sys.settrace`, which is slower but gives the same answers. The time between
+one line event and the next is charged to the first line, so a line that calls into a library is charged for the
+library call.
+"""
+import sys
+from time import perf_counter
+
+import pygments
+import pygments.lexers
+import pygments.formatters.html
+
+__all__ = ["LineProfiler", "heat_map"]
+
+_monitoring = getattr(sys, "monitoring", None)
+
+
+class LineProfiler(object):
+
+    """Context manager that profiles the lines of one source file while it is active."""
+
+    def __init__(self, filename):
+        """Profile the code whose co_filename is filename."""
+        self.filename = filename
+        self.hits = {}
+        self.times = {}
+        self._line = None
+        self._last = None
+        self._tool = None
+
+    def _hit(self, line):
+        """Record a line event, charging the time since the last one to the last line."""
+        now = perf_counter()
+        if self._line is not None:
+            self.times[self._line] = self.times.get(self._line, 0.0) + now - self._last
+        self.hits[line] = self.hits.get(line, 0) + 1
+        self._line = line
+        self._last = perf_counter()
+
+    def _monitor(self, code, line):
+        """sys.monitoring LINE callback."""
+        if code.co_filename != self.filename:
+            return _monitoring.DISABLE
+        self._hit(line)
+
+    def _trace(self, frame, event, arg):
+        """sys.settrace global trace function - only trace frames in the file."""
+        if frame.f_code.co_filename != self.filename:
+            return None
+        return self._trace_lines
+
+    def _trace_lines(self, frame, event, arg):
+        """sys.settrace local trace function."""
+        if event == "line":
+            self._hit(frame.f_lineno)
+        return self._trace_lines
+
+    def __enter__(self):
+        """Start profiling."""
+        if _monitoring is not None and _monitoring.get_tool(_monitoring.PROFILER_ID) is None:
+            self._tool = _monitoring.PROFILER_ID
+            _monitoring.use_tool_id(self._tool, "phys2320_assessor")
+            _monitoring.register_callback(self._tool, _monitoring.events.LINE, self._monitor)
+            _monitoring.set_events(self._tool, _monitoring.events.LINE)
+        else:  # Older python, or something else is using the profiler slot
+            sys.settrace(self._trace)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Stop profiling and charge the time so far to the last line."""
+        if self._tool is not None:
+            _monitoring.set_events(self._tool, 0)
+            _monitoring.register_callback(self._tool, _monitoring.events.LINE, None)
+            _monitoring.free_tool_id(self._tool)
+            _monitoring.restart_events()  # Re-enable the locations disabled while profiling
+            self._tool = None
+        else:
+            sys.settrace(None)
+        if self._line is not None:
+            self.times[self._line] = self.times.get(self._line, 0.0) + perf_counter() - self._last
+            self._line = None
+
+    @property
+    def profile(self):
+        """Dictionary of line number to (hits, seconds)."""
+        return {line: (hits, self.times.get(line, 0.0)) for line, hits in self.hits.items()}
+
+
+def heat_map(code, profile, noclasses=True, style="xcode"):
+    """Return html for the highlighted code with each line's hits and time, shaded by the time spent on it.
+
+    Args:
+        code (str):
+            The source code.
+        profile (dict):
+            Mapping of line number to (hits, seconds) from :py:attr:`LineProfiler.profile`.
+
+    Keyword Arguments:
+        noclasses (bool):
+            Use inline styles for the highlighting rather than classes from a shared stylesheet.
+        style (str):
+            pygments style.
+
+    Returns:
+        (str):
+            An html table with a row per line.
+    """
+    lexer = pygments.lexers.get_lexer_by_name("Python", stripnl=False, ensurenl=True)
+    formatter = pygments.formatters.html.HtmlFormatter(noclasses=noclasses, nowrap=True, style=style)
+    lines = pygments.highlight(code, lexer, formatter).split("\n")
+    total = sum(seconds for _, seconds in profile.values()) or 1.0
+    hottest = max([seconds for _, seconds in profile.values()] + [1e-12])
+    rows = ['<div class="highlight"><table class="heatmap">']
+    rows.append("<tr><th>Line</th><th>Hits</th><th>Time</th><th>%</th><th>Code</th></tr>")
+    for ix, html in enumerate(lines[: len(code.splitlines())], start=1):
+        hits, seconds = profile.get(ix, (0, 0.0))
+        shade = f' style="background-color: rgba(255, 69, 0, {0.6 * seconds / hottest:.2f});"' if hits else ""
+        stats = f"<td>{hits}</td><td>{1000*seconds:.2f}ms</td><td>{100*seconds/total:.1f}</td>" if hits else "<td></td>" * 3
+        rows.append(f'<tr{shade}><td>{ix}</td>{stats}<td class="code">{html}</td></tr>')
+    rows.append("</table></div>")
+    return "\n".join(rows)
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""Run the file, mark and pdf stages over a cohort, streaming students from one stage to the next."""
+import os
+from os import path
+import importlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter
+from traceback import format_exc
+
+from .cohort import ComputingClass
+from .filer import unzip_downloads, build_submission_list, process_file
+from .journal import RunJournal
+from .progress import RunMonitor
+from .workers import make_pool, calibrate
+
+log = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 2  # A student who has killed this many workers is not tried again when resuming
+
+
+def load_class(spec):
+    """Import and return the Assessor subclass named by spec.
+
+    Args:
+        spec (str):
+            A string of the form *module:ClassName* (or *module.ClassName*) naming the year's Assessor subclass.
+
+    Returns:
+        (type):
+            The Assessor subclass.
+    """
+    if ":" in spec:
+        mod_name, cls_name = spec.split(":", 1)
+    else:
+        mod_name, _, cls_name = spec.rpartition(".")
+    if not mod_name or not cls_name:
+        raise ValueError(f"Unable to interpret {spec} as module:ClassName")
+    return getattr(importlib.import_module(mod_name), cls_name)
+
+
+def mark_student(assessor, journal=None, host=None):
+    """Run the tests for one student in a worker process and return the marked Assessor.
+
+    If a RunJournal is given, the start and end of marking are recorded in it from the worker so that a student
+    whose code brings down the worker can be identified when resuming. The host's calibration time (host - from
+    :py:func:`workers.calibrate`, run once by the parent rather than in every fresh worker) is recorded with the
+    timings so they can be compared between hosts. If host is None the worker calibrates itself.
+    """
+    if journal is not None:
+        journal.record(assessor.subdir, "mark", "start")
+    if host is None:
+        with assessor.timing():  # Calibrate under the same conditions as the timed runs
+            host = calibrate()
+    assessor.host = host
+    start = perf_counter()
+    assessor.test()
+    if journal is not None:
+        journal.record(
+            assessor.subdir,
+            "mark",
+            assessor=assessor,
+            elapsed=perf_counter() - start,
+            student_time=getattr(assessor, "student_time", None),
+            model_time=getattr(assessor, "model_time", None),
+            **assessor.host,
+        )
+    return assessor
+
+
+def pdf_student(assessor, refresh=False, journal=None):
+    """Create the pdf report for one student in a worker process.
+
+    Args:
+        assessor (Assessor):
+            The (marked) student assessor.
+
+    Keyword Arguments:
+        refresh (bool):
+            If True, re-read the submission folder first - needed when the student has not just been marked.
+        journal (RunJournal, None):
+            If given, record the pdf stage in the journal.
+
+    Returns:
+        (Assessor):
+            The student assessor.
+    """
+    if journal is not None:
+        journal.record(assessor.subdir, "pdf", "start")
+    start = perf_counter()
+    if refresh:
+        assessor.get_info()
+    assessor.create_pdf()
+    if journal is not None:
+        journal.record(assessor.subdir, "pdf", elapsed=perf_counter() - start)
+    return assessor
+
+
+def _describe(assessor, subdir):
+    """Return a short description of a student for progress messages."""
+    if assessor is not None and assessor.issid is not None:
+        return f"{assessor.name} ({assessor.issid})"
+    return path.basename(subdir)
+
+
+def run_pipeline(
+    student_class,
+    download=None,
+    pattern=None,
+    directory="Student Work",
+    clobber=True,
+    file_workers=1,
+    mark_workers=1,
+    pdf_workers=1,
+    restart=False,
+    ignore_skip=False,
+    pdf=True,
+    prepare=True,
+    triage=True,
+    resume=False,
+    settings=None,
+    start_method="forkserver",
+    threads=1,
+    pin=False,
+    metrics=None,
+):
+    """File, mark and pdf a cohort, passing each student on to the next stage as soon as they are ready.
+
+    Args:
+        student_class (type):
+            The year's Assessor subclass.
+
+    Keyword Arguments:
+        download (str, None):
+            glob pattern for matching Gradebook zip files. If None, skip the filing stage.
+        pattern (str, None):
+            Regular expression string for matching submission description files.
+        directory (str):
+            Working directory (default Student Work)
+        clobber (bool):
+            Whether to clobber existing files when filing.
+        file_workers, mark_workers, pdf_workers (int):
+            How many students can be in each stage at once.
+        restart (bool):
+            Passed to ComputingClass - keep the existing function signatures table.
+        ignore_skip (bool):
+            Passed to ComputingClass - mark students even if they have a skip file.
+        pdf (bool):
+            Whether to run the pdf stage.
+        prepare (bool):
+            Generate the missing standard data files for the students already filed before marking starts.
+        triage (bool):
+            Run the pre-flight checks on the students already filed - those that can't be run are failed straight away
+            and the rest are marked longest first (see :py:func:`triage.triage_cohort`).
+        resume (bool):
+            Carry on from the run journal of a run that stopped part way through. Stages that the journal shows as
+            finished are not re-run and the function signatures table is kept.
+        settings (dict, None):
+            Assessor attributes to override for every student, e.g. {"report_assets": "shared"}.
+        start_method (str):
+            multiprocessing start method for the worker pools - see :py:func:`workers.make_pool`.
+        threads (int, None):
+            Most BLAS/OpenMP threads each worker may use.
+        pin (bool):
+            Pin each marking worker to a core of its own.
+        metrics (str, None):
+            Name of a Prometheus textfile to keep up to date with the run's counters.
+
+    Returns:
+        (dict):
+            Mapping of student folder to the last stage completed, or an error message.
+
+    Students filed by this run are marked as soon as their folder is ready, all other students that
+    ComputingClass thinks still need marking are queued once filing has finished.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    cohort = ComputingClass(
+        ".", student_class=student_class, restart=restart or resume, ignore_skip=ignore_skip, settings=settings
+    )
+    journal = RunJournal(".")
+    if resume:
+        progress = journal.progress()
+    else:
+        journal.new_run()
+        progress = {}
+    # The workers log to the monitor, which keeps the run's status file and run log up to date
+    monitor = RunMonitor(
+        ".",
+        stages=("mark", "pdf") if pdf else ("mark",),
+        workers={"mark": mark_workers, "pdf": pdf_workers},
+        journal=journal,
+        metrics=metrics,
+        start_method=start_method,
+    ).start()
+    try:
+        if prepare:
+            cohort.prepare_std_data(workers=mark_workers)
+        outcome = {}
+        order = []
+        if triage:
+            report = cohort.triage(workers=mark_workers, journal=journal)
+            outcome.update({subdir: f"triage failed: {message}" for subdir, message in report.failures.items()})
+            order = report.order
+    except BaseException:
+        monitor.stop()
+        raise
+    host = calibrate()  # Once for the run - marking workers are fresh processes that would each calibrate again
+    stages = {}
+    pending = set()
+    # Students who were running when a worker died are retried on their own in the quarantine pool.
+    sizes = {"mark": mark_workers, "quarantine": 1, "pdf": pdf_workers}
+    pools = {}
+
+    def pool(name):
+        if name not in pools:
+            pools[name] = make_pool(
+                sizes[name],
+                [student_class.__module__],
+                isolate=name != "pdf",
+                start_method=start_method,
+                threads=threads,
+                pin=pin and name != "pdf",
+                log_queue=monitor.queue,
+            )
+        return pools[name]
+
+    def retire(name, executor):
+        """Shut down a broken executor - unless it has already been replaced, when the new one is left running."""
+        if pools.get(name) is executor:
+            pools.pop(name).shutdown(wait=False)
+
+    def queue_pdf(assessor, subdir):
+        executor = pool("pdf")
+        future = executor.submit(pdf_student, assessor, journal=journal)
+        stages[future] = ("pdf", subdir, executor)
+        pending.add(future)
+
+    def queue_mark(subdir, lane="mark", retry=False):
+        subdir = path.realpath(subdir)
+        if subdir in outcome and not retry:
+            return
+        done = progress.get(path.basename(subdir), {})
+        status, starts = done.get("mark", (None, 0))
+        if status == "done":
+            outcome[subdir] = "marked"
+            assessor = journal.state(subdir, "mark")
+            if pdf and done.get("pdf", (None,))[0] != "done" and assessor is not None:
+                queue_pdf(assessor, subdir)
+            return
+        if starts >= MAX_ATTEMPTS:
+            log.warning(f"Not marking {path.basename(subdir)} again - it stopped the worker {starts} times.")
+            outcome[subdir] = f"mark failed: stopped the worker {starts} times"
+            return
+        if starts > 0:
+            lane = "quarantine"
+        outcome[subdir] = "queued"
+        monitor.expect(subdir)
+        executor = pool(lane)
+        try:
+            future = executor.submit(mark_student, cohort.make_student(subdir), journal, host)
+        except IOError as err:
+            outcome[subdir] = f"mark failed: {err}"
+            return
+        stages[future] = (lane, subdir, executor)
+        pending.add(future)
+
+    def worker_stopped(stage, subdir, executor):
+        """A worker process died - replace the pool and requeue the student."""
+        retire(stage, executor)
+        progress.update(journal.progress())
+        if progress.get(path.basename(subdir), {}).get("mark", (None,))[0] == "start":
+            journal.record(subdir, "mark", "failed", message="Worker process stopped")
+        queue_mark(subdir, stage, retry=True)
+
+    try:
+        with ThreadPoolExecutor(max(file_workers, 1)) as filer:
+            if download is not None:
+                unzip_downloads(download)
+                log.info("Processing Files: Building file list")
+                for readme in build_submission_list(os.getcwd(), pattern).values():
+                    future = filer.submit(process_file, readme, clobber)
+                    stages[future] = ("file", readme, filer)
+                    pending.add(future)
+            filing = True
+
+            while pending or filing:
+                if filing and not any(stages[f][0] == "file" for f in pending):
+                    filing = False
+                    for subdir in order:
+                        queue_mark(subdir)
+                    for subdir, do in zip(cohort.subdirs, cohort.noskip):
+                        if do or path.basename(path.realpath(subdir)) in progress:
+                            queue_mark(subdir)
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    stage, subdir, executor = stages.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        if stage == "pdf":
+                            retire("pdf", executor)
+                            outcome[subdir] = "pdf failed: worker process stopped"
+                            journal.record(subdir, "pdf", "failed", message="Worker process stopped")
+                        else:
+                            worker_stopped(stage, subdir, executor)
+                        continue
+                    except Exception as err:
+                        log.error(f"{stage} stage failed for {path.basename(subdir)}: {err}\n{format_exc()}")
+                        outcome[path.realpath(subdir)] = f"{stage} failed: {err}"
+                        if stage != "file":
+                            journal.record(subdir, "mark" if stage == "quarantine" else stage, "failed", message=str(err))
+                        continue
+                    if stage == "file":
+                        log.info(f"Filed {result}")
+                        journal.record(result, "file")
+                        queue_mark(result)
+                    elif stage in ["mark", "quarantine"]:
+                        log.info(f"Marked {_describe(result, subdir)}")
+                        outcome[subdir] = "marked"
+                        if pdf:
+                            queue_pdf(result, subdir)
+                    else:
+                        log.info(f"Created pdf for {_describe(result, subdir)}")
+                        outcome[subdir] = "pdf"
+    finally:
+        for executor in pools.values():
+            executor.shutdown()
+        monitor.stop()
+
+    cohort.close()
+    return outcome
+
+
+def mark_cohort(
+    student_class,
+    directory=".",
+    workers=1,
+    restart=False,
+    ignore_skip=False,
+    prepare=True,
+    triage=True,
+    resume=False,
+    settings=None,
+    start_method="forkserver",
+    threads=1,
+    pin=False,
+    metrics=None,
+):
+    """Mark all the students in directory that still need marking using a pool of worker processes."""
+    return run_pipeline(
+        student_class,
+        directory=directory,
+        mark_workers=workers,
+        restart=restart,
+        ignore_skip=ignore_skip,
+        pdf=False,
+        prepare=prepare,
+        triage=triage,
+        resume=resume,
+        settings=settings,
+        start_method=start_method,
+        threads=threads,
+        pin=pin,
+        metrics=metrics,
+    )
+
+
+def pdf_cohort(student_class, directory=".", workers=1, settings=None, start_method="forkserver"):
+    """Create the pdf reports for all the marked students in directory using a pool of worker processes."""
+    os.chdir(directory)
+    cohort = ComputingClass(".", student_class=student_class, restart=True, ignore_skip=True, settings=settings)
+    outcome = {}
+    with make_pool(workers, [student_class.__module__], isolate=False, start_method=start_method) as pdfer:
+        futures = {}
+        for subdir in cohort.subdirs:
+            if not path.exists(path.join(subdir, "results.html")):
+                continue
+            futures[pdfer.submit(pdf_student, cohort.make_student(subdir), True)] = subdir
+        for future in futures:
+            subdir = path.realpath(futures[future])
+            try:
+                log.info(f"Created pdf for {_describe(future.result(), subdir)}")
+                outcome[subdir] = "pdf"
+            except Exception as err:
+                log.error(f"pdf stage failed for {path.basename(subdir)}: {err}")
+                outcome[subdir] = f"pdf failed: {err}"
+    cohort.close()
+    return outcome
+
+
+def replay_student(assessor):
+    """Re-run the comparisons and rewrite the report for one student from their recorded stages."""
+    assessor.replay = True
+    assessor.test()
+    return assessor
+
+
+def replay_cohort(student_class, directory=".", workers=1, settings=None, start_method="forkserver"):
+    """Re-compare and re-write the reports for the cohort from the recorded stages, without running any code.
+
+    The raw returns of the student and model code and the calculated answers recorded when each student was marked
+    (see :py:attr:`Assessor.stages`) are passed through sanitize_student_answers, normalise_entry and compare again,
+    so changes to these can be applied to the whole cohort in minutes. Students without a complete recording - e.g.
+    because their code failed - are left alone.
+
+    Returns:
+        (dict):
+            Mapping of student folder to outcome.
+    """
+    os.chdir(directory)
+    cohort = ComputingClass(".", student_class=student_class, restart=True, ignore_skip=True, settings=settings)
+    outcome = {}
+    with make_pool(workers, [student_class.__module__], isolate=False, start_method=start_method) as replayer:
+        futures = {}
+        for subdir in cohort.subdirs:
+            assessor = cohort.make_student(subdir)
+            if not assessor.can_replay():
+                outcome[path.realpath(subdir)] = "not recorded"
+                continue
+            futures[replayer.submit(replay_student, assessor)] = path.realpath(subdir)
+        for future in futures:
+            subdir = futures[future]
+            try:
+                log.info(f"Replayed {_describe(future.result(), subdir)}")
+                outcome[subdir] = "replayed"
+            except Exception as err:
+                log.error(f"replay failed for {path.basename(subdir)}: {err}")
+                outcome[subdir] = f"replay failed: {err}"
+    cohort.close()
+    return outcome
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""Live progress, an estimated finish time and a structured log for a cohort run.
+
+Once students are marked in parallel, lines printed by the workers get interleaved or lost. Instead, the workers' log
+records are put on a multiprocessing queue (given to each worker by :py:func:`workers.make_pool`) and a
+:py:class:`RunMonitor` in the parent takes them off one at a time. Each record is printed, appended as a line of JSON
+to the run log and - since :py:meth:`journal.RunJournal.record` logs every stage starting, finishing or failing as an
+event - used to keep track of which students are done, running and failed.
+
+The monitor rewrites a small status file every few seconds, which ``phys2320 status`` prints. The estimated time left
+comes from a rolling window of each stage's recent times (seeded from the journal's earlier runs), shared out over the
+stage's workers longest first as in :py:func:`triage.estimate_runtime`. It can also write the counters in the
+Prometheus text format, for the node exporter's textfile collector.
+"""
+from collections import Counter, deque
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+from os import path
+import sys
+import tempfile
+import threading
+import time
+
+from .triage import DEFAULT_MARK_TIME, estimate_runtime
+from .workers import get_context
+
+__all__ = ["STATUS_FILE", "LOG_FILE", "JsonLineHandler", "RunMonitor", "read_status", "format_status"]
+
+STATUS_FILE = "run_status.json"
+LOG_FILE = "run_log.jsonl"
+LOGGER = "phys2320_assessor"  # Every module logs under the package's logger
+WINDOW = 20  # Recent times per stage used for the estimate
+RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def _write_atomic(filename, text):
+    """Replace filename with text, so that readers never see a half-written file."""
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(filename) or ".", prefix=".tmp", suffix=path.basename(filename))
+    with os.fdopen(fd, "w", encoding="utf-8") as data:
+        data.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, filename)
+
+
+class JsonLineHandler(logging.Handler):
+
+    """Append each log record to a file as a line of JSON."""
+
+    def __init__(self, filename):
+        """Open filename for appending."""
+        super().__init__()
+        self.stream = open(filename, "a", encoding="utf-8")
+
+    def emit(self, record):
+        """Write the record with its time, level, process, logger, message and any extra fields."""
+        try:
+            entry = {
+                "time": record.created,
+                "level": record.levelname,
+                "process": record.process,
+                "logger": record.name,
+                "message": record.getMessage(),
+            }
+            entry.update({key: value for key, value in vars(record).items() if key not in RECORD_ATTRS})
+            self.stream.write(json.dumps(entry, default=str) + "\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """Close the file."""
+        self.stream.close()
+        super().close()
+
+
+class RunMonitor(logging.Handler):
+
+    """Gather the log records of a cohort run from all its workers and keep the status file up to date."""
+
+    def __init__(
+        self,
+        directory=".",
+        stages=("mark",),
+        workers=None,
+        journal=None,
+        metrics=None,
+        interval=2.0,
+        start_method="forkserver",
+        console=True,
+    ):
+        """Set up the monitor - records are only gathered between :py:meth:`start` and :py:meth:`stop`.
+
+        Keyword Arguments:
+            directory (str):
+                The cohort directory, where the status file and run log are written.
+            stages (tuple of str):
+                The stages every expected student goes through, in order.
+            workers (dict, None):
+                Number of workers for each stage, for the estimate.
+            journal (RunJournal, None):
+                If given, the stage times of earlier runs are used until this run has some of its own.
+            metrics (str, None):
+                Name of a Prometheus textfile to write the counters to.
+            interval (float):
+                Seconds between rewrites of the status and metrics files.
+            start_method (str):
+                multiprocessing start method of the worker pools - the log queue must be made to match.
+            console (bool):
+                Print the messages (INFO and above) on stdout.
+        """
+        super().__init__(logging.DEBUG)
+        self.directory = path.realpath(directory)
+        self.stages = tuple(stages)
+        self.workers = {stage: 1 for stage in self.stages}
+        self.workers.update(workers or {})
+        self.metrics = metrics
+        self.interval = interval
+        self.console = console
+        self.queue = get_context(start_method).Queue()
+        self.expected = set()
+        self.done = {stage: set() for stage in self.stages}
+        self.failed = {}
+        self.running = {}  # Student to (stage, start time)
+        self.completed = Counter()
+        self.errors = Counter()
+        self.seconds = Counter()
+        self.levels = Counter()
+        self.times = {stage: deque(maxlen=WINDOW) for stage in self.stages}
+        history = {} if journal is None else journal.timings()
+        for stage in self.stages:  # Seed the estimate with the median of earlier runs
+            earlier = sorted(times[stage] for times in history.values() if stage in times)
+            if earlier:
+                self.times[stage].append(earlier[len(earlier) // 2])
+        self.started = None
+        self._listener = None
+        self._timer = None
+        self._stopping = threading.Event()
+        self._handler = None
+        self._logger_state = None
+
+    def expect(self, subdir):
+        """Count subdir among the students this run will take through every stage."""
+        self.expected.add(path.basename(path.realpath(subdir)))
+
+    def emit(self, record):
+        """Update the counts from a log record - called from the listener's thread, holding the handler's lock."""
+        self.levels[record.levelname.lower()] += 1
+        event = getattr(record, "event", None)
+        if isinstance(event, dict) and event.get("student"):
+            self._event(event)
+
+    def _refresh(self):
+        """Rewrite the files every interval seconds, so the running times and estimate stay current between records."""
+        while not self._stopping.wait(self.interval):
+            with self.lock:  # Not while a record is being counted
+                self.write()
+
+    def _event(self, event):
+        """Update the counts from a journal record."""
+        student, stage, status = event["student"], event.get("stage"), event.get("status")
+        if status == "start":
+            self.running[student] = (stage, event.get("time", time.time()))
+            if stage in self.failed.get(student, ()):
+                self.failed[student].discard(stage)  # Being tried again
+            return
+        if self.running.get(student, (None,))[0] == stage:
+            del self.running[student]
+        if status == "done":
+            self.completed[stage] += 1
+            self.done.setdefault(stage, set()).add(student)
+            if "elapsed" in event:
+                self.seconds[stage] += event["elapsed"]
+                self.times.setdefault(stage, deque(maxlen=WINDOW)).append(event["elapsed"])
+        elif status == "failed":
+            self.errors[stage] += 1
+            self.failed.setdefault(student, set()).add(stage)
+
+    def _mean(self, stage):
+        """Return the mean of the recent times for stage, or None if there are none."""
+        times = self.times.get(stage)
+        return sum(times) / len(times) if times else None
+
+    def estimate(self, now=None):
+        """Return the estimated number of seconds until every expected student has been through every stage.
+
+        Each stage's remaining students are shared out over its workers, and the stages that follow it add their
+        mean time for the last of them. Stages with no times yet use the default marking time.
+        """
+        now = time.time() if now is None else now
+        means = {stage: self._mean(stage) or DEFAULT_MARK_TIME for stage in self.stages}
+        eta = 0.0
+        for ix, stage in enumerate(self.stages):
+            times = []
+            for student in list(self.expected):  # Students are added from the main thread
+                if student in self.done[stage] or self.failed.get(student):
+                    continue
+                running = self.running.get(student)
+                if running is not None and running[0] == stage:
+                    times.append(max(means[stage] - (now - running[1]), 0.0))
+                else:
+                    times.append(means[stage])
+            if times:
+                later = sum(means[after] for after in self.stages[ix + 1 :])
+                eta = max(eta, estimate_runtime(times, self.workers.get(stage, 1)) + later)
+        return eta
+
+    def status(self, finished=False):
+        """Return the current state of the run as a dictionary."""
+        now = time.time()
+        last = self.stages[-1]
+        failed = sorted(student for student, stages in self.failed.items() if stages)
+        elapsed = now - (self.started or now)
+        return {
+            "directory": self.directory,
+            "started": self.started,
+            "updated": now,
+            "finished": finished,
+            "stages": list(self.stages),
+            "expected": len(self.expected),
+            "done": {stage: len(self.done[stage]) for stage in self.stages},
+            "finished_students": len(self.done[last]),
+            "failed": failed,
+            "running": [
+                {"student": student, "stage": stage, "seconds": now - since}
+                for student, (stage, since) in sorted(self.running.items())
+            ],
+            "mean_seconds": {stage: self._mean(stage) for stage in self.stages},
+            "rate_per_minute": 60.0 * len(self.done[last]) / elapsed if elapsed > 0 else None,
+            "eta_seconds": None if finished else self.estimate(now),
+            "messages": dict(self.levels),
+        }
+
+    def prometheus(self, status):
+        """Return the counters in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, doc, values):
+            lines.append(f"# HELP phys2320_{name} {doc}")
+            lines.append(f"# TYPE phys2320_{name} {kind}")
+            for labels, value in values:
+                label = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"phys2320_{name}{{{label}}} {value}" if label else f"phys2320_{name} {value}")
+
+        stages = sorted(set(self.stages) | set(self.completed) | set(self.errors))
+
+        def by_stage(counts):
+            return [({"stage": stage}, counts[stage]) for stage in stages]
+
+        running = Counter(stage for stage, _ in self.running.values())
+        metric("students_expected", "gauge", "Students this run will mark.", [({}, len(self.expected))])
+        metric("stage_completed_total", "counter", "Stages finished.", by_stage(self.completed))
+        metric("stage_failed_total", "counter", "Stages failed.", by_stage(self.errors))
+        metric("stage_seconds_total", "counter", "Time spent in each stage.", by_stage(self.seconds))
+        metric("stage_running", "gauge", "Students in each stage now.", by_stage(running))
+        levels = [({"level": level}, count) for level, count in sorted(self.levels.items())]
+        metric("log_messages_total", "counter", "Log messages by level.", levels)
+        metric("eta_seconds", "gauge", "Estimated seconds until the run finishes.", [({}, status["eta_seconds"] or 0)])
+        metric("last_update_timestamp_seconds", "gauge", "When these figures were written.", [({}, status["updated"])])
+        return "\n".join(lines) + "\n"
+
+    def write(self, finished=False):
+        """Rewrite the status file, and the metrics file if there is one."""
+        status = self.status(finished)
+        _write_atomic(path.join(self.directory, STATUS_FILE), json.dumps(status, indent=1))
+        if self.metrics is not None:
+            _write_atomic(path.realpath(self.metrics), self.prometheus(status))
+
+    def start(self):
+        """Start gathering the records of this process and of the workers given the queue."""
+        self.started = time.time()
+        handlers = [JsonLineHandler(path.join(self.directory, LOG_FILE)), self]
+        if self.console:
+            console = logging.StreamHandler(sys.stdout)
+            console.setLevel(logging.INFO)
+            console.setFormatter(logging.Formatter("%(message)s"))
+            handlers.append(console)
+        self._listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self._listener.start()
+        logger = logging.getLogger(LOGGER)
+        self._logger_state = (logger.level, logger.propagate)
+        self._handler = QueueHandler(self.queue)
+        logger.addHandler(self._handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False  # Already printed by the listener
+        self.write()
+        self._stopping.clear()
+        self._timer = threading.Thread(target=self._refresh, name="RunMonitor", daemon=True)
+        self._timer.start()
+        return self
+
+    def stop(self):
+        """Take the last records off the queue, write the final status and close the run log."""
+        logger = logging.getLogger(LOGGER)
+        logger.removeHandler(self._handler)
+        logger.setLevel(self._logger_state[0])
+        logger.propagate = self._logger_state[1]
+        self._listener.stop()
+        self._stopping.set()
+        self._timer.join()
+        self.write(finished=True)
+        for handler in self._listener.handlers:
+            if handler is not self:
+                handler.close()
+
+    def __enter__(self):
+        """Start the monitor."""
+        return self.start()
+
+    def __exit__(self, *args):
+        """Stop the monitor."""
+        self.stop()
+
+
+def read_status(directory="."):
+    """Return the status written by the monitor of the run in directory, or None if there isn't one."""
+    try:
+        with open(path.join(directory, STATUS_FILE), "r", encoding="utf-8") as data:
+            return json.load(data)
+    except (OSError, ValueError):
+        return None
+
+
+def _duration(seconds):
+    """Format seconds as e.g. 1h02m or 4m10s."""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+def format_status(status):
+    """Return a one line summary of a status from :py:func:`read_status`."""
+    done = ", ".join(f"{count} {stage}" for stage, count in status["done"].items())
+    line = f"{status['finished_students']}/{status['expected']} finished ({done}), {len(status['failed'])} failed"
+    line += f", {len(status['running'])} running"
+    if status["finished"]:
+        return line + f" - run finished after {_duration(status['updated'] - status['started'])}"
+    if status["eta_seconds"] is not None:
+        line += f", about {_duration(status['eta_seconds'])} to go"
+    return line
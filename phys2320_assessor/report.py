@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Helpers for writing the shared report assets and compressed report bundles."""
+import gzip
+import os
+from os import path
+import shutil
+import tempfile
+import zipfile
+
+__all__ = ["REPORT_CSS", "write_asset", "bundle_report"]
+
+REPORT_CSS = "report.css"  # Name of the shared stylesheet in the cohort directory
+
+
+def write_asset(filename, text):
+    """Write text to filename unless it already holds exactly that text.
+
+    The file is written to a temporary file and renamed into place so that parallel workers never see a partial
+    file.
+
+    Returns:
+        (bool):
+            True if the file was (re)written.
+    """
+    if path.exists(filename):
+        with open(filename, "r", encoding="utf-8") as asset:
+            if asset.read() == text:
+                return False
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(path.realpath(filename)), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as asset:
+        asset.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, filename)
+    return True
+
+
+def bundle_report(subdir, mode, report="results.html"):
+    """Compress a student's report.
+
+    Args:
+        subdir (str):
+            The student's folder.
+        mode (str):
+            *gzip* writes results.html.gz alongside the report, *zip* writes results.zip containing the report, its
+            figures and the shared stylesheet laid out as they are in the cohort directory.
+
+    Keyword Arguments:
+        report (str):
+            File name of the report.
+
+    Returns:
+        (str):
+            The bundle file written.
+    """
+    src = path.join(subdir, report)
+    if mode == "gzip":
+        dest = src + ".gz"
+        with open(src, "rb") as html, gzip.open(dest, "wb") as bundle:
+            shutil.copyfileobj(html, bundle)
+    elif mode == "zip":
+        student = path.basename(path.realpath(subdir))
+        dest = path.join(subdir, path.splitext(report)[0] + ".zip")
+        with zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+            bundle.write(src, f"{student}/{report}")
+            figures = path.join(subdir, "figures")
+            if path.isdir(figures):
+                for fig in sorted(os.listdir(figures)):
+                    bundle.write(path.join(figures, fig), f"{student}/figures/{fig}", compress_type=zipfile.ZIP_STORED)
+            css = path.join(path.dirname(path.realpath(subdir)), REPORT_CSS)
+            if path.exists(css):
+                bundle.write(css, REPORT_CSS)
+    else:
+        raise ValueError(f"Unknown report bundle mode {mode}")
+    return dest
@@ -31,6 +31,8 @@ def mk_answer(ans, key, units=None, fmt="text"):
 
 def _fix_val(v,s):
     """Try to ensure that v and s are both floats ad s is positive."""
+    if type(v) in (float, int) and type(s) in (float, int):  # The usual case - skip the checks for sequences
+        return float(v), abs(float(s))
 
     if isinstance(v,Iterable) and len (v)==2:
         v,s=v[0],v[1]
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Run code in a forked child process under resource limits and bring its result back through shared memory.
+
+The child's return value is sent back in two parts. Every numpy array bigger than a threshold is written once into a
+memory-mapped file (in /dev/shm where there is one, so it never touches a disk) and replaced by a small
+:py:data:`SharedArray` placeholder. Only this skeleton of the result - the dictionaries, lists, small values and
+placeholders - is pickled over the pipe. The parent maps the file and rebuilds the result with read-only views of the
+arrays, so nothing is copied in transit. Once the child has exited, :py:meth:`SharedResult.detach` copies the arrays
+into memory the parent owns - so the child can't change them afterwards - and removes the file.
+"""
+from collections import namedtuple
+import mmap
+import multiprocessing as mp
+import os
+from os import path
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+__all__ = ["SharedArray", "SharedResult", "ChildRun", "send_result", "receive_result", "start_in_child", "run_in_child"]
+
+SharedArray = namedtuple("SharedArray", ["offset", "shape", "dtype"])
+SharedArray.__doc__ = """Placeholder for an array passed through the shared file - its offset, shape and dtype."""
+
+SHARED_DIR = "/dev/shm" if path.isdir("/dev/shm") else tempfile.gettempdir()
+THRESHOLD = 1 << 16  # Arrays smaller than this many bytes are simply pickled
+ALIGN = 64
+
+
+def _pack(obj, arrays, threshold):
+    """Return obj with its large arrays replaced by placeholders, adding (placeholder, array) to arrays."""
+    if type(obj) is np.ndarray and obj.nbytes >= threshold and not obj.dtype.hasobject:
+        offset = 0 if not arrays else -(-(arrays[-1][0].offset + arrays[-1][1].nbytes) // ALIGN) * ALIGN
+        placeholder = SharedArray(offset, obj.shape, obj.dtype)
+        arrays.append((placeholder, obj))
+        return placeholder
+    if type(obj) is dict:
+        return {key: _pack(value, arrays, threshold) for key, value in obj.items()}
+    if type(obj) in (list, tuple):
+        return type(obj)(_pack(value, arrays, threshold) for value in obj)
+    return obj
+
+
+def _unpack(obj, buffer, copy):
+    """Rebuild the result from its skeleton, with views of (or copies from) buffer for the placeholders."""
+    if isinstance(obj, SharedArray):
+        view = np.ndarray(obj.shape, obj.dtype, buffer=buffer, offset=obj.offset)
+        return view.copy() if copy else view
+    if type(obj) is dict:
+        return {key: _unpack(value, buffer, copy) for key, value in obj.items()}
+    if type(obj) in (list, tuple):
+        return type(obj)(_unpack(value, buffer, copy) for value in obj)
+    return obj
+
+
+def send_result(conn, obj, threshold=THRESHOLD):
+    """Send obj over the pipe conn, passing its large arrays through a shared memory-mapped file.
+
+    Args:
+        conn (Connection):
+            The sending end of a pipe.
+        obj (any):
+            The result to send - arrays are found inside dictionaries, lists and tuples.
+
+    Keyword Arguments:
+        threshold (int):
+            Arrays of at least this many bytes are passed through the file.
+    """
+    arrays = []
+    skeleton = _pack(obj, arrays, threshold)
+    filename = None
+    if arrays:
+        size = arrays[-1][0].offset + arrays[-1][1].nbytes
+        fd, filename = tempfile.mkstemp(dir=SHARED_DIR, prefix="phys2320-", suffix=".buf")
+        try:
+            os.ftruncate(fd, size)
+            with mmap.mmap(fd, size) as buffer:
+                for placeholder, array in arrays:
+                    np.ndarray(array.shape, array.dtype, buffer=buffer, offset=placeholder.offset)[...] = array
+        finally:
+            os.close(fd)
+    conn.send((skeleton, filename))
+
+
+class SharedResult(object):
+
+    """A result received from :py:func:`send_result`, whose arrays are views of the shared file until detached."""
+
+    def __init__(self, skeleton, filename):
+        """Map the shared file (if there is one) and build the result from the skeleton."""
+        self.skeleton = skeleton
+        self.filename = filename
+        self._buffer = None
+        if filename is not None:
+            with open(filename, "rb") as data:
+                self._buffer = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        self.value = _unpack(skeleton, self._buffer, copy=False)
+
+    def detach(self):
+        """Copy the arrays out of the shared file and remove it - call once the sending process has exited.
+
+        Returns:
+            (any):
+                The result, owning all its arrays.
+        """
+        if self.filename is not None:
+            self.value = _unpack(self.skeleton, self._buffer, copy=True)
+            self.close()
+        return self.value
+
+    def close(self):
+        """Remove the shared file - any views of it must not be used afterwards."""
+        if self.filename is not None:
+            self._buffer = None  # The mapping is released once the views of it have gone
+            try:
+                os.unlink(self.filename)
+            except OSError:
+                pass
+            self.filename = None
+
+
+def receive_result(conn):
+    """Receive a result sent by :py:func:`send_result` on the pipe conn.
+
+    Returns:
+        (SharedResult):
+            The received result - its value holds views of the shared file until it is detached.
+    """
+    return SharedResult(*conn.recv())
+
+
+def _child(conn, func, args, cpu_limit, memory_limit):
+    """Run func(*args) in the child under the resource limits and send back the result."""
+    try:
+        if resource is not None:
+            if cpu_limit is not None:
+                resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_limit) + 1, int(cpu_limit) + 2))
+            if memory_limit is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (int(memory_limit), int(memory_limit)))
+        result = (True, func(*args))
+    except MemoryError:
+        result = (False, "ran out of memory")
+    except BaseException as err:
+        result = (False, f"{type(err).__name__}: {err}")
+    try:
+        send_result(conn, result)
+    except Exception as err:  # e.g. the result can't be pickled
+        conn.send(((False, f"couldn't send back the result: {err}"), None))
+    finally:
+        conn.close()
+        os._exit(0)  # Don't run any of the parent's exit handlers
+
+
+class ChildRun(object):
+
+    """A call running in a forked child process under resource limits - see :py:func:`start_in_child`."""
+
+    def __init__(self, func, args, cpu_limit=None, memory_limit=None, timeout=None):
+        """Fork the child and start it running func(*args)."""
+        ctx = mp.get_context("fork")
+        self.cpu_limit = cpu_limit
+        self._receive, send = ctx.Pipe(duplex=False)
+        self._child = ctx.Process(target=_child, args=(send, func, args, cpu_limit, memory_limit))
+        self._child.start()
+        send.close()
+        if timeout is None and cpu_limit is not None:
+            timeout = 2.0 * cpu_limit + 10.0  # Allow for the child waiting on I/O
+        self.deadline = None if timeout is None else perf_counter() + timeout
+
+    def result(self):
+        """Wait for the child to finish and return (True, value) or (False, the reason there's no value)."""
+        shared = None
+        try:
+            if self._receive.poll(None if self.deadline is None else max(self.deadline - perf_counter(), 0.0)):
+                shared = receive_result(self._receive)
+                ret = shared.value
+            else:
+                ret = (False, "ran out of time")
+        except EOFError:  # The child died without saying why - almost always the CPU limit
+            ret = (False, "ran out of CPU time" if self.cpu_limit is not None else "stopped unexpectedly")
+        finally:
+            self._child.join(1.0)
+            if self._child.is_alive():
+                self._child.kill()
+                self._child.join()
+            self._receive.close()
+        if shared is not None:
+            ret = shared.detach()  # The child has gone, so now take our own copies
+        return ret
+
+    def cancel(self):
+        """Stop the child without waiting for its result, removing any shared file it has already sent."""
+        try:
+            if self._receive.poll(0):
+                receive_result(self._receive).close()
+        except (EOFError, OSError):
+            pass
+        finally:
+            if self._child.is_alive():
+                self._child.kill()
+            self._child.join()
+            self._receive.close()
+
+
+def start_in_child(func, *args, cpu_limit=None, memory_limit=None, timeout=None):
+    """Start func(*args) running in a forked child process with limits on its CPU time and memory.
+
+    Args:
+        func (callable):
+            The code to run - it is inherited by the child, so needn't be picklable.
+        *args:
+            Arguments for func.
+
+    Keyword Arguments:
+        cpu_limit (float, None):
+            Seconds of CPU time the child may use before it is stopped.
+        memory_limit (int, None):
+            Bytes of address space the child may use.
+        timeout (float, None):
+            Seconds to wait for a result - defaults to twice the CPU limit plus ten seconds, to allow for waiting on
+            I/O.
+
+    Returns:
+        (ChildRun):
+            The running child - its result method waits for and returns (True, value) or (False, message). Large
+            arrays in the value come back through shared memory (see :py:func:`send_result`).
+    """
+    return ChildRun(func, args, cpu_limit=cpu_limit, memory_limit=memory_limit, timeout=timeout)
+
+
+def run_in_child(func, *args, cpu_limit=None, memory_limit=None, timeout=None):
+    """Call func(*args) in a forked child process and wait for the result - see :py:func:`start_in_child`.
+
+    Returns:
+        (bool, any):
+            True and the value func returned, or False and a message saying why there isn't one.
+    """
+    return start_in_child(func, *args, cpu_limit=cpu_limit, memory_limit=memory_limit, timeout=timeout).result()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Time code on larger and larger data files to see how its run time grows with the size of the data.
+
+A single timing on one small data file can't tell a student whose code loops over every pair of points from one
+whose code is just slow to start. :py:func:`time_limited` runs some code in a forked child process (see
+:py:mod:`sandbox`), with limits on its CPU time and memory so that a quadratic loop over a large file can't take the
+marking down with it, and :py:func:`fit_exponent` fits the power law t ~ n**k to the times for files of different
+sizes.
+"""
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from .sandbox import run_in_child
+
+__all__ = ["time_limited", "fit_exponent"]
+
+
+def _best_time(func, filename, repeat, budget):
+    """Run func(filename) up to repeat times, or until budget seconds have passed, and return the best time."""
+    sys.stdout = sys.stderr = open(os.devnull, "w")  # Nobody is reading the output
+    best = None
+    started = perf_counter()
+    for _ in range(max(repeat, 1)):
+        t1 = perf_counter()
+        func(filename)
+        elapsed = perf_counter() - t1
+        best = elapsed if best is None else min(best, elapsed)
+        if perf_counter() - started > budget:
+            break
+    return best
+
+
+def time_limited(func, filename, cpu_limit=60.0, memory_limit=None, repeat=3, budget=1.0):
+    """Time func(filename) in a forked child process with limits on its CPU time and memory.
+
+    Args:
+        func (callable):
+            The code to time - it is inherited by the child, so needn't be picklable.
+        filename (str):
+            The data file to pass to it.
+
+    Keyword Arguments:
+        cpu_limit (float, None):
+            Seconds of CPU time the child may use before it is stopped.
+        memory_limit (int, None):
+            Bytes of address space the child may use.
+        repeat (int):
+            Most times to run the code - the best time is used.
+        budget (float):
+            Stop repeating once this many seconds have been spent.
+
+    Returns:
+        (float or str):
+            The best time in seconds, or a message saying why the code couldn't be timed.
+    """
+    _, value = run_in_child(_best_time, func, filename, repeat, budget, cpu_limit=cpu_limit, memory_limit=memory_limit)
+    return value
+
+
+def fit_exponent(sizes, times):
+    """Fit times = a * sizes**k and return k, or None if there aren't at least two usable points.
+
+    Args:
+        sizes (list of int):
+            Number of rows of data in each file.
+        times (list of float or str):
+            Time taken for each file - entries that aren't numbers (failed runs) are skipped.
+    """
+    points = [(n, t) for n, t in zip(sizes, times) if isinstance(t, float) and t > 0 and n > 0]
+    if len({n for n, _ in points}) < 2:
+        return None
+    sizes, times = np.log(np.array(points, dtype=float)).T
+    return float(np.polyfit(sizes, times, 1)[0])
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Compile the year's answer template into a flat plan of the answers to normalise and compare.
+
+The template (:py:attr:`Assessor.template`) describes the dictionary ProcessData returns - None for a single answer,
+a dictionary or a list of templates for nested answers. Rather than walking the template alongside every set of
+answers, it is compiled once into a list of nodes in depth first order, each holding its key path, what kind of
+answer is expected there and the name of its error key. Normalising or comparing a set of answers is then one pass
+along the list. Wherever the answers don't have the shape the template describes, the Assessor falls back to walking
+that part of the answers recursively.
+"""
+from collections import namedtuple
+
+__all__ = ["PlanNode", "AnswerPlan", "EMPTY_PLAN", "compile_template"]
+
+PlanNode = namedtuple("PlanNode", ["path", "parent", "key", "kind", "error_key", "template", "size"])
+PlanNode.__doc__ = """One answer in the plan.
+
+Attributes:
+    path (tuple):
+        Keys (and list indices) from the top of the answers to this answer.
+    parent (tuple):
+        The path of the dict or list holding the answer.
+    key (str or int):
+        The answer's key (or index) in its parent.
+    kind (str):
+        *value* for a single answer, *dict* or *list* for nested answers.
+    error_key (str or None):
+        The key of the answer's uncertainty in the same dictionary, or None for answers in lists.
+    template (dict, list or None):
+        The part of the template for this answer - used when falling back to the recursive code.
+    size (int):
+        Number of nodes in the plan for this answer, including itself - so that a whole nested answer can be skipped.
+"""
+
+
+class AnswerPlan(object):
+
+    """The compiled form of an answer template."""
+
+    def __init__(self, template):
+        """Compile template (a dictionary) into a list of :py:class:`PlanNode`."""
+        self.nodes = []
+        self.children = {}  # Path of each dict or list to the keys the template expects in it
+        self._compile(template if isinstance(template, dict) else {}, ())
+
+    def _compile(self, template, path):
+        """Add the nodes for the contents of the dict or list template at path."""
+        keys = template.keys() if isinstance(template, dict) else range(len(template))
+        keys = [key for key in keys if not (isinstance(key, str) and key.endswith("_error"))]
+        self.children[path] = keys
+        for key in keys:
+            sub = template[key]
+            kind = "dict" if isinstance(sub, dict) else "list" if isinstance(sub, list) else "value"
+            error_key = f"{key}_error" if isinstance(key, str) else None
+            ix = len(self.nodes)
+            self.nodes.append(None)
+            if kind != "value":
+                self._compile(sub, path + (key,))
+            self.nodes[ix] = PlanNode(path + (key,), path, key, kind, error_key, sub, len(self.nodes) - ix)
+
+
+EMPTY_PLAN = AnswerPlan({})
+_plans = {}
+
+
+def compile_template(template):
+    """Return the :py:class:`AnswerPlan` for template, compiling it only the first time it is seen.
+
+    Plans are kept for each template object - templates are class attributes and shouldn't be changed in place. Anything
+    other than a dictionary (e.g. None when there is no template) gets the shared, empty, :py:data:`EMPTY_PLAN`.
+    """
+    if not isinstance(template, dict):
+        return EMPTY_PLAN
+    seen = _plans.get(id(template))
+    if seen is None or seen[0] is not template:
+        seen = _plans[id(template)] = (template, AnswerPlan(template))
+    return seen[1]
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""Find near-duplicate figures, docstrings and comments across the cohort without comparing every pair of students.
+
+Each rendered figure is reduced to a perceptual *difference hash* (:py:func:`figure_hash`): the png is shrunk to a
+small grey-scale grid and each bit records whether a cell is darker than its right-hand neighbour. Re-saving, small
+changes of size and the odd changed label move only a few bits, so figures that look the same have hashes a small
+Hamming distance apart. The hashes are kept in a :py:class:`BKTree`, which finds every hash within a given distance of
+another by visiting only a small part of the tree, so the whole cohort is checked in roughly n log n time.
+
+The docstrings and comments of each submission (:py:func:`code_text`) are split into overlapping runs of words
+(:py:func:`shingles`) and summarised by a MinHash signature (:py:class:`MinHasher`) - the fraction of places where two
+signatures agree estimates the Jaccard similarity of the two sets of shingles. :py:class:`LSHIndex` cuts each
+signature into bands and files it under a hash of each band, so a submission only has to be compared with the ones
+that share a band with it. Submissions can be added to the index one at a time as they arrive.
+"""
+import ast
+import io
+import re
+import tokenize
+from zlib import crc32
+
+import numpy as np
+from matplotlib import image as mpimg
+
+__all__ = [
+    "figure_hash",
+    "hamming",
+    "BKTree",
+    "similar_pairs",
+    "code_text",
+    "shingles",
+    "MinHasher",
+    "jaccard",
+    "LSHIndex",
+    "similar_texts",
+    "MIN_SHINGLES",
+]
+
+HASH_SIZE = 16  # The hash has HASH_SIZE**2 bits
+PRIME = (1 << 32) - 5  # Largest prime below 2**32 - the MinHash permutations are a*x+b mod PRIME
+SHINGLE = 3  # Words in each shingle
+PERMUTATIONS = 128  # Length of the MinHash signatures
+BANDS = 32  # LSH bands - with 128 permutations pairs above roughly 0.4 similarity share a band
+MIN_SHINGLES = 5  # Text with fewer shingles than this (e.g. a one line docstring) is too short to compare
+
+
+def figure_hash(png, size=HASH_SIZE):
+    """Return the difference hash of the png image data png as an int of size*size bits.
+
+    Args:
+        png (bytes):
+            The rendered figure.
+
+    Keyword Arguments:
+        size (int):
+            The hash is made from a size by size+1 grid of the image.
+
+    Returns:
+        (int):
+            The hash - 0 for a blank image.
+    """
+    pixels = np.asarray(mpimg.imread(io.BytesIO(png), format="png"), dtype=float)
+    if pixels.ndim == 3:
+        if pixels.shape[2] == 4:  # Put transparent parts on white
+            pixels = pixels[..., :3] * pixels[..., 3:] + (1.0 - pixels[..., 3:])
+        pixels = pixels[..., :3].mean(axis=2)
+    if pixels.shape[0] < size or pixels.shape[1] < size + 1:
+        return 0
+    rows = np.linspace(0, pixels.shape[0], size + 1).astype(int)
+    cols = np.linspace(0, pixels.shape[1], size + 2).astype(int)
+    grid = np.add.reduceat(np.add.reduceat(pixels, rows[:-1], axis=0), cols[:-1], axis=1)
+    grid /= np.outer(np.diff(rows), np.diff(cols))
+    bits = (grid[:, :-1] < grid[:, 1:]).ravel()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming(a, b):
+    """Return the number of bits that differ between the hashes a and b."""
+    return bin(a ^ b).count("1")
+
+
+class BKTree(object):
+
+    """A Burkhard-Keller tree of hashes for finding every hash within a Hamming distance of another.
+
+    Each node keeps its children by their distance from it. By the triangle inequality a hash within r of the query
+    can only be under a child whose distance d from the node is within r of the query's distance from the node, so
+    whole branches of the tree are skipped.
+    """
+
+    def __init__(self):
+        """Start an empty tree."""
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        """Add the hash value, labelled with item."""
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (value, [item], {})
+                return
+            node = node[2][distance]
+
+    def search(self, value, radius):
+        """Return a list of (distance, item) for every hash within radius of value."""
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, item) for item in node[1])
+            stack.extend(child for d, child in node[2].items() if distance - radius <= d <= distance + radius)
+        return found
+
+    def __len__(self):
+        """Number of hashes in the tree."""
+        return self.size
+
+
+def similar_pairs(hashes, radius):
+    """Find the pairs of hashes from different owners that are within radius of each other.
+
+    Args:
+        hashes (iterable):
+            Tuples of (owner, label, hash) - e.g. a student's issid, a figure name and its hash. Zero hashes (blank
+            figures) are skipped.
+        radius (int):
+            Greatest Hamming distance to report.
+
+    Returns:
+        (list):
+            Tuples of (distance, (owner, label), (owner, label)), closest first, with each pair reported once.
+    """
+    tree = BKTree()
+    pairs = []
+    for owner, label, value in hashes:
+        if not value:
+            continue
+        for distance, (other, other_label) in tree.search(value, radius):
+            if other != owner:
+                pairs.append((distance, (other, other_label), (owner, label)))
+        tree.add(value, (owner, label))
+    return sorted(pairs)
+
+
+def code_text(source):
+    """Return the docstrings and comments of the python source code source as one string.
+
+    Comments are found with :py:mod:`tokenize` and docstrings with :py:mod:`ast`, so strings in the code itself are
+    left out. Source that can't be parsed still gives whatever was found before the error.
+    """
+    parts = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            if token.type == tokenize.COMMENT:
+                parts.append(token.string.lstrip("#"))
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        pass
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return "\n".join(parts)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            docstring = ast.get_docstring(node)
+            if docstring:
+                parts.append(docstring)
+    return "\n".join(parts)
+
+
+def shingles(text, size=SHINGLE):
+    """Return the set of crc32 hashes of the runs of size words in text, ignoring case and punctuation."""
+    words = re.findall(r"[a-z0-9]+", text.lower())
+    if len(words) < size:
+        return {crc32(" ".join(words).encode())} if words else set()
+    return {crc32(" ".join(words[ix : ix + size]).encode()) for ix in range(len(words) - size + 1)}
+
+
+class MinHasher(object):
+
+    """Make MinHash signatures of sets of 32 bit hashes with a fixed set of random permutations."""
+
+    def __init__(self, permutations=PERMUTATIONS, seed=2320):
+        """Choose the permutations - signatures can only be compared if made with the same permutations and seed."""
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, PRIME, permutations, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, permutations, dtype=np.uint64)
+
+    def signature(self, hashes):
+        """Return the signature of the set hashes as a tuple of ints, or None for an empty set."""
+        if not hashes:
+            return None
+        prime = np.uint64(PRIME)
+        values = np.fromiter(hashes, dtype=np.uint64) % prime
+        permuted = (np.outer(self.a, values) % prime + self.b[:, None]) % prime  # a*x < 2**64 so no overflow
+        return tuple(int(v) for v in permuted.min(axis=1))
+
+
+def jaccard(a, b):
+    """Estimate the Jaccard similarity of two sets from their MinHash signatures a and b."""
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class LSHIndex(object):
+
+    """Locality sensitive hashing index of MinHash signatures, cut into bands."""
+
+    def __init__(self, bands=BANDS):
+        """Start an empty index that cuts signatures into bands bands."""
+        self.bands = bands
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def _bands(self, signature):
+        """Yield (band number, band) for signature."""
+        rows = len(signature) // self.bands
+        for band in range(self.bands):
+            yield band, tuple(signature[band * rows : (band + 1) * rows])
+
+    def candidates(self, signature):
+        """Return the set of keys already in the index that share at least one band with signature."""
+        found = set()
+        for band, key in self._bands(signature):
+            found.update(self.buckets[band].get(key, ()))
+        return found
+
+    def add(self, key, signature, threshold=0.0):
+        """Add signature under key and return a list of (similarity, other key) for the matches already indexed.
+
+        Keyword Arguments:
+            threshold (float):
+                Only candidates whose estimated Jaccard similarity is at least this are returned.
+        """
+        matches = []
+        for other in self.candidates(signature):
+            similarity = jaccard(signature, self.signatures[other])
+            if other != key and similarity >= threshold:
+                matches.append((similarity, other))
+        self.signatures[key] = signature
+        for band, bucket in self._bands(signature):
+            self.buckets[band].setdefault(bucket, []).append(key)
+        return sorted(matches, reverse=True)
+
+    def __len__(self):
+        """Number of signatures in the index."""
+        return len(self.signatures)
+
+
+def similar_texts(signatures, threshold, bands=BANDS):
+    """Find the pairs of signatures whose estimated Jaccard similarity is at least threshold.
+
+    Args:
+        signatures (iterable):
+            Tuples of (key, signature) - e.g. a student's issid and the signature of their docstrings and comments.
+        threshold (float):
+            Least estimated similarity to report.
+
+    Returns:
+        (list):
+            Tuples of (similarity, key, key), most similar first, with each pair reported once.
+    """
+    index = LSHIndex(bands)
+    pairs = []
+    for key, signature in signatures:
+        pairs.extend((similarity, other, key) for similarity, other in index.add(key, signature, threshold))
+    return sorted(pairs, key=lambda pair: (-pair[0], pair[1], pair[2]))
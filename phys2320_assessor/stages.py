@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Named stages of marking one student, with the artifacts of each stage cached by a hash of its inputs.
+
+Each stage declares the stages whose results it uses, the Assessor methods that implement it and the Assessor
+settings that change what it does. The key of a stage is a hash of the keys of its inputs, the source code of those
+methods and the values of those settings - the first stage's key being a hash of the submitted files. When a student
+is marked again only the stages whose key has changed are re-run, so e.g. changing a comparison tolerance re-runs the
+comparisons without importing or running the student's code again.
+"""
+from collections import namedtuple
+import hashlib
+import inspect
+import os
+from os import path
+import pickle
+import tempfile
+
+__all__ = ["Stage", "Artifact", "StageCache", "method_hash", "files_hash"]
+
+Stage = namedtuple("Stage", ["inputs", "methods", "settings", "attrs", "cache"])
+Stage.__doc__ = """Definition of one stage.
+
+inputs are the names of the stages whose results are passed to the stage, methods the Assessor methods whose source
+code determines the result, settings the Assessor attributes that change it and attrs the Assessor attributes it sets
+(restored when the stage is cached). cache is True to cache the whole artifact, *html* to cache only its report
+fragment (for stages such as the import whose result can't be stored) or False.
+"""
+
+Artifact = namedtuple("Artifact", ["key", "html", "data", "attrs"])
+Artifact.__doc__ = """The result of a stage - its report fragment, its data for later stages and the Assessor attributes it set."""
+
+_method_hashes = {}
+
+
+def method_hash(cls, names):
+    """Return a hash of the source code of the methods names of class cls."""
+    key = (cls, tuple(names))
+    if key not in _method_hashes:
+        digest = hashlib.sha1()
+        for name in names:
+            method = getattr(cls, name, None)
+            try:
+                digest.update(inspect.getsource(method).encode("utf-8"))
+            except (OSError, TypeError):  # No source available - fall back to the byte code
+                digest.update(repr(getattr(getattr(method, "__code__", None), "co_code", name)).encode("utf-8"))
+        _method_hashes[key] = digest.hexdigest()
+    return _method_hashes[key]
+
+
+def files_hash(filenames):
+    """Return a hash of the names and contents of filenames, skipping None entries."""
+    digest = hashlib.sha1()
+    for filename in filenames:
+        if filename is None:
+            continue
+        digest.update(path.basename(filename).encode("utf-8"))
+        if path.exists(filename):
+            with open(filename, "rb") as data:
+                digest.update(data.read())
+    return digest.hexdigest()
+
+
+class StageCache(object):
+
+    """Store the artifact of each stage for one student as a pickle in a folder in the student's directory."""
+
+    def __init__(self, directory):
+        """Use directory to keep the artifacts."""
+        self.directory = directory
+
+    def get(self, name, key=None):
+        """Return the artifact stored for stage name if it was made with key (or with any key if key is None)."""
+        filename = path.join(self.directory, f"{name}.pkl")
+        if not path.exists(filename):
+            return None
+        try:
+            with open(filename, "rb") as data:
+                artifact = pickle.load(data)
+        except Exception:  # Corrupt or written by an incompatible version
+            return None
+        return artifact if key is None or artifact.key == key else None
+
+    def put(self, name, artifact):
+        """Store the artifact for stage name, returning False if it can't be pickled."""
+        try:
+            payload = pickle.dumps(artifact)
+        except Exception:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as data:
+            data.write(payload)
+        os.replace(tmp, path.join(self.directory, f"{name}.pkl"))
+        return True
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Generate the standard data files for a cohort once and place them into the student folders without copying.
+
+The standard data file each student needs is named by formatting the Assessor's stdfile_pattern with the settings
+from the header of their own data file. :py:func:`prepare_std_data` works out every distinct standard file needed
+by the cohort and generates the missing ones in parallel. Generation is always done while holding a lock file next to
+the standard file, so parallel workers can't race to write the same file.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import logging
+from os import path
+
+from .assessor import CaptureOutput
+from .funcs import file_lock
+
+__all__ = ["std_filename", "generate_std_data", "prepare_std_data"]
+
+log = logging.getLogger(__name__)
+
+
+def std_filename(assessor):
+    """Work out the name of the standard data file a student needs, or None if that isn't possible.
+
+    Args:
+        assessor (Assessor):
+            Student assessor - the submission is inspected with get_info if that hasn't been done already.
+
+    Returns:
+        (str, dict or None, None):
+            The standard file name and the header settings used to make it.
+    """
+    try:
+        if assessor.data is None:
+            with CaptureOutput():
+                assessor.get_info()
+        header = assessor.load_data(assessor.data).header
+        return assessor.stdfile_pattern.format(**header), header
+    except Exception:
+        return None, None
+
+
+def generate_std_data(assessor, settings):
+    """Generate one standard data file, unless another process already has.
+
+    Args:
+        assessor (Assessor):
+            A student assessor whose get_std_data will make the file.
+        settings (dict):
+            The data file header settings that the standard file should be made for.
+
+    Returns:
+        (str):
+            The name of the standard file.
+    """
+    assessor.metadata = settings
+    std_file = path.join(assessor.stdfile_dir, assessor.stdfile_pattern.format(**settings))
+    with file_lock(std_file + ".lock"):
+        if not path.exists(std_file):
+            assessor.get_std_data()
+    return std_file
+
+
+def prepare_std_data(cohort, workers=1):
+    """Generate every missing standard data file the cohort needs, in parallel.
+
+    Args:
+        cohort (ComputingClass):
+            The cohort of students.
+
+    Keyword Arguments:
+        workers (int):
+            Number of standard files to generate at once.
+
+    Returns:
+        (dict):
+            Mapping of the standard file names the cohort needs to the number of students needing each.
+    """
+    needed = {}
+    makers = {}
+    for subdir in cohort.subdirs:
+        assessor = cohort.make_student(subdir)
+        name, settings = std_filename(assessor)
+        if name is None:
+            continue
+        needed[name] = needed.get(name, 0) + 1
+        if name not in makers and not path.exists(path.join(assessor.stdfile_dir, name)):
+            makers[name] = (assessor, settings)
+    if makers:
+        log.info(f"Generating {len(makers)} standard data files for {len(needed)} distinct standard files.")
+        with ProcessPoolExecutor(max(workers, 1)) as pool:
+            for name in pool.map(generate_std_data, *zip(*makers.values())):
+                log.info(f"Generated {name}")
+    return needed
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""A quick pre-flight pass over a cohort before the full marking run.
+
+Every submission is located, byte-compiled and inspected in parallel. Students whose code can't possibly run - no
+code or data file, a syntax error, no ProcessData function or use of input() - get a short report straight away
+rather than taking a worker through the full run. The rest are ordered longest first using the marking times from
+earlier runs in the journal, so that one slow student isn't left running on its own at the end, and the total time
+for the run is estimated.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import heapq
+import io
+import logging
+from os import path
+
+from . import exceptions as excp
+from .funcs import Inspector, touch
+
+__all__ = ["TriageReport", "DEFAULT_MARK_TIME", "triage_student", "estimate_runtime", "triage_cohort"]
+
+log = logging.getLogger(__name__)
+
+TriageReport = namedtuple("TriageReport", ["failures", "order", "estimate"])
+
+DEFAULT_MARK_TIME = 60.0  # Seconds to allow for marking a student when there are no earlier timings at all
+
+# Problems, besides syntax errors, that mean the full run would fail anyway
+FAST_FAILURES = (excp.NoDataError, excp.NoCpdeError, excp.NoProcessDataError, excp.RawInputFound)
+
+
+def _fast_failure_report(assessor, err):
+    """Write the short report for a student whose code can't be run.
+
+    The code is only highlighted - linting it with pylint and radon is left to the marking and replay stages, so the
+    pre-flight pass stays quick.
+    """
+    err_string = str(err).replace("\n", "<br/>\n")
+    touch(path.join(assessor.subdir, "skip"))
+    with open(path.join(assessor.subdir, "results.html"), "w") as report, contextlib.redirect_stdout(report):
+        assessor.report_header()
+        print("<h2>Submission failed the pre-flight checks</h2>")
+        print(f"<p>{err_string}</p>")
+        print("<h2>Manual Checking Required</h2>")
+        if assessor.code is not None:
+            print("<h1>Student Code</h1>")
+            assessor.highlight_code()
+        print("</body></html>")
+
+
+def triage_student(assessor):
+    """Check that a student's code could run, without running it.
+
+    Args:
+        assessor (Assessor):
+            The student assessor.
+
+    Returns:
+        (str, str or None):
+            The student folder and an error message if the student failed the checks (None otherwise).
+    """
+    message = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            assessor.get_info()
+            if assessor.code is None:
+                raise excp.NoCpdeError("Student does not seem to have submitted a Python file!")
+            with open(assessor.code, "r", errors="ignore") as code:
+                compile(code.read(), assessor.code, "exec")
+            Inspector(assessor.code)
+    except SyntaxError as err:
+        message = f"Syntax error in {path.basename(err.filename or '')} line {err.lineno}: {err.msg}"
+    except FAST_FAILURES as err:
+        message = str(err)
+    except Exception:  # Anything else is left for the full run to report properly
+        pass
+    if message is not None:
+        _fast_failure_report(assessor, message)
+    return assessor.subdir, message
+
+
+def estimate_runtime(times, workers=1):
+    """Estimate how long marking will take when jobs are handed out longest first.
+
+    Args:
+        times (list of float):
+            Expected time for each student.
+
+    Keyword Arguments:
+        workers (int):
+            Number of students marked at once.
+
+    Returns:
+        (float):
+            Time until the last worker finishes.
+    """
+    finish = [0.0] * max(workers, 1)
+    for elapsed in sorted(times, reverse=True):
+        heapq.heapreplace(finish, finish[0] + elapsed)
+    return max(finish)
+
+
+def triage_cohort(cohort, workers=1, journal=None, mark_workers=None):
+    """Run the pre-flight checks over all the students in the cohort that still need marking.
+
+    Args:
+        cohort (ComputingClass):
+            The cohort of students.
+
+    Keyword Arguments:
+        workers (int):
+            Number of students to check at once.
+        journal (RunJournal, None):
+            If given, fast failures are recorded in it and its timings from earlier runs are used to order the
+            students and estimate the run time.
+        mark_workers (int, None):
+            Number of students that will be marked at once, for the estimate - defaults to workers.
+
+    Returns:
+        (TriageReport):
+            failures maps student folders to the reason they failed, order lists the remaining student folders longest
+            first and estimate is the expected time in seconds to mark them.
+    """
+    todo = [subdir for subdir, do in zip(cohort.subdirs, cohort.noskip) if do]
+    failures = {}
+    passed = []
+    with ProcessPoolExecutor(max(workers, 1)) as pool:
+        for subdir, message in pool.map(triage_student, [cohort.make_student(subdir) for subdir in todo]):
+            subdir = path.realpath(subdir)
+            if message is None:
+                passed.append(subdir)
+                continue
+            failures[subdir] = message
+            log.warning(f"Pre-flight check failed for {path.basename(subdir)}: {message}")
+            if journal is not None:
+                journal.record(subdir, "triage", "failed", message=message)
+
+    history = {} if journal is None else journal.timings()
+    known = sorted(stages["mark"] for stages in history.values() if "mark" in stages)
+    default = known[len(known) // 2] if known else DEFAULT_MARK_TIME
+    expected = {subdir: history.get(path.basename(subdir), {}).get("mark", default) for subdir in passed}
+    order = sorted(passed, key=lambda subdir: expected[subdir], reverse=True)
+    estimate = estimate_runtime(list(expected.values()), workers if mark_workers is None else mark_workers)
+    log.info(
+        f"Pre-flight checks: {len(failures)} of {len(todo)} students can't be run, "
+        + f"estimated time to mark the rest is {estimate:.0f} seconds."
+    )
+    return TriageReport(failures, order, estimate)
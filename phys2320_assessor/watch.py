@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""Watch the download directory and the student folders, filing and marking students as their work arrives.
+
+At a deadline the Gradebook is downloaded again and again. :py:func:`watch_cohort` polls for new or changed zip files
+matching the download glob and for changes to the files in each student's folder - e.g. a marker editing the code or
+fixes.txt. Nothing is acted on until it has stopped changing for a few seconds, so half-downloaded zips and
+half-saved edits are left until they are complete. New zips are unzipped and filed with the usual newer-date check
+(see :py:func:`filer.build_submission_list`), changed folders have their skip file removed, and then just the
+students without a skip file are marked (and their pdfs made) by :py:func:`pipeline.run_pipeline`.
+"""
+import os
+from os import path
+from pathlib import Path
+import stat
+import time
+import zipfile
+
+from .filer import unzip_file, build_submission_list, process_file
+from .pipeline import run_pipeline
+
+__all__ = ["Watcher", "folder_state", "watch_cohort"]
+
+# Files written by marking a student, which shouldn't make the student look changed
+OUTPUTS = {"results.html", "results.pdf", "_results.pdf", "results.html.gz", "results.zip", "skip"}
+
+
+def folder_state(subdir):
+    """Return the names, sizes and modification times of the submitted files in the student folder subdir.
+
+    Hidden files, folders, the files written by marking (including the temp_ copy of oddly named code) and read-only
+    files (the placed standard data) are left out.
+    """
+    state = []
+    with os.scandir(subdir) as entries:
+        for entry in entries:
+            if entry.name.startswith((".", "temp_")) or entry.name in OUTPUTS:
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            info = entry.stat(follow_symlinks=False)
+            if info.st_mode & stat.S_IWUSR:
+                state.append((entry.name, info.st_size, info.st_mtime_ns))
+    return tuple(sorted(state))
+
+
+class Watcher(object):
+
+    """Poll the download glob and the student folders, reporting each change once it has settled."""
+
+    def __init__(self, download=None, settle=5.0):
+        """Watch for zip files matching the glob download in the current directory.
+
+        Keyword Arguments:
+            download (str, None):
+                glob pattern for the Gradebook zip files - None to only watch the student folders.
+            settle (float):
+                Seconds something must stay the same before it is reported.
+        """
+        self.download = download
+        self.settle = settle
+        self.seen = {}  # What each zip file or folder was when it was last acted on
+        self.pending = {}  # A change that hasn't settled yet and when it was first seen
+
+    def _settled(self, key, state, now):
+        """Return True if key has changed from what was last acted on and has stayed at state for settle seconds."""
+        if self.seen.get(key) == state:
+            self.pending.pop(key, None)
+            return False
+        first = self.pending.get(key)
+        if first is None or first[0] != state:
+            self.pending[key] = (state, now)
+            return False
+        return now - first[1] >= self.settle
+
+    def accept(self, key, state):
+        """Record that key has been acted on at state."""
+        self.seen[key] = state
+        self.pending.pop(key, None)
+
+    def baseline(self, subdirs):
+        """Accept the current state of the student folders subdirs, e.g. once they have been queued for marking."""
+        for subdir in subdirs:
+            self.accept(path.realpath(subdir), folder_state(subdir))
+
+    def downloads(self, now=None):
+        """Return a list of (zip file, state) for the new or changed zip files that have settled."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for zipf in sorted(Path(".").glob(self.download)) if self.download else []:
+            try:
+                info = zipf.stat()
+            except OSError:  # Removed since the glob
+                continue
+            state = (info.st_size, info.st_mtime_ns)
+            if self._settled(str(zipf), state, now) and zipfile.is_zipfile(zipf):
+                ready.append((str(zipf), state))
+        return ready
+
+    def folders(self, subdirs, now=None):
+        """Return a list of (folder, state) for the student folders in subdirs whose files have changed and settled."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for subdir in subdirs:
+            subdir = path.realpath(subdir)
+            try:
+                state = folder_state(subdir)
+            except OSError:
+                continue
+            if self._settled(subdir, state, now):
+                ready.append((subdir, state))
+        return ready
+
+
+def _student_folders():
+    """Return the student folders in the current directory."""
+    return [entry for entry in sorted(os.listdir(".")) if path.exists(path.join(entry, "readme.txt"))]
+
+
+def _unskip(subdir):
+    """Remove the skip file from the student folder subdir so the student is marked again."""
+    if path.exists(path.join(subdir, "skip")):
+        os.unlink(path.join(subdir, "skip"))
+
+
+def watch_cohort(
+    student_class,
+    download=None,
+    pattern=None,
+    directory="Student Work",
+    interval=10.0,
+    settle=5.0,
+    clobber=True,
+    mark_workers=1,
+    pdf_workers=1,
+    restart=False,
+    pdf=True,
+    prepare=True,
+    triage=True,
+    settings=None,
+    start_method="forkserver",
+    threads=1,
+    pin=False,
+    metrics=None,
+    max_polls=None,
+):
+    """File and mark students as new downloads and changes to their folders appear, until interrupted.
+
+    Args:
+        student_class (type):
+            The year's Assessor subclass.
+
+    Keyword Arguments:
+        download (str, None):
+            glob pattern for the Gradebook zip files, relative to directory. If None, only watch the student folders.
+        pattern (str, None):
+            Regular expression string for matching submission description files.
+        directory (str):
+            Working directory (default Student Work)
+        interval (float):
+            Seconds between polls.
+        settle (float):
+            Seconds a zip file or folder must stay the same before it is acted on.
+        max_polls (int, None):
+            Stop after this many polls - None to carry on until interrupted.
+
+    The other keyword arguments are passed to :py:func:`pipeline.run_pipeline` for each batch of students. The first
+    batch marks every student that still needs marking, as the run command would.
+
+    Returns:
+        (dict):
+            Mapping of student folder to the last stage completed, or an error message.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    directory = os.getcwd()
+    watcher = Watcher(download, settle)
+    watcher.baseline(_student_folders())
+    outcome = {}
+    polls = 0
+    first = True
+    try:
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            changed = first
+            for subdir, state in watcher.folders(_student_folders()):
+                print(f"Work changed in {path.basename(subdir)}")
+                watcher.accept(subdir, state)  # Changes made from here on are marked next time
+                _unskip(subdir)
+                changed = True
+            for zipf, state in watcher.downloads():
+                watcher.accept(zipf, state)
+                try:
+                    unzip_file(zipf)
+                except (zipfile.BadZipFile, OSError) as err:  # Try again once it has changed
+                    print(f"Couldn't unzip {zipf}: {err}")
+                    continue
+                for readme in build_submission_list(directory, pattern).values():
+                    filed = process_file(readme, clobber)
+                    print(f"Filed {filed}")
+                    _unskip(filed)  # A resubmission goes into the student's existing, already marked, folder
+                    watcher.baseline([filed])  # Being marked now
+                    changed = True
+            if changed:
+                outcome.update(
+                    run_pipeline(
+                        student_class,
+                        directory=directory,
+                        mark_workers=mark_workers,
+                        pdf_workers=pdf_workers,
+                        restart=restart or not first,
+                        pdf=pdf,
+                        prepare=prepare,
+                        triage=triage,
+                        settings=settings,
+                        start_method=start_method,
+                        threads=threads,
+                        pin=pin,
+                        metrics=metrics,
+                    )
+                )
+                first = False
+                print(f"Waiting for changes - {len(outcome)} students marked so far.")
+            if max_polls is None or polls < max_polls:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    return outcome
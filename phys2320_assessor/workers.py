@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""Pools of worker processes that start from a warm copy of the scientific python stack.
+
+Importing numpy, scipy, matplotlib (and building its font cache), uncertainties and pylint takes seconds - far longer
+than marking many students. The pools made here use the forkserver start method: a server process imports the
+assessor, the year's subclass and the modules students commonly use once, and every worker is then forked from it.
+By default each worker marks just one student before exiting, so student code can't leave anything behind for the
+next student, but the cost of a fresh worker is only a fork.
+
+So that parallel workers don't fight over the cores - which also makes the timings of the student and model code
+depend on whatever else is running - the BLAS/OpenMP libraries in each worker are limited to a few threads, and
+workers can optionally be pinned to a core of their own. :py:func:`calibrate` times a fixed piece of work so that
+timings from different hosts can be compared.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import functools
+import logging
+from logging.handlers import QueueHandler
+import multiprocessing as mp
+import os
+from os import path
+import socket
+import sys
+import tempfile
+from time import perf_counter
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+__all__ = ["PRELOAD", "THREAD_VARIABLES", "get_context", "make_pool", "pin_worker", "calibrate"]
+
+PRELOAD = [
+    "numpy",
+    "scipy",
+    "scipy.optimize",
+    "scipy.stats",
+    "scipy.signal",
+    "scipy.integrate",
+    "scipy.interpolate",
+    "matplotlib",
+    "matplotlib.pyplot",
+    "uncertainties",
+    "uncertainties.unumpy",
+    "pylint.lint",
+    "mccabe",
+    "pygments.lexers",
+    "pygments.formatters.html",
+    "phys2320_assessor.assessor",
+]
+
+# Environment variables read by the BLAS and OpenMP libraries when they are loaded
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+_pinned = None  # The open lock file that reserves this worker's core
+
+
+def pin_worker(lock_dir):
+    """Pin this process to a core that no other worker sharing lock_dir is using.
+
+    Each core has a lock file in lock_dir - the lock is held for the life of the process and is released by the
+    operating system when the worker exits, so the core is then free for the next worker.
+
+    Returns:
+        (int or None):
+            The core pinned to, or None if all the cores are taken (or pinning isn't supported).
+    """
+    global _pinned
+    if fcntl is None or not hasattr(os, "sched_setaffinity"):
+        return None
+    for cpu in sorted(os.sched_getaffinity(0)):
+        fd = os.open(path.join(lock_dir, f"cpu{cpu}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            continue
+        os.sched_setaffinity(0, {cpu})
+        _pinned = fd
+        return cpu
+    return None
+
+
+def _init_worker(threads, lock_dir, log_queue=None):
+    """Apply the thread limit and core pinning in a new worker process and send its log records to log_queue."""
+    if threads is not None and threadpool_limits is not None:
+        threadpool_limits(limits=threads)  # For libraries already loaded by the server process
+    if lock_dir is not None:
+        pin_worker(lock_dir)
+    logger = logging.getLogger("phys2320_assessor")
+    if log_queue is not None:
+        logger.addHandler(QueueHandler(log_queue))
+        logger.setLevel(logging.DEBUG)
+    elif not logger.handlers:  # Nobody is gathering the records, so print the messages as before
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def get_context(start_method="forkserver"):
+    """Return the multiprocessing context for start_method, or the platform default if it isn't available."""
+    return mp.get_context(start_method if start_method in mp.get_all_start_methods() else None)
+
+
+@functools.lru_cache(maxsize=None)
+def calibrate(repeat=5):
+    """Time a fixed mix of python and numpy work on this host.
+
+    The best of repeat attempts is used. Dividing a measured time by the calibration gives a figure that can be
+    compared between hosts. The BLAS libraries are held to one thread (if threadpoolctl is installed), so the result
+    is the same in the parent process as in a worker limited to one thread.
+
+    Returns:
+        (dict):
+            The host name and the calibration time in seconds.
+    """
+    import numpy as np
+
+    limit = threadpool_limits(limits=1) if threadpool_limits is not None else contextlib.nullcontext()
+    with limit:
+        best = _calibration_time(np, repeat)
+    return {"host": socket.gethostname(), "calibration": best}
+
+
+def _calibration_time(np, repeat):
+    """Return the best time of repeat runs of the calibration work."""
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        total = 0.0
+        for i in range(20000):
+            total += i**0.5
+        data = np.linspace(0.0, 1.0, 200000)
+        np.polyfit(data, np.sin(data), 3)
+        np.dot(data[:40000].reshape(200, 200), data[40000:80000].reshape(200, 200))
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def make_pool(workers, preload=(), isolate=True, start_method="forkserver", threads=1, pin=False, log_queue=None):
+    """Make a process pool whose workers are forked from a server with the scientific stack already imported.
+
+    Args:
+        workers (int):
+            Maximum number of worker processes.
+
+    Keyword Arguments:
+        preload (list of str):
+            Extra modules to import in the server - typically the module defining the year's Assessor subclass.
+        isolate (bool):
+            Give every task a freshly forked worker (needs Python 3.11 or later and a start method other than fork,
+            otherwise workers are reused).
+        start_method (str):
+            multiprocessing start method - *forkserver* if available, otherwise falls back to the platform default.
+        threads (int, None):
+            Most threads each worker's BLAS/OpenMP libraries may use, or None for no limit. The limit is passed through
+            the environment, so it should be the same for every pool made by a process as the server is only started
+            once (threadpoolctl is used as well if it is installed).
+        pin (bool):
+            Pin each worker to a core of its own (Linux only). The cores are shared out between all the pools made by
+            this process.
+        log_queue (Queue, None):
+            If given, the workers' log records are put on this queue (see :py:class:`progress.RunMonitor`) - it must
+            come from :py:func:`get_context` with the same start method. Otherwise the workers print their messages.
+
+    Returns:
+        (ProcessPoolExecutor):
+            The pool of workers.
+    """
+    os.environ.setdefault("MPLBACKEND", "Agg")  # Workers never have a display
+    if threads is not None:
+        for var in THREAD_VARIABLES:
+            os.environ[var] = str(threads)
+    lock_dir = None
+    if pin:
+        lock_dir = path.join(tempfile.gettempdir(), f"phys2320-cpus-{os.getpid()}")
+        os.makedirs(lock_dir, exist_ok=True)
+    ctx = get_context(start_method)
+    if ctx.get_start_method() == "forkserver":
+        modules = list(PRELOAD) + [mod for mod in preload if mod not in PRELOAD and mod != "__main__"]
+        ctx.set_forkserver_preload(modules)
+    kargs = {"mp_context": ctx, "initializer": _init_worker, "initargs": (threads, lock_dir, log_queue)}
+    if isolate and sys.version_info >= (3, 11) and ctx.get_start_method() != "fork":
+        kargs["max_tasks_per_child"] = 1
+    return ProcessPoolExecutor(max(workers, 1), **kargs)
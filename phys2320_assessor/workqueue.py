@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""A lease based work queue of students, kept in an SQLite file in the cohort directory.
+
+The queue lets any number of worker processes, on any machine that can see the cohort directory, share out the
+marking. A worker claims a student by taking a time limited lease on them, keeps the lease alive with heartbeats while
+marking, and records completion at the end. If a worker dies its leases expire and the students go back on the queue
+for another worker to pick up. Students are identified by their folder name, so hosts may mount the cohort directory
+at different paths.
+
+The database uses SQLite's default rollback journal (not WAL) as that is what works over network filesystems - each
+claim is a single short BEGIN IMMEDIATE transaction.
+"""
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import os
+from os import path
+import socket
+import sqlite3
+import threading
+import time
+
+from .cohort import ComputingClass
+from .journal import RunJournal
+from .pipeline import mark_student
+from .workers import make_pool, calibrate
+
+__all__ = ["WorkQueue", "run_worker"]
+
+log = logging.getLogger(__name__)
+
+
+class WorkQueue(object):
+
+    """Publish, claim, renew and complete leases on students to mark."""
+
+    def __init__(self, filename="work_queue.db", lease=300.0, max_attempts=3, timeout=60.0):
+        """Open (creating if necessary) the queue database.
+
+        Keyword Arguments:
+            filename (str):
+                The SQLite file - normally in the cohort directory.
+            lease (float):
+                How long in seconds a claim lasts without a heartbeat.
+            max_attempts (int):
+                A student whose lease has expired or whose worker has failed this many times is marked as failed
+                rather than being re-queued.
+            timeout (float):
+                How long to wait for the database lock.
+        """
+        self.filename = filename
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(filename, timeout=timeout, isolation_level=None)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS `tasks` (
+              `student` varchar(200) PRIMARY KEY,
+              `state` varchar(10) NOT NULL,
+              `owner` varchar(100),
+              `expires` real,
+              `attempts` int(11) NOT NULL DEFAULT 0,
+              `updated` real,
+              `message` text);
+            """
+        )
+
+    def __getstate__(self):
+        """Connections can't be pickled - reconnect on unpickling."""
+        state = self.__dict__.copy()
+        state.pop("conn", None)
+        return state
+
+    def __setstate__(self, state):
+        """Reconnect to the database."""
+        self.__dict__.update(state)
+        self.conn = sqlite3.connect(self.filename, timeout=60.0, isolation_level=None)
+
+    def _transaction(self, sql, *params):
+        """Run a list of (sql, params) statements in one immediate transaction, returning the last cursor."""
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            for statement, args in zip(sql, params):
+                cur.execute(statement, args)
+            self.conn.execute("COMMIT;")  # Not on cur - that would reset its rowcount
+        except Exception:
+            cur.execute("ROLLBACK;")
+            raise
+        return cur
+
+    def publish(self, subdirs, requeue=False):
+        """Add students to the queue.
+
+        Args:
+            subdirs (list of str):
+                Student folders.
+
+        Keyword Arguments:
+            requeue (bool):
+                Put students back on the queue even if they have already been done or have failed.
+
+        Returns:
+            (int):
+                Number of students now queued.
+        """
+        now = time.time()
+        if requeue:
+            sql = "INSERT OR REPLACE INTO tasks (student, state, attempts, updated) VALUES (?, 'queued', 0, ?);"
+        else:
+            sql = "INSERT OR IGNORE INTO tasks (student, state, attempts, updated) VALUES (?, 'queued', 0, ?);"
+        students = [path.basename(path.realpath(subdir)) for subdir in subdirs]
+        self._transaction([sql] * len(students), *[(student, now) for student in students])
+        return self.counts().get("queued", 0)
+
+    def expire(self):
+        """Put students whose lease has run out back on the queue (or fail them if they have had too many tries)."""
+        now = time.time()
+        self._transaction(
+            [
+                """UPDATE tasks SET state='failed', owner=NULL, updated=?, message='Lease expired too many times'
+                   WHERE state='leased' AND expires<? AND attempts>=?;""",
+                "UPDATE tasks SET state='queued', owner=NULL, updated=? WHERE state='leased' AND expires<?;",
+            ],
+            (now, now, self.max_attempts),
+            (now, now),
+        )
+
+    def claim(self, owner):
+        """Lease the next queued student to owner.
+
+        Returns:
+            (str or None):
+                The student folder name, or None if nothing is waiting.
+        """
+        self.expire()
+        now = time.time()
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            row = cur.execute("SELECT student FROM tasks WHERE state='queued' ORDER BY rowid LIMIT 1;").fetchone()
+            if row is not None:
+                cur.execute(
+                    """UPDATE tasks SET state='leased', owner=?, expires=?, attempts=attempts+1, updated=?
+                       WHERE student=?;""",
+                    (owner, now + self.lease, now, row[0]),
+                )
+            cur.execute("COMMIT;")
+        except Exception:
+            cur.execute("ROLLBACK;")
+            raise
+        return None if row is None else row[0]
+
+    def heartbeat(self, student, owner):
+        """Extend owner's lease on student. Returns False if the lease has been lost."""
+        now = time.time()
+        cur = self._transaction(
+            ["UPDATE tasks SET expires=?, updated=? WHERE student=? AND owner=? AND state='leased';"],
+            (now + self.lease, now, student, owner),
+        )
+        return cur.rowcount > 0
+
+    def complete(self, student, owner, message=None):
+        """Record that owner has finished marking student.
+
+        Returns False (and records nothing) if owner's lease had already run out and the student was put back on the
+        queue or claimed by another worker.
+        """
+        cur = self._transaction(
+            [
+                """UPDATE tasks SET state='done', expires=NULL, updated=?, message=?
+                   WHERE student=? AND owner=? AND state='leased';"""
+            ],
+            (time.time(), message, student, owner),
+        )
+        return cur.rowcount > 0
+
+    def release(self, student, owner, message=None):
+        """Give up owner's lease on student after a failure - re-queued unless it has had too many attempts."""
+        now = time.time()
+        self._transaction(
+            [
+                """UPDATE tasks SET state=CASE WHEN attempts>=? THEN 'failed' ELSE 'queued' END, owner=NULL,
+                   expires=NULL, updated=?, message=? WHERE student=? AND owner=?;"""
+            ],
+            (self.max_attempts, now, message, student, owner),
+        )
+
+    def counts(self):
+        """Return a dictionary of the number of students in each state."""
+        return dict(self.conn.execute("SELECT state, count(*) FROM tasks GROUP BY state;").fetchall())
+
+    def idle(self):
+        """True if there is nothing queued or being worked on."""
+        counts = self.counts()
+        return counts.get("queued", 0) == 0 and counts.get("leased", 0) == 0
+
+
+def run_worker(
+    student_class,
+    directory=".",
+    workers=1,
+    lease=300.0,
+    poll=5.0,
+    settings=None,
+    start_method="forkserver",
+    exit_when_idle=True,
+    threads=1,
+    pin=False,
+):
+    """Claim students from the cohort's work queue and mark them until the queue is empty.
+
+    Args:
+        student_class (type):
+            The year's Assessor subclass.
+
+    Keyword Arguments:
+        directory (str):
+            The cohort directory holding work_queue.db.
+        workers (int):
+            How many students this worker marks at once.
+        lease (float):
+            Lease length in seconds - heartbeats are sent every third of this.
+        poll (float):
+            How often to check the queue when there is nothing to claim.
+        settings (dict, None):
+            Assessor attribute overrides.
+        start_method (str):
+            multiprocessing start method for the marking pool.
+        exit_when_idle (bool):
+            Stop once nothing is queued or leased by anyone, otherwise keep polling for new work.
+        threads (int, None):
+            Most BLAS/OpenMP threads each marking process may use.
+        pin (bool):
+            Pin each marking process to a core of its own.
+
+    Returns:
+        (dict):
+            Mapping of student folder name to outcome for the students this worker handled - "lease lost" if the
+            lease ran out before marking finished, so that the queue's record of the student is left to whoever holds
+            it now.
+    """
+    os.chdir(directory)
+    cohort = ComputingClass(".", student_class=student_class, restart=True, ignore_skip=True, settings=settings)
+    queue = WorkQueue(lease=lease)
+    journal = RunJournal(".")
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    outcome = {}
+    active = {}
+    stop = threading.Event()
+
+    def heartbeat():
+        beats = WorkQueue(lease=lease)  # sqlite connections belong to one thread
+        while not stop.wait(lease / 3.0):
+            for student in list(active.values()):
+                if not beats.heartbeat(student, owner):
+                    log.warning(f"Lost the lease on {student}")
+
+    host = calibrate()  # Once, rather than in every fresh worker
+    beater = threading.Thread(target=heartbeat, daemon=True)
+    beater.start()
+    pool = None
+    try:
+        while True:
+            if pool is None:
+                pool = make_pool(
+                    workers, [student_class.__module__], start_method=start_method, threads=threads, pin=pin
+                )
+            while len(active) < workers:
+                student = queue.claim(owner)
+                if student is None:
+                    break
+                try:
+                    active[pool.submit(mark_student, cohort.make_student(student), journal, host)] = student
+                except IOError as err:
+                    queue.release(student, owner, str(err))
+                    outcome[student] = f"mark failed: {err}"
+            if not active:
+                if exit_when_idle and queue.idle():
+                    break
+                time.sleep(poll)
+                continue
+            done, _ = wait(list(active), timeout=poll, return_when=FIRST_COMPLETED)
+            for future in done:
+                student = active.pop(future)
+                try:
+                    future.result()
+                except BrokenProcessPool:
+                    queue.release(student, owner, "Worker process stopped")
+                    outcome[student] = "mark failed: worker process stopped"
+                    if pool is not None:
+                        pool.shutdown(wait=False)
+                        pool = None
+                except Exception as err:
+                    queue.release(student, owner, str(err))
+                    outcome[student] = f"mark failed: {err}"
+                else:
+                    if queue.complete(student, owner):
+                        outcome[student] = "marked"
+                        log.info(f"Marked {student}")
+                    else:  # Another worker has it now - leave the queue to record their result
+                        outcome[student] = "lease lost"
+                        log.warning(f"Lost the lease on {student} before marking finished - left to the queue")
+    finally:
+        stop.set()
+        if pool is not None:
+            pool.shutdown()
+        cohort.close()
+    return outcome